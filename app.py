@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory, send_file
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, Response, g
 from flask_cors import CORS
 import ollama
 import uuid
@@ -10,32 +10,54 @@ import atexit
 import threading
 import logging
 import time
-import tempfile
-import shutil
-from duckduckgo_search import DDGS
+import copy
 from werkzeug.utils import secure_filename
-from PIL import Image
-from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
-import torch
+from instrumentacao import metricas, LockMedido
+from armazenamento import load_data, sanitize_filename, save_data, PersistenceCoordinator, SAVE_INTERVAL
+from conversas import Chat, ChatStore, ChatManager
+from fila_tarefas import BackgroundTaskQueue
+from estado_partilhado import LocalState, STATE_BACKENDS, SharedJsonDocument
+from cache_artefactos import ArtifactStore
+from escalonador_ollama import OllamaScheduler, SobrecargaOllama, OllamaIndisponivel, OLLAMA_RETRIES
+from memorias import MemoryIndex, EMBEDDING_BACKENDS
+from servico_imagens import ImageJobService, IMAGE_SEED, IMAGE_SIZE
+from registo_feedback import FeedbackStore
+from busca_web import WebSearchService, SEARCH_PROVIDERS
+from indice_documentos import DocumentService, estimar_tokens, termos_pesquisa
+# torch, diffusers, PIL e duckduckgo_search são importados só quando são usados (arranque rápido)
 
 app = Flask(__name__)
 CORS(app)
 
-CHATS_FILE = 'chats_data.json'
+CHATS_FILE = 'chats_data.json'  # formato antigo, migrado para CHATS_DB no arranque
 USER_INFO_FILE = 'user_infos.json'
 SETTINGS_FILE = 'settings.json'
-FEEDBACK_FILE = 'feedback_data.json'
+FEEDBACK_FILE = 'feedback_data.json'  # formato antigo, migrado para FEEDBACK_LOG no arranque
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'txt'}
-
-cancel_flags = {}
-
-# Locks para garantir thread safety
-chats_lock = threading.Lock()
-user_infos_lock = threading.Lock()
-settings_lock = threading.Lock()
-
-SAVE_INTERVAL = 10  # segundos
+TIPOS_FICHEIRO = ['pdf', 'txt', 'csv', 'json', 'py', 'docx', 'xlsx', 'pptx']
+
+# 'local': estado em memória (um só processo). 'sqlite': partilhado por vários workers (ex: gunicorn -w N)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'local')
+
+CHAT_PAGE_MAX = 200  # blocos por página em GET /chat/<cid>?limit=
+COMPACT_INTERVAL = 300  # atraso máximo (s) da compactação da base de dados dos chats depois de uma escrita
+ESPERA_ANALISE = 30  # segundos que a resposta espera pela análise da mensagem
+ANALISE_WORKERS = 4  # análises de mensagens em simultâneo (fila própria: as respostas esperam por elas)
+CONTEXT_TOKENS = int(os.environ.get('CONTEXT_TOKENS', 4096))  # orçamento (estimado) do prompt enviado ao modelo
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')  # tempo que o modelo (e a KV cache) fica carregado
+# num_ctx igual em todas as chamadas: mudá-lo obriga o Ollama a recarregar o modelo e perde a KV cache
+OLLAMA_NUM_CTX = CONTEXT_TOKENS + 1024  # orçamento do prompt + espaço para a resposta
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.1:8b')  # modelo das respostas e das extrações
+OLLAMA_SMALL_MODEL = os.environ.get('OLLAMA_SMALL_MODEL', 'llama3.2:3b')  # modelo das classificações e dos títulos
+MODEL_WARM_INTERVAL = 600  # segundos entre aquecimentos dos modelos já usados (deve ser menor que o keep_alive)
+MEMORY_EMBEDDINGS = os.environ.get('MEMORY_EMBEDDINGS', 'ollama')  # backend dos embeddings das memórias: 'ollama' ou 'hash'
+MEMORY_MAX = 5000  # memórias guardadas por utilizador (as mais antigas saem primeiro)
+SEARCH_PROVIDER = os.environ.get('SEARCH_PROVIDER', 'ddg')  # 'ddg' (DuckDuckGo) ou 'local' (índice em SEARCH_LOCAL_INDEX)
+SEARCH_MAX_QUERIES = 5  # pesquisas por pedido em /api/websearch
+SUMMARY_BATCH = 4  # blocos extra incluídos no resumo de cada vez, para não o recalcular a cada mensagem
+SEND_DEADLINE = 180  # prazo total (s) de um /chat/<id>/send: espera na fila, geração e análise
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'  # cabeçalho Server-Timing com as etapas de cada pedido (debug)
 
 # Configuração básica do logging
 logging.basicConfig(
@@ -47,7 +69,31 @@ logging.basicConfig(
     ]
 )
 
+# Locks para garantir thread safety (os chats têm locks próprios dentro do ChatManager)
+user_infos_lock = LockMedido('user_infos')
+settings_lock = LockMedido('settings')
+
 # Prompts comuns
+# Mensagem de sistema fixa. Faz parte do prefixo estável do prompt (ver prefixo_sistema):
+# qualquer alteração aqui deve incrementar PROMPT_VERSAO.
+PROMPT_VERSAO = 1
+PROMPT_SISTEMA = """
+Identidade e Função:
+És o Llama 3, um modelo de linguagem do Ollama. Foste criado para ajudar os utilizadores com informações úteis, gerar texto, responder a perguntas, resolver problemas e muito mais.
+
+Estilo de Comunicação:
+Sê direto, claro e profissional.
+Não faças elogios exagerados ou bajulação.
+Mantém um tom humano e caloroso, mas evita soar robótico ou artificialmente entusiasmado.
+Prioriza a honestidade: se não souberes algo, diz-o abertamente.
+Evita adivinhar o que o utilizador quer sem confirmação. Pergunta se necessário.
+
+Linguagem e Preferências do Utilizador:
+Lê e adapta-te às preferências do utilizador com base no contexto da conversa (por exemplo, se preferir respostas curtas, em português europeu, técnicas, etc.).
+
+Privacidade e Segurança:
+Nunca peças, guardes ou reveles dados sensíveis.
+"""
 PROMPT_EXTRAIR_INFO = (
     "Extraia e salve informações pessoais relevantes do usuário (nome, profissão, interesses, cidade, clube, etc) "
     "a partir da mensagem abaixo. Responda apenas com um JSON contendo os campos detectados.\n"
@@ -60,91 +106,54 @@ PROMPT_EXTRAIR_MEMORIA = (
     "Responda no formato: 'O utilizador ...'. Se não houver informação pessoal relevante, responda apenas com 'N/A'.\n"
     "Mensagem: \"{user_text}\""
 )
+# Análise única da mensagem: substitui as chamadas separadas de perfil, memória, ficheiro, imagem e título
+PROMPT_ANALISAR_MENSAGEM = (
+    "Analisa a mensagem do utilizador abaixo e responde apenas com um objeto JSON com exatamente estes campos:\n"
+    "- \"perfil\": objeto com informações pessoais relevantes do utilizador (nome, profissão, interesses, cidade, clube, etc); {{}} se não houver.\n"
+    "- \"memoria\": uma frase curta e objetiva no formato 'O utilizador ...' que resuma uma informação pessoal relevante sobre o utilizador "
+    "(gostos, hobbies, interesses, línguas que fala, preferências, profissão, localidade, idade, etc), ignorando tópicos de conversa, "
+    "eventos históricos ou notícias; null se não houver.\n"
+    "- \"quer_ficheiro\": true se o utilizador pede para gerar um ficheiro, senão false.\n"
+    "- \"tipo_ficheiro\": um de pdf, txt, csv, json, py, docx, xlsx, pptx, ou null.\n"
+    "- \"quer_imagem\": true se o utilizador pede para gerar uma imagem, senão false.\n"
+    "- \"titulo\": {instrucao_titulo}\n"
+    "Mensagem: \"{user_text}\""
+)
+# Resumo incremental da parte de uma conversa que já não cabe no contexto
+PROMPT_RESUMO_CONVERSA = (
+    "Atualiza o resumo de uma conversa entre um utilizador e um assistente. "
+    "Mantém os factos, decisões, pedidos e preferências importantes; omite cumprimentos e detalhes irrelevantes. "
+    "Responde apenas com o resumo atualizado, em texto corrido, com no máximo 200 palavras.\n"
+    "Resumo atual: \"{resumo}\"\n"
+    "Novas mensagens:\n{mensagens}"
+)
+INSTRUCAO_TITULO = (
+    "nome curto e técnico (máximo 5 palavras, sem pontuação extra nem adjetivos vagos) que descreva o tema da conversa; "
+    "se for apenas uma saudação, um título neutro como 'Saudações'."
+)
 
-def load_data(file_path, default_data=None):
-    if default_data is None:
-        default_data = {}
-    if not os.path.exists(file_path):
-        return default_data
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        logging.warning(f"Falha ao carregar {file_path}: {e}")
-        return default_data
-
-def sanitize_filename(filename):
-    # Permite apenas letras, números, hífen e sublinhado
-    return re.sub(r'[^a-zA-Z0-9_.-]', '_', filename)
-
-def save_data(file_path, data):
-    # Caminho absoluto seguro
-    file_path = os.path.abspath(file_path)
-    dir_name = os.path.dirname(file_path)
-    # Sanitiza o nome do arquivo (apenas para arquivos novos criados a partir de input)
-    base = os.path.basename(file_path)
-    safe_base = sanitize_filename(base)
-    file_path = os.path.join(dir_name, safe_base)
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name, exist_ok=True)
-    try:
-        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=dir_name, delete=False) as tf:
-            json.dump(data, tf, ensure_ascii=False, indent=2)
-            tf.flush()
-            os.fsync(tf.fileno())
-            tempname = tf.name
-        os.replace(tempname, file_path)
-        os.chmod(file_path, 0o600)  # Permissões restritas
-    except Exception as e:
-        logging.error(f"Erro ao salvar {file_path} (escrita segura): {e}")
-
-class Chat:
-    def __init__(self, cid, data):
-        self.cid = cid
-        self.data = data
-
-    @property
-    def name(self):
-        return self.data.get('name', 'Novo Chat')
-
-    @name.setter
-    def name(self, value):
-        self.data['name'] = value
-
-    def add_message(self, user_text, ai_text):
-        self.data.setdefault('conversation_blocks', []).append({
-            'user_variants': [user_text],
-            'ai_responses': [ai_text],
-            'selected': 0
-        })
-
-    def get_conversation_blocks(self):
-        return self.data.get('conversation_blocks', [])
-
-    def to_dict(self):
-        return self.data
-
-# Helper to wrap chats dict with Chat objects
-class ChatManager:
-    def __init__(self, chats_dict):
-        self.chats_dict = chats_dict
-    def __getitem__(self, cid):
-        return Chat(cid, self.chats_dict[cid])
-    def __setitem__(self, cid, chat_obj):
-        self.chats_dict[cid] = chat_obj.to_dict()
-    def __delitem__(self, cid):
-        del self.chats_dict[cid]
-    def items(self):
-        return ((cid, Chat(cid, data)) for cid, data in self.chats_dict.items())
-    def get(self, cid):
-        if cid in self.chats_dict:
-            return Chat(cid, self.chats_dict[cid])
-        return None
-    def __contains__(self, cid):
-        return cid in self.chats_dict
-
-chats = ChatManager(load_data(CHATS_FILE))
+estado = STATE_BACKENDS[STATE_BACKEND]()
+chat_store = ChatStore()
+chat_store.migrar_json(CHATS_FILE)
+chats = ChatManager(chat_store, estado)
+artefactos = ArtifactStore(UPLOAD_FOLDER)
+ollama_pool = OllamaScheduler(OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX)
+persistencia = PersistenceCoordinator()
+indice_memorias = MemoryIndex(EMBEDDING_BACKENDS[MEMORY_EMBEDDINGS](ollama_pool), persistencia)
 user_infos = load_data(USER_INFO_FILE)
+tarefas = BackgroundTaskQueue()
+analises = BackgroundTaskQueue(ANALISE_WORKERS, nome='analises')
+
+# Notificações por chat (nome gerado, memória guardada) e pedidos de cancelamento ficam no estado
+# partilhado: o pedido seguinte do cliente pode chegar a outro worker
+def pedir_cancelamento(cid):
+    estado.definir('cancelar', cid, True)
+
+def cancelamento_pedido(cid):
+    return estado.obter('cancelar', cid, False)
+
+def limpar_cancelamento(cid):
+    estado.remover('cancelar', cid)
 
 def get_default_settings():
     return {
@@ -159,6 +168,208 @@ def get_default_settings():
 settings = load_data(SETTINGS_FILE, get_default_settings())
 if not os.path.exists(SETTINGS_FILE):
     save_data(SETTINGS_FILE, settings)
+documento_settings = SharedJsonDocument('settings', SETTINGS_FILE, settings, settings_lock, estado)
+
+# Modelo e opções por tipo de tarefa; settings.json -> "models" altera só os campos indicados.
+# Tarefas que partilham um modelo têm de usar o mesmo num_ctx (outro valor obriga o Ollama a recarregá-lo).
+MODELOS_POR_OMISSAO = {
+    'chat': {'model': OLLAMA_MODEL, 'num_ctx': OLLAMA_NUM_CTX, 'keep_alive': OLLAMA_KEEP_ALIVE},
+    'extraction': {'model': OLLAMA_MODEL, 'num_ctx': OLLAMA_NUM_CTX, 'num_predict': 512, 'temperature': 0.2,
+                   'keep_alive': OLLAMA_KEEP_ALIVE},
+    'classification': {'model': OLLAMA_SMALL_MODEL, 'num_ctx': 2048, 'num_predict': 8, 'temperature': 0,
+                       'keep_alive': OLLAMA_KEEP_ALIVE},
+    'naming': {'model': OLLAMA_SMALL_MODEL, 'num_ctx': 2048, 'num_predict': 24, 'temperature': 0.3,
+               'keep_alive': OLLAMA_KEEP_ALIVE},
+}
+
+def validar_modelos(config):
+    # Devolve a mensagem de erro, ou None se a secção "models" das definições for válida
+    if not isinstance(config, dict):
+        return "'models' deve ser um objeto"
+    efetivos = {}
+    for tarefa, campos in config.items():
+        if tarefa not in MODELOS_POR_OMISSAO:
+            return f"Tarefa desconhecida em 'models': {tarefa} (válidas: {', '.join(MODELOS_POR_OMISSAO)})"
+        if not isinstance(campos, dict):
+            return f"models.{tarefa} deve ser um objeto"
+        for campo, valor in campos.items():
+            if campo == 'model':
+                if not isinstance(valor, str) or not valor.strip():
+                    return f"models.{tarefa}.model deve ser o nome de um modelo"
+            elif campo == 'num_ctx':
+                if not isinstance(valor, int) or isinstance(valor, bool) or not 256 <= valor <= 131072:
+                    return f"models.{tarefa}.num_ctx deve ser um inteiro entre 256 e 131072"
+            elif campo == 'num_predict':
+                if not isinstance(valor, int) or isinstance(valor, bool) or not (valor == -1 or 1 <= valor <= 8192):
+                    return f"models.{tarefa}.num_predict deve ser -1 ou um inteiro entre 1 e 8192"
+            elif campo == 'temperature':
+                if not isinstance(valor, (int, float)) or isinstance(valor, bool) or not 0 <= valor <= 2:
+                    return f"models.{tarefa}.temperature deve ser um número entre 0 e 2"
+            elif campo == 'keep_alive':
+                if isinstance(valor, bool) or not isinstance(valor, (str, int)):
+                    return f"models.{tarefa}.keep_alive deve ser uma duração (ex: '30m') ou segundos"
+            else:
+                return f"Campo desconhecido em models.{tarefa}: {campo}"
+        efetivos[tarefa] = dict(MODELOS_POR_OMISSAO[tarefa], **campos)
+    for tarefa, padrao in MODELOS_POR_OMISSAO.items():
+        efetivos.setdefault(tarefa, padrao)
+    contextos = {}
+    for tarefa, cfg in efetivos.items():
+        anterior = contextos.setdefault(cfg['model'], (tarefa, cfg['num_ctx']))
+        if anterior[1] != cfg['num_ctx']:
+            return (f"models.{tarefa} e models.{anterior[0]} usam o modelo {cfg['model']} com num_ctx diferentes "
+                    "(o Ollama teria de recarregar o modelo a cada troca)")
+    return None
+
+class ModelRouter:
+    # Escolhe o modelo e as opções de cada chamada pelo tipo de tarefa (MODELOS_POR_OMISSAO + settings).
+    # Cada modelo tem o seu limite de pedidos no ollama_pool, por isso as classificações e os títulos
+    # num modelo pequeno não esperam pelas respostas do modelo principal.
+    # Um modelo que o Ollama não tem (404) é substituído pelo modelo do chat durante MODEL_WARM_INTERVAL.
+    # Uma thread volta a carregar os modelos usados antes de o keep_alive expirar.
+    def __init__(self, settings, lock, intervalo=MODEL_WARM_INTERVAL):
+        self.settings = settings
+        self.lock = lock
+        self.intervalo = intervalo
+        self._estado_lock = threading.Lock()
+        self._indisponiveis = {}  # modelo -> quando deixou de ser usado
+        self._usados = {}  # modelo -> (último uso, opções para o aquecer)
+        erro = validar_modelos(settings.get('models') or {})
+        if erro:
+            # settings.json editado à mão: fica com as omissões em vez de mandar opções inválidas ao Ollama
+            logging.warning(f"Secção 'models' de {SETTINGS_FILE} ignorada: {erro}")
+            with lock:
+                settings.pop('models', None)
+        threading.Thread(target=self._aquecedor, name='modelos-aquecer', daemon=True).start()
+
+    def config(self, tarefa):
+        with self.lock:
+            campos = (self.settings.get('models') or {}).get(tarefa) or {}
+        return dict(MODELOS_POR_OMISSAO[tarefa], **campos)
+
+    def efetivos(self):
+        return {tarefa: self.config(tarefa) for tarefa in MODELOS_POR_OMISSAO}
+
+    def _disponivel(self, modelo):
+        with self._estado_lock:
+            desde = self._indisponiveis.get(modelo)
+            if desde is not None and time.time() - desde >= self.intervalo:
+                del self._indisponiveis[modelo]
+                desde = None
+            return desde is None
+
+    def parametros(self, tarefa):
+        # Devolve (modelo, kwargs para o ollama_pool)
+        cfg = self.config(tarefa)
+        if tarefa != 'chat' and not self._disponivel(cfg['model']):
+            principal = self.config('chat')
+            cfg = dict(cfg, model=principal['model'], num_ctx=principal['num_ctx'], keep_alive=principal['keep_alive'])
+        opcoes = {k: cfg[k] for k in ('num_ctx', 'num_predict', 'temperature') if k in cfg}
+        with self._estado_lock:
+            self._usados[cfg['model']] = (time.time(), {'options': {'num_ctx': cfg['num_ctx']}, 'keep_alive': cfg['keep_alive']})
+        return cfg['model'], {'options': opcoes, 'keep_alive': cfg['keep_alive']}
+
+    def modelo(self, tarefa):
+        return self.parametros(tarefa)[0]
+
+    def chat(self, tarefa, mensagens, **kwargs):
+        modelo, opcoes = self.parametros(tarefa)
+        try:
+            return ollama_pool.chat(modelo, mensagens, **opcoes, **kwargs)
+        except ollama.ResponseError as e:
+            if e.status_code != 404 or tarefa == 'chat':
+                raise
+            logging.warning(f"Modelo {modelo} indisponível no Ollama ({e}); a usar o modelo do chat para '{tarefa}'")
+            with self._estado_lock:
+                self._indisponiveis[modelo] = time.time()
+            modelo, opcoes = self.parametros(tarefa)
+            return ollama_pool.chat(modelo, mensagens, **opcoes, **kwargs)
+
+    def aquecer(self, escolhidos=None):
+        # Carrega os modelos (mensagens vazias: o Ollama só carrega o modelo e renova o keep_alive)
+        if escolhidos is None:
+            escolhidos = {}
+            for tarefa in MODELOS_POR_OMISSAO:
+                modelo, opcoes = self.parametros(tarefa)
+                escolhidos.setdefault(modelo, {'options': {'num_ctx': opcoes['options']['num_ctx']},
+                                               'keep_alive': opcoes['keep_alive']})
+        for modelo, opcoes in escolhidos.items():
+            inicio = time.time()
+            try:
+                ollama_pool.chat(modelo, [], **opcoes)
+                logging.info(f"Modelo {modelo} carregado em {time.time() - inicio:.1f}s")
+            except Exception as e:
+                logging.warning(f"Falha ao aquecer o modelo {modelo}: {e}")
+
+    def _aquecedor(self):
+        while True:
+            time.sleep(self.intervalo)
+            # Só os modelos usados recentemente: um modelo esquecido pode ser descarregado
+            agora = time.time()
+            with self._estado_lock:
+                escolhidos = {m: opcoes for m, (usado, opcoes) in self._usados.items()
+                              if agora - usado < 3 * self.intervalo and m not in self._indisponiveis}
+            if escolhidos and ollama_pool.breaker.metrics()['estado'] != 'aberto':
+                self.aquecer(escolhidos)
+
+modelos = ModelRouter(settings, settings_lock)
+
+def montar_prefixo(perfil, incluir_perfil):
+    # Mensagens de sistema do início do prompt. O resultado é determinístico (campos ordenados,
+    # valores serializados de forma estável) para o Ollama reutilizar a KV cache deste prefixo
+    mensagens = [{'role': 'system', 'content': PROMPT_SISTEMA}]
+    if not (incluir_perfil and perfil):
+        return mensagens
+    system_context = "As informações a seguir são sobre o usuário. Use-as para personalizar suas respostas de forma implícita, sem mencioná-las diretamente.\n"
+    campos = 0
+    for key in sorted(perfil):
+        value = perfil[key]
+        # As memórias não entram no prefixo: só as relevantes, junto da mensagem (mensagem_memorias)
+        if key == 'memorias_resumidas' or not value:
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        system_context += f"- {key.replace('_', ' ').capitalize()}: {value}\n"
+        campos += 1
+    if campos:
+        mensagens.append({'role': 'system', 'content': system_context})
+    return mensagens
+
+# user_id -> (chave, mensagens): o prefixo só é remontado quando o perfil ou a configuração mudam
+prefixos = {}
+prefixos_lock = threading.Lock()
+
+def limpar_prefixos():
+    # Chamado quando o perfil é recarregado de outro worker (a geração local não mudou)
+    with prefixos_lock:
+        prefixos.clear()
+
+documento_user_infos = SharedJsonDocument('user_infos', USER_INFO_FILE, user_infos, user_infos_lock, estado,
+                                          ao_recarregar=limpar_prefixos)
+
+@app.before_request
+def sincronizar_estado():
+    # Com vários workers: recarrega o que outro processo alterou (sem alterações, só lê contadores)
+    if estado.partilhado:
+        documento_user_infos.sincronizar()
+        documento_settings.sincronizar()
+        chats.sincronizar()
+
+def prefixo_sistema(user_id):
+    incluir_perfil = settings.get('memory', {}).get('reference_saved_memories', False)
+    # A geração de user_infos muda a cada alteração do perfil (marcar_sujo)
+    chave = (PROMPT_VERSAO, persistencia.geracao('user_infos'), incluir_perfil)
+    with prefixos_lock:
+        em_cache = prefixos.get(user_id)
+        if em_cache and em_cache[0] == chave:
+            return list(em_cache[1])
+    # Cópia do perfil: as tarefas em segundo plano podem alterá-lo durante este pedido
+    with user_infos_lock:
+        perfil = copy.deepcopy(user_infos.get(user_id, {}))
+    mensagens = montar_prefixo(perfil, incluir_perfil)
+    with prefixos_lock:
+        prefixos[user_id] = (chave, mensagens)
+    return list(mensagens)
 
 def new_chat_obj(name="Novo Chat"):
     return {'name': name, 'conversation_blocks': []}
@@ -167,56 +378,110 @@ def new_chat_obj(name="Novo Chat"):
 def index():
     return render_template('index.html')
 
+def resposta_condicional(etag, gerar):
+    # ETag (fraca) a partir de contadores de versão: se o cliente já tem esta versão responde 304 sem
+    # gerar o corpo. Cache-Control: no-cache faz o browser revalidar sempre, mas reaproveitar o corpo.
+    if request.if_none_match.contains_weak(etag):
+        resposta = app.response_class(status=304)
+    else:
+        resposta = gerar()
+        if resposta.status_code != 200:
+            return resposta
+    resposta.set_etag(etag, weak=True)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
 @app.route('/chats', methods=['GET'])
 def list_chats():
-    return jsonify([{'id': cid, 'name': chat.name} for cid, chat in chats.items()])
+    # Sem parâmetros: lista completa. ?since=<cursor>: só os chats alterados/apagados desde esse cursor
+    # (o primeiro pedido usa since= vazio e recebe a lista completa com 'full': true)
+    if 'since' in request.args:
+        alteracoes = chats.alteracoes(request.args['since'])
+        return resposta_condicional(alteracoes['cursor'], lambda: jsonify(alteracoes))
+    return resposta_condicional(chats.etag_listagem(), lambda: jsonify(chats.listar()))
 
 @app.route('/chat', methods=['POST'])
 def create_chat():
     cid = str(uuid.uuid4())
-    with chats_lock:
-        chats[cid] = Chat(cid, new_chat_obj())
+    chats[cid] = Chat(cid, new_chat_obj())
     return jsonify({'id': cid, 'name': chats[cid].name})
 
 @app.route('/chat/<cid>', methods=['GET'])
 def get_chat(cid):
-    chat = chats.get(cid)
-    if not chat:
+    # Sem parâmetros: todos os blocos. ?limit=N[&before=idx]: janela dos N blocos anteriores a `before`
+    # (por omissão os mais recentes); 'next_before' é o cursor da janela seguinte (mais antiga).
+    versao = chats.versao(cid)
+    if versao is None:
         return jsonify({'error': 'Chat não encontrado'}), 404
-    return jsonify(chat.get_conversation_blocks())
+    if 'limit' not in request.args:
+        return resposta_condicional(str(versao), lambda: jsonify(chats.copia_blocos(cid) or []))
+    try:
+        limite = min(CHAT_PAGE_MAX, max(1, int(request.args['limit'])))
+        antes = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({'error': 'limit e before devem ser números'}), 400
+
+    def gerar():
+        janela = chats.janela_blocos(cid, antes, limite)
+        if janela is None:
+            resposta = jsonify({'error': 'Chat não encontrado'})
+            resposta.status_code = 404
+            return resposta
+        versao_atual, total, inicio, blocks = janela
+        return jsonify({'blocks': blocks, 'start': inicio, 'total': total, 'versao': versao_atual,
+                        'next_before': inicio if inicio > 0 else None})
+    return resposta_condicional(str(versao), gerar)
 
 @app.route('/chat/<cid>', methods=['DELETE'])
 def delete_chat(cid):
-    with chats_lock:
-        if cid in chats:
-            del chats[cid]
-            return jsonify({'ok': True})
+    if chats.remover(cid):
+        documentos.remover_chat(cid)
+        return jsonify({'ok': True})
     return jsonify({'error': 'Chat não encontrado'}), 404
 
+@app.route('/api/search', methods=['GET'])
+def search_chats():
+    # ?q=...&page=1&per_page=20 -> resultados ordenados por relevância (BM25), com excertos
+    if not chat_store.pesquisa_disponivel:
+        return jsonify({'error': 'Pesquisa indisponível (SQLite sem FTS5)'}), 501
+    termos = termos_pesquisa(request.args.get('q', ''))[:20]
+    if not termos:
+        return jsonify({'error': 'Pesquisa vazia'}), 400
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(100, max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify({'error': 'page e per_page devem ser números'}), 400
+    # Cada termo entre aspas (sem sintaxe FTS5 vinda do utilizador) e como prefixo; todos obrigatórios
+    consulta = ' '.join(f'"{t}"*' for t in termos)
+    inicio = time.perf_counter()
+    total, resultados = chat_store.pesquisar(consulta, per_page, (page - 1) * per_page)
+    return jsonify({'query': request.args.get('q'), 'total': total, 'page': page, 'per_page': per_page,
+                    'results': resultados, 'took_ms': round((time.perf_counter() - inicio) * 1000, 1)})
+
 @app.route('/chat/<cid>/rename', methods=['POST'])
 def rename_chat(cid):
     new_name = request.json.get('name', '').strip()
     new_name = bleach.clean(new_name)
     if len(new_name) > 200:
         return jsonify({'error': 'Nome demasiado longo (máx 200 caracteres)'}), 400
-    with chats_lock:
-        if cid in chats and new_name:
-            chats[cid].name = new_name
-            return jsonify({'ok': True})
+    if new_name and chats.renomear(cid, new_name):
+        return jsonify({'ok': True})
     return jsonify({'error': 'Chat não encontrado ou nome inválido'}), 400
 
-# Função genérica para executar prompts no Ollama, com retries exponenciais
-def executar_prompt(prompt, model='llama3.1:8b', max_retries=3):
-    delay = 1
-    for attempt in range(max_retries):
-        try:
-            response = ollama.chat(model=model, messages=[{'role': 'system', 'content': prompt}])
-            return response['message']['content']
-        except Exception as e:
-            logging.warning(f"Erro ao executar prompt no Ollama (tentativa {attempt+1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(delay)
-                delay *= 2
+# Função genérica para executar prompts no Ollama (os retries e o circuit breaker estão no ollama_pool)
+def executar_prompt(prompt, tarefa='extraction', max_retries=OLLAMA_RETRIES, formato=None,
+                    prioridade=OllamaScheduler.AUXILIAR, prazo=None):
+    extra = {'format': formato} if formato else {}
+    try:
+        response = modelos.chat(tarefa, [{'role': 'system', 'content': prompt}], tentativas=max_retries,
+                                prioridade=prioridade, prazo=prazo, **extra)
+        return response['message']['content']
+    except SobrecargaOllama as e:
+        # Tarefa auxiliar: com o Ollama sobrecarregado é descartada, não repetida
+        logging.warning(f"Prompt descartado: {e}")
+    except Exception as e:
+        logging.warning(f"Erro ao executar prompt no Ollama: {e}")
     return None
 
 def extrair_info_com_ia(user_text, user_info):
@@ -238,7 +503,8 @@ def extrair_info_com_ia(user_text, user_info):
             logging.warning(f"Erro ao interpretar JSON extraído: {e}\nConteúdo: {result}")
     return user_info
 
-def extrair_memoria_resumida(user_text):
+def e_mensagem_trivial(user_text):
+    # Cumprimentos e mensagens muito curtas não têm informação pessoal a memorizar
     cumprimentos = [
         'bom dia', 'boa tarde', 'boa noite', 'olá', 'ola', 'oi', 'tudo bem', 'alô', 'hello', 'hi',
         'boa madrugada', 'saudações', 'salve', 'e aí', 'eai', 'yo', 'hey', 'oiê', 'oii', 'oiii', 'al'
@@ -253,8 +519,11 @@ def extrair_memoria_resumida(user_text):
     ]
     for pattern in cumprimentos_regex:
         if re.fullmatch(pattern, texto):
-            return None
-    if texto in cumprimentos or len(texto) < 10:
+            return True
+    return texto in cumprimentos or len(texto) < 10
+
+def extrair_memoria_resumida(user_text):
+    if e_mensagem_trivial(user_text):
         return None
     prompt = PROMPT_EXTRAIR_MEMORIA.format(user_text=user_text)
     frase = executar_prompt(prompt)
@@ -262,6 +531,71 @@ def extrair_memoria_resumida(user_text):
         return frase.strip()
     return None
 
+def validar_analise(dados):
+    # Valida o JSON devolvido pela análise; devolve um dict normalizado ou None se não respeitar o esquema
+    if not isinstance(dados, dict):
+        return None
+    perfil = dados.get('perfil') or {}
+    if not isinstance(perfil, dict):
+        return None
+    memoria = dados.get('memoria')
+    if memoria is not None and not isinstance(memoria, str):
+        return None
+    memoria = memoria.strip() if memoria else None
+    if memoria in ('', 'N/A', 'null'):
+        memoria = None
+    quer_ficheiro = dados.get('quer_ficheiro')
+    quer_imagem = dados.get('quer_imagem')
+    if not isinstance(quer_ficheiro, bool) or not isinstance(quer_imagem, bool):
+        return None
+    tipo_ficheiro = dados.get('tipo_ficheiro')
+    if isinstance(tipo_ficheiro, str):
+        tipo_ficheiro = tipo_ficheiro.strip().lower().lstrip('.')
+    if tipo_ficheiro not in TIPOS_FICHEIRO:
+        tipo_ficheiro = None
+    titulo = dados.get('titulo')
+    if titulo is not None and not isinstance(titulo, str):
+        return None
+    titulo = titulo.strip().strip('"\'') if titulo else None
+    return {
+        'perfil': {k: v for k, v in perfil.items() if isinstance(k, str) and v not in (None, '', [], {})},
+        'memoria': memoria,
+        'quer_ficheiro': quer_ficheiro,
+        'tipo_ficheiro': tipo_ficheiro,
+        'quer_imagem': quer_imagem,
+        'titulo': titulo[:200] if titulo else None
+    }
+
+def analise_sem_modelo():
+    # Análise neutra para quando o modelo não respondeu: as intenções de ficheiro/imagem ficam só com
+    # as verificações locais (pedido_ficheiro_explicito, tipo_ficheiro_no_texto, is_image_request)
+    return {'perfil': {}, 'memoria': None, 'quer_ficheiro': False, 'tipo_ficheiro': None,
+            'quer_imagem': False, 'titulo': None}
+
+def analisar_mensagem(user_text, gerar_titulo=False, prioridade=OllamaScheduler.AUXILIAR, prazo=None):
+    # Uma única chamada ao modelo que cobre perfil, memória, intenção de ficheiro/imagem e título.
+    # Devolve None se a resposta não for válida; nesse caso usam-se as funções individuais.
+    # Se o modelo não responder (fila cheia, prazo, circuito aberto, erro de ligação) lança a exceção.
+    instrucao_titulo = INSTRUCAO_TITULO if gerar_titulo else "null"
+    prompt = PROMPT_ANALISAR_MENSAGEM.format(user_text=user_text, instrucao_titulo=instrucao_titulo)
+    response = modelos.chat('extraction', [{'role': 'system', 'content': prompt}], format='json',
+                            prioridade=prioridade, prazo=prazo)
+    result = response['message']['content']
+    if not result:
+        return None
+    try:
+        match = re.search(r'\{.*\}', result, re.DOTALL)
+        if not match:
+            logging.warning(f"Análise da mensagem sem JSON: {result}")
+            return None
+        analise = validar_analise(json.loads(match.group(0)))
+        if analise is None:
+            logging.warning(f"Análise da mensagem fora do esquema: {result}")
+        return analise
+    except Exception as e:
+        logging.warning(f"Erro ao interpretar análise da mensagem: {e}\nConteúdo: {result}")
+        return None
+
 def gerar_nome_conversa_primeira_mensagem(msg):
     prompt = (
         "Gere um nome curto, técnico e descritivo para uma conversa de chat com base na mensagem abaixo. "
@@ -271,30 +605,309 @@ def gerar_nome_conversa_primeira_mensagem(msg):
         f"Mensagem: \"{msg}\""
     )
     try:
-        response = ollama.chat(model='llama3.1:8b', messages=[{'role': 'system', 'content': prompt}])
+        response = modelos.chat('naming', [{'role': 'system', 'content': prompt}])
         nome = response['message']['content'].strip()
         return nome
     except Exception as e:
         logging.warning(f"Falha ao gerar nome da conversa: {e}")
         return msg[:30]  # fallback: primeiros 30 caracteres
 
+def registar_notificacao(cid, **campos):
+    estado.juntar('notificacoes', cid, campos)
+
+def consumir_notificacoes(cid):
+    # Devolve (e limpa) as notificações do chat e indica se ainda há tarefas em curso
+    notif = estado.retirar('notificacoes', cid, {})
+    return {
+        'memoria_atualizada': notif.get('memoria_atualizada', False),
+        'nome': notif.get('nome'),
+        'tarefas_pendentes': tarefas.tem_pendentes(cid)
+    }
+
+def atualizar_perfil(user_id, novos_campos):
+    if not novos_campos:
+        return
+    with user_infos_lock:
+        info = user_infos.setdefault(user_id, {})
+        info.update(novos_campos)
+    persistencia.marcar_sujo('user_infos')
+
+def guardar_memoria(user_id, frase_memoria):
+    # Devolve True se a memória for nova (nem igual nem quase igual, por similaridade, a uma existente)
+    if not frase_memoria:
+        return False
+    with user_infos_lock:
+        existentes = list(user_infos.get(user_id, {}).get('memorias_resumidas', []))
+    try:
+        if indice_memorias.duplicada(user_id, existentes, frase_memoria):
+            return False
+    except Exception as e:
+        logging.warning(f"Deduplicação por similaridade indisponível: {e}")
+    with user_infos_lock:
+        memorias = user_infos.setdefault(user_id, {}).setdefault('memorias_resumidas', [])
+        if frase_memoria in memorias:
+            return False
+        memorias.append(frase_memoria)
+        # Só as MEMORY_MAX mais recentes; o prompt recebe apenas as mais relevantes
+        user_infos[user_id]['memorias_resumidas'] = memorias[-MEMORY_MAX:]
+    persistencia.marcar_sujo('user_infos')
+    return True
+
+def mensagem_memorias(user_id, user_text):
+    # Mensagem de sistema com as memórias relevantes para a mensagem atual (None se não houver).
+    # Fica fora do prefixo estável: muda de mensagem para mensagem.
+    if not settings.get('memory', {}).get('reference_saved_memories', False):
+        return None
+    with user_infos_lock:
+        textos = list(user_infos.get(user_id, {}).get('memorias_resumidas', []))
+    relevantes = indice_memorias.relevantes(user_id, textos, user_text) if textos else []
+    if not relevantes:
+        return None
+    conteudo = "Outras informações relevantes sobre o usuário (use-as de forma implícita):\n"
+    conteudo += ''.join(f"- {frase}\n" for frase in relevantes)
+    return {'role': 'system', 'content': conteudo}
+
+def aplicar_nome_chat(cid, nome):
+    # Só substitui o nome por omissão (não sobrepõe um nome dado pelo utilizador)
+    if not nome:
+        return
+    if not chats.renomear(cid, nome, apenas_se_nome='Novo Chat'):
+        return
+    registar_notificacao(cid, nome=nome)
+
+def tarefa_perfil(cid, user_id, user_text):
+    extraido = extrair_info_com_ia(user_text, {})
+    atualizar_perfil(user_id, {k: v for k, v in extraido.items() if k != 'memorias_resumidas'})
+
+def tarefa_memoria(cid, user_id, user_text):
+    if guardar_memoria(user_id, extrair_memoria_resumida(user_text)):
+        registar_notificacao(cid, memoria_atualizada=True)
+
+def tarefa_nome(cid, user_text):
+    aplicar_nome_chat(cid, gerar_nome_conversa_primeira_mensagem(user_text))
+
+def turno_do_bloco(block):
+    # (pergunta, resposta) da variante selecionada; None para blocos pendentes ou cancelados sem texto
+    selected = block.get('selected', 0)
+    try:
+        user = block['user_variants'][selected]
+        ai = block['ai_responses'][selected]
+    except (IndexError, KeyError):
+        return None
+    if not user or not ai or ai == MENSAGEM_CANCELADA:
+        return None
+    return user, ai
+
+def tarefa_resumo(cid, ate):
+    # Junta ao resumo os blocos [resumo['ate'], ate) que saíram da janela do contexto
+    resumo = chats.resumo(cid)
+    blocos = chats.copia_blocos(cid)
+    if resumo is None or blocos is None or resumo['ate'] >= ate:
+        return
+    mensagens = []
+    for block in blocos[resumo['ate']:ate]:
+        turno = turno_do_bloco(block)
+        if turno:
+            mensagens.append(f"Utilizador: {turno[0][:2000]}\nAssistente: {turno[1][:2000]}")
+    texto = resumo['texto']
+    if mensagens:
+        novo = executar_prompt(PROMPT_RESUMO_CONVERSA.format(resumo=texto, mensagens='\n'.join(mensagens)))
+        if not novo:
+            return
+        texto = novo.strip()
+    chats.guardar_resumo(cid, texto, ate)
+
+def construir_historico(cid, blocos_anteriores, orcamento):
+    # Mantém literalmente os turnos mais recentes que cabem no orçamento (em tokens estimados);
+    # os mais antigos entram através do resumo guardado no chat. Quando há blocos fora da janela
+    # que o resumo ainda não cobre, o resumo é atualizado em segundo plano (fica pronto para a
+    # próxima mensagem) e cobre logo SUMMARY_BATCH blocos a mais. Os blocos que o resumo já cobre
+    # nunca entram literalmente (estariam duas vezes no prompt).
+    resumo = chats.resumo(cid) or {'texto': '', 'ate': 0}
+    if resumo['texto']:
+        orcamento -= estimar_tokens(resumo['texto'])
+    recentes = []
+    inicio = len(blocos_anteriores)
+    for idx in range(len(blocos_anteriores) - 1, min(resumo['ate'], len(blocos_anteriores)) - 1, -1):
+        turno = turno_do_bloco(blocos_anteriores[idx])
+        if turno:
+            custo = estimar_tokens(turno[0]) + estimar_tokens(turno[1])
+            if custo > orcamento:
+                break
+            orcamento -= custo
+            recentes.append(turno)
+        inicio = idx
+    recentes.reverse()
+    if inicio > resumo['ate']:
+        tarefas.submit(('resumo', cid), tarefa_resumo, cid, min(len(blocos_anteriores), inicio + SUMMARY_BATCH))
+    mensagens = []
+    if resumo['texto'] and resumo['ate'] > 0:
+        mensagens.append({'role': 'system', 'content': f"Resumo da parte anterior desta conversa:\n{resumo['texto']}"})
+    for user, ai in recentes:
+        mensagens.append({'role': 'user', 'content': user})
+        mensagens.append({'role': 'assistant', 'content': ai})
+    return mensagens
+
+def processar_analise_mensagem(cid, block_idx, user_id, user_text, primeira, prazo=None):
+    # Corre na fila de análises, em paralelo com a geração da resposta. A resposta espera pelas
+    # intenções de ficheiro/imagem, por isso a chamada ao modelo tem a prioridade das respostas e não
+    # fica atrás das tarefas auxiliares. Devolve a análise logo que a tem; perfil, memória e título
+    # são aplicados depois, na fila de tarefas (a deduplicação das memórias também chama o modelo).
+    try:
+        analise = analisar_mensagem(user_text, gerar_titulo=primeira, prioridade=OllamaScheduler.INTERATIVA, prazo=prazo)
+    except Exception as e:
+        # O modelo não respondeu: as extrações individuais só juntariam mais chamadas a um modelo já
+        # sobrecarregado ou em baixo. Fica sem perfil, memória e título para esta mensagem
+        logging.warning(f"Análise da mensagem descartada para o chat {cid}: {e}")
+        return analise_sem_modelo()
+    if analise is None:
+        # Resposta fora do esquema: extrações individuais, cada uma como tarefa própria
+        tarefas.submit(('perfil', cid, block_idx), tarefa_perfil, cid, user_id, user_text)
+        tarefas.submit(('memoria', cid, block_idx), tarefa_memoria, cid, user_id, user_text)
+        if primeira:
+            tarefas.submit(('nome', cid), tarefa_nome, cid, user_text)
+        return None
+    tarefas.submit(('aplicar_analise', cid, block_idx), aplicar_analise, cid, user_id, user_text, primeira, analise)
+    return analise
+
+def aplicar_analise(cid, user_id, user_text, primeira, analise):
+    atualizar_perfil(user_id, analise['perfil'])
+    if not e_mensagem_trivial(user_text) and guardar_memoria(user_id, analise['memoria']):
+        registar_notificacao(cid, memoria_atualizada=True)
+    if primeira:
+        if analise['titulo']:
+            aplicar_nome_chat(cid, analise['titulo'])
+        else:
+            tarefas.submit(('nome', cid), tarefa_nome, cid, user_text)
+
+def esperar_analise(futuro, cid, block_idx, user_id, user_text, primeira, prazo=None, espera=ESPERA_ANALISE):
+    if futuro is None:
+        # Fila cheia: fazer a análise no próprio pedido
+        return processar_analise_mensagem(cid, block_idx, user_id, user_text, primeira, prazo)
+    espera = espera if prazo is None else max(0, min(espera, prazo - time.time()))
+    try:
+        return futuro.result(timeout=espera)
+    except Exception as e:
+        # Sem chamadas de classificação extra: a resposta decide só com as verificações locais
+        logging.warning(f"Análise da mensagem indisponível para o chat {cid}: {e}")
+        return analise_sem_modelo()
+
+@app.route('/chat/<cid>/updates', methods=['GET'])
+def chat_updates(cid):
+    return jsonify(consumir_notificacoes(cid))
+
+@app.route('/api/tasks/stats', methods=['GET'])
+def tasks_stats():
+    return jsonify(tarefas.metrics())
+
+@app.route('/api/ollama/stats', methods=['GET'])
+def ollama_stats():
+    return jsonify(ollama_pool.metrics())
+
+def resposta_503(mensagem, retry_after):
+    resposta = jsonify({'error': mensagem, 'retry_after': retry_after})
+    resposta.headers['Retry-After'] = str(retry_after)
+    return resposta, 503
+
+@app.errorhandler(SobrecargaOllama)
+def ollama_sobrecarregado(e):
+    return resposta_503('O servidor está ocupado. Tente novamente dentro de momentos.', e.retry_after)
+
+@app.errorhandler(OllamaIndisponivel)
+def ollama_indisponivel(e):
+    return resposta_503('O modelo está indisponível de momento. Tente novamente dentro de momentos.', e.retry_after)
+
+@app.route('/api/memory/stats', methods=['GET'])
+def memory_stats():
+    return jsonify(indice_memorias.metrics())
+
+@app.route('/api/artifacts/stats', methods=['GET'])
+def artifacts_stats():
+    return jsonify(artefactos.metrics())
+
 @app.route('/chat/<cid>/cancel', methods=['POST'])
 def cancel_chat_response(cid):
-    cancel_flags[cid] = True
+    pedir_cancelamento(cid)
+    imagens.cancelar_chat(cid)
     return jsonify({'ok': True})
 
-# Carregar o pipeline uma vez (global, para performance)
-sd_pipe = None
-def get_sd_pipe():
-    global sd_pipe
-    if sd_pipe is None:
-        print("[DEBUG] Carregando modelo SDXL para CPU...")
-        sd_pipe = StableDiffusionXLPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            torch_dtype=torch.float32
-        )
-        sd_pipe = sd_pipe.to("cpu")
-    return sd_pipe
+def ao_terminar_imagem(job):
+    # Atualiza o bloco do chat que pediu a imagem e devolve o texto final
+    if job['estado'] == 'concluido':
+        ai_text = f"Imagem gerada com sucesso! [Download da imagem gerada]({job['url']})"
+    elif job['estado'] == 'cancelado':
+        ai_text = MENSAGEM_CANCELADA
+    else:
+        logging.error(f"Erro ao gerar imagem (job {job['id']}): {job['erro']}")
+        ai_text = "Lamento, não foi possível gerar a imagem."
+    if job['block_idx'] is not None:
+        atualizar_resposta_bloco(job['chat_id'], job['block_idx'], ai_text)
+    return ai_text
+
+imagens = ImageJobService(artefactos, estado, ao_terminar=ao_terminar_imagem)
+atexit.register(imagens.encerrar)
+
+def ler_dimensao(valor, omissao):
+    # Largura/altura pedidas à API: múltiplos de 8 entre 256 e 2048
+    try:
+        valor = int(valor) if valor is not None else omissao
+    except (TypeError, ValueError):
+        return None
+    return valor if 256 <= valor <= 2048 and valor % 8 == 0 else None
+
+@app.route('/api/images', methods=['POST'])
+def submit_image_job():
+    data = request.json or {}
+    prompt = bleach.clean(data.get('prompt', '')).strip()
+    chat_id = data.get('chat_id')
+    if not prompt or not chat_id:
+        return jsonify({'error': 'prompt e chat_id são obrigatórios'}), 400
+    largura = ler_dimensao(data.get('width'), IMAGE_SIZE)
+    altura = ler_dimensao(data.get('height'), IMAGE_SIZE)
+    if largura is None or altura is None:
+        return jsonify({'error': 'width e height devem ser múltiplos de 8 entre 256 e 2048'}), 400
+    try:
+        seed = int(data.get('seed', IMAGE_SEED))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'seed inválida'}), 400
+    job = imagens.submeter(prompt, chat_id, seed=seed, largura=largura, altura=altura)
+    # Um hit na cache devolve o job já concluído
+    return jsonify(job), 200 if job['estado'] == 'concluido' else 202
+
+@app.route('/api/images/<job_id>', methods=['GET'])
+def image_job_status(job_id):
+    job = imagens.estado(job_id)
+    if not job:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job)
+
+@app.route('/api/images/<job_id>/events', methods=['GET'])
+def image_job_events(job_id):
+    # Server-Sent Events com o estado do job sempre que muda (progresso, conclusão)
+    if not imagens.estado(job_id):
+        return jsonify({'error': 'Job não encontrado'}), 404
+    def eventos():
+        versao = -1
+        while True:
+            job = imagens.esperar(job_id, versao, timeout=15)
+            if job is None:
+                return
+            if job['versao'] == versao:
+                yield ': keep-alive\n\n'
+                continue
+            versao = job['versao']
+            yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+            # O texto final (ai_text) chega numa versão própria, depois do estado terminal
+            if job['estado'] in ImageJobService.TERMINAIS and job['ai_text'] is not None:
+                return
+    return Response(eventos(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/images/<job_id>/cancel', methods=['POST'])
+def cancel_image_job(job_id):
+    if imagens.cancelar(job_id):
+        return jsonify({'ok': True})
+    return jsonify({'error': 'Job não encontrado ou já terminado'}), 404
 
 def is_image_request(user_text):
     # Detecta pedidos de imagem de forma simples
@@ -304,173 +917,192 @@ def is_image_request(user_text):
     user_text_lower = user_text.lower()
     return any(kw in user_text_lower for kw in keywords)
 
-def generate_image_from_text(prompt, output_path):
-    pipe = get_sd_pipe()
-    print(f"[DEBUG] Gerando imagem para prompt: {prompt}")
-    image = pipe(prompt).images[0]
-    image.save(output_path)
-    print(f"[DEBUG] Imagem salva em: {output_path}")
+MENSAGEM_CANCELADA = '⏹️ Resposta cancelada pelo usuário.'
 
-@app.route('/chat/<cid>/send', methods=['POST'])
-def send_message(cid):
-    user_text = request.json.get('message')
+def gerar_resposta_ia(cid, ollama_messages, prazo=None):
+    # Gera a resposta do Ollama em streaming, token a token.
+    # O cancelamento (e o prazo do pedido) é verificado entre chunks: ao fechar o stream a ligação HTTP
+    # é terminada e o Ollama deixa de gerar, libertando o modelo.
+    stream = None
+    produziu = False
+    inicio = time.perf_counter()
+    try:
+        # Já admitido em send_message: aqui espera pela vez em vez de ser rejeitado
+        modelo, opcoes = modelos.parametros('chat')
+        stream = ollama_pool.chat_stream(modelo, ollama_messages, rejeitar=False, prazo=prazo, **opcoes)
+        for chunk in stream:
+            if cancelamento_pedido(cid):
+                logging.info(f"Geração cancelada para o chat {cid}")
+                break
+            if prazo is not None and time.time() > prazo:
+                logging.warning(f"Prazo do pedido excedido durante a geração para o chat {cid}")
+                break
+            token = chunk['message']['content']
+            if token:
+                produziu = True
+                yield token
+    except Exception as e:
+        logging.error(f"Erro ao conectar ao Ollama: {e}")
+        if not produziu:
+            yield "Lamento, não consigo processar isso agora."
+    finally:
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+        metricas.registar_etapa('geracao', time.perf_counter() - inicio)
+
+def atualizar_resposta_bloco(cid, block_idx, ai_text):
+    with metricas.etapa('guardar_resposta'):
+        chats.definir_resposta(cid, block_idx, ai_text)
+
+def registar_cancelamento(cid, block_idx, ai_text):
+    # Guarda o texto parcial já gerado (ou a mensagem de cancelamento se não houver nada)
+    limpar_cancelamento(cid)
+    ai_text = ai_text if ai_text.strip() else MENSAGEM_CANCELADA
+    atualizar_resposta_bloco(cid, block_idx, ai_text)
+    return dict(consumir_notificacoes(cid), ai_text=ai_text, block_idx=block_idx, cancelado=True)
+
+def decidir_ficheiro(user_text, analise, prazo=None):
+    # Devolve (quer_ficheiro, tipo) usando a análise única quando disponível. Só quando a análise veio
+    # fora do esquema (None) se pergunta ao modelo; se ele não respondeu a análise é a neutra
+    # (analise_sem_modelo) e contam só as verificações locais
+    if analise is None:
+        if not user_wants_file(user_text, prazo):
+            return False, None
+        return True, get_file_type(user_text, prazo)
+    if not (pedido_ficheiro_explicito(user_text) or analise['quer_ficheiro']):
+        return False, None
+    return True, tipo_ficheiro_no_texto(user_text) or analise['tipo_ficheiro']
+
+def finalizar_resposta(cid, block_idx, user_text, ai_text, analise=None, prazo=None):
+    # --- NOVO FLUXO: verificação de geração de ficheiro ---
+    # Verifica se o usuário pediu um ficheiro e gera o ficheiro se necessário
+    with metricas.etapa('decidir_ficheiro'):
+        quer_ficheiro, file_type = decidir_ficheiro(user_text, analise, prazo)
+    if quer_ficheiro:
+        if not file_type or file_type not in TIPOS_FICHEIRO:
+            ai_text = "Por favor, indique o tipo de ficheiro (ex: pdf, docx, txt, etc.)"
+            atualizar_resposta_bloco(cid, block_idx, ai_text)
+            return dict(consumir_notificacoes(cid), ai_text=ai_text, block_idx=block_idx)
+        with metricas.etapa('gerar_ficheiro'):
+            generated_filename = ai_generate_file_if_requested(user_text, ai_text, cid, file_type)
+        if generated_filename:
+            download_url = f"/files/{sanitize_filename(cid)}/{generated_filename}"
+            ai_text += f"\n\n[Download do arquivo gerado]({download_url})"
+            # Atualizar o bloco com a resposta do AI
+            atualizar_resposta_bloco(cid, block_idx, ai_text)
+            return dict(consumir_notificacoes(cid), ai_text=ai_text, block_idx=block_idx)
+
+    # --- SUPORTE À GERAÇÃO DE IMAGEM ---
+    if is_image_request(user_text) or (analise and analise['quer_imagem']):
+        # A imagem é gerada pelo serviço de jobs; o bloco é atualizado quando o job terminar
+        ai_text = "🖼️ A gerar imagem..."
+        atualizar_resposta_bloco(cid, block_idx, ai_text)
+        with metricas.etapa('submeter_imagem'):
+            job = imagens.submeter(user_text, cid, block_idx=block_idx)
+        if job['ai_text'] is not None:
+            # Hit na cache: a resposta final já está pronta
+            return dict(consumir_notificacoes(cid), ai_text=job['ai_text'], block_idx=block_idx)
+        return dict(consumir_notificacoes(cid), ai_text=ai_text, block_idx=block_idx, image_job=job['id'])
+
+    # Atualizar o bloco com a resposta do AI (o nome do chat é gerado em segundo plano)
+    atualizar_resposta_bloco(cid, block_idx, ai_text)
+    return dict(consumir_notificacoes(cid), ai_text=ai_text, block_idx=block_idx)
+
+def preparar_envio(cid, user_text):
+    # Passos do /send antes da geração, comuns ao Flask e ao modo ASGI (asgi.py): valida a mensagem,
+    # cria o bloco e monta as mensagens para o Ollama. Devolve (contexto, None) ou (None, (erro, status)).
+    # Com a fila do modelo cheia (ou o Ollama em baixo) lança SobrecargaOllama/OllamaIndisponivel (503).
     if not user_text:
-        return jsonify({'error': 'Mensagem vazia'}), 400
-    user_text = bleach.clean(user_text)
+        return None, ('Mensagem vazia', 400)
+    with metricas.etapa('sanitizar'):
+        user_text = bleach.clean(user_text)
     if len(user_text) > 20000:
-        return jsonify({'error': 'Mensagem demasiado longa (máx 10000 caracteres)'}), 400
+        return None, ('Mensagem demasiado longa (máx 10000 caracteres)', 400)
     if cid not in chats:
-        return jsonify({'error': 'Chat não encontrado'}), 404
+        return None, ('Chat não encontrado', 404)
+    # Responde já 503 se for o caso, antes de criar o bloco
+    ollama_pool.verificar_carga(modelos.modelo('chat'))
+    # Prazo total do pedido: fila, geração, análise e decisões de ficheiro
+    prazo = time.time() + SEND_DEADLINE
+
+    # Um cancelamento antigo (ex: pedido já terminado) não deve afetar esta mensagem
+    limpar_cancelamento(cid)
 
     # Salvar imediatamente o bloco do usuário com resposta AI como None
-    with chats_lock:
-        chats[cid].data.setdefault('conversation_blocks', []).append({
-            'user_variants': [user_text],
-            'ai_responses': [None],
-            'selected': 0
-        })
-        save_data(CHATS_FILE, chats.chats_dict)
+    with metricas.etapa('guardar_bloco'):
+        adicionado = chats.adicionar_bloco(cid, user_text)
+    if adicionado is None:
+        return None, ('Chat não encontrado', 404)
+    # Cópia do histórico anterior, para montar o contexto sem segurar o lock
+    block_idx, blocos_anteriores = adicionado
 
     # 1. Construir o contexto do sistema
-    system_messages = []
-    system_message = """
-Identidade e Função:
-És o Llama 3, um modelo de linguagem do Ollama. Foste criado para ajudar os utilizadores com informações úteis, gerar texto, responder a perguntas, resolver problemas e muito mais.
-
-Estilo de Comunicação:
-Sê direto, claro e profissional.
-Não faças elogios exagerados ou bajulação.
-Mantém um tom humano e caloroso, mas evita soar robótico ou artificialmente entusiasmado.
-Prioriza a honestidade: se não souberes algo, diz-o abertamente.
-Evita adivinhar o que o utilizador quer sem confirmação. Pergunta se necessário.
-
-Linguagem e Preferências do Utilizador:
-Lê e adapta-te às preferências do utilizador com base no contexto da conversa (por exemplo, se preferir respostas curtas, em português europeu, técnicas, etc.).
-
-Privacidade e Segurança:
-Nunca peças, guardes ou reveles dados sensíveis.
-"""
-    system_messages.append({'role': 'system', 'content': system_message})
     user_id = "default_user"
-    current_user_info = user_infos.get(user_id, {})
-    updated_info = extrair_info_com_ia(user_text, dict(current_user_info))
-    if updated_info != current_user_info:
-        with user_infos_lock:
-            user_infos[user_id] = updated_info
-    memoria_foi_atualizada = False
-    frase_memoria = extrair_memoria_resumida(user_text)
-    if frase_memoria:
-        with user_infos_lock:
-            user_infos.setdefault(user_id, {}).setdefault('memorias_resumidas', [])
-            if frase_memoria not in user_infos[user_id]['memorias_resumidas']:
-                user_infos[user_id]['memorias_resumidas'].append(frase_memoria)
-                # Limitar para as 20 mais recentes
-                user_infos[user_id]['memorias_resumidas'] = user_infos[user_id]['memorias_resumidas'][-20:]
-                memoria_foi_atualizada = True
-    # Adicionar info do usuário se a configuração permitir
-    if settings.get('memory', {}).get('reference_saved_memories', False) and updated_info:
-        system_context = "As informações a seguir são sobre o usuário. Use-as para personalizar suas respostas de forma implícita, sem mencioná-las diretamente.\n"
-        for key, value in updated_info.items():
-            if value:
-                system_context += f"- {key.replace('_', ' ').capitalize()}: {value}\n"
-        # Adicionar frases resumidas
-        memorias_resumidas = user_infos.get(user_id, {}).get('memorias_resumidas', [])
-        if memorias_resumidas:
-            system_context += "- Outras informações relevantes:\n"
-            for frase in memorias_resumidas:
-                system_context += f"  - {frase}\n"
-        system_messages.append({'role': 'system', 'content': system_context})
+    # Prefixo estável (identidade + perfil), reutilizado até o perfil mudar
+    system_messages = prefixo_sistema(user_id)
+    # A análise da mensagem (perfil, memória, título, intenções) corre numa fila própria, em paralelo
+    # com a geração; a resposta só espera por ela no fim, para saber se deve gerar ficheiro/imagem
+    primeira = block_idx == 0
+    futuro_analise = analises.submit(('analise', cid, block_idx), processar_analise_mensagem,
+                                     cid, block_idx, user_id, user_text, primeira, prazo)
+
+    # Memórias e excertos dos ficheiros relevantes para esta mensagem: vão depois do histórico,
+    # para não quebrar a reutilização da KV cache do prefixo e do histórico
+    with metricas.etapa('contexto'):
+        memorias_msg = [m for m in [mensagem_memorias(user_id, user_text), documentos.contexto(cid, user_text)] if m]
 
     # 2. Construir o histórico da conversa
     history_messages = []
     if settings.get('memory', {}).get('reference_chat_history', False):
-        for block in chats[cid].get_conversation_blocks():
-            history_messages.append({'role': 'user', 'content': block['user_variants'][block['selected']]})
-            history_messages.append({'role': 'assistant', 'content': block['ai_responses'][block['selected']]})
+        # Orçamento que sobra depois das mensagens de sistema e da mensagem atual
+        usados = sum(estimar_tokens(m['content']) for m in system_messages + memorias_msg) + estimar_tokens(user_text)
+        with metricas.etapa('historico'):
+            history_messages = construir_historico(cid, blocos_anteriores, CONTEXT_TOKENS - usados)
 
     # 3. Montar a mensagem final para o Ollama
-    ollama_messages = system_messages + history_messages + [{'role': 'user', 'content': user_text}]
-
-    # --- NOVO FLUXO: verificação de geração de ficheiro ---
-    generated_filename = None
-    file_type = None
-    
-    # Primeiro, gera a resposta da IA normalmente
-    try:
-        response = ollama.chat(model='llama3.1:8b', messages=ollama_messages)
-        ai_text = response['message']['content']
-    except Exception as e:
-        logging.error(f"Erro ao conectar ao Ollama: {e}")
-        ai_text = "Lamento, não consigo processar isso agora."
-
-    # Depois, verifica se o usuário pediu um ficheiro e gera o ficheiro se necessário
-    if user_wants_file(user_text):
-        file_type = get_file_type(user_text)
-        if not file_type or file_type not in ['pdf', 'txt', 'csv', 'json', 'py', 'docx', 'xlsx', 'pptx']:
-            ai_text = "Por favor, indique o tipo de ficheiro (ex: pdf, docx, txt, etc.)"
-            with chats_lock:
-                chats[cid].data['conversation_blocks'][-1]['ai_responses'][0] = ai_text
-                save_data(CHATS_FILE, chats.chats_dict)
-            return jsonify({
-                'ai_text': ai_text,
-                'block_idx': len(chats[cid].get_conversation_blocks()) - 1,
-                'memoria_atualizada': False
-            })
-        generated_filename = ai_generate_file_if_requested(user_text, ai_text, cid, file_type)
-        if generated_filename:
-            download_url = f"/files/{sanitize_filename(cid)}/{generated_filename}"
-            ai_text += f"\n\n[Download do arquivo gerado]({download_url})"
-            # Atualizar o bloco com a resposta do AI
-            with chats_lock:
-                chats[cid].data['conversation_blocks'][-1]['ai_responses'][0] = ai_text
-                save_data(CHATS_FILE, chats.chats_dict)
-            return jsonify({
-                'ai_text': ai_text,
-                'block_idx': len(chats[cid].get_conversation_blocks()) - 1,
-                'memoria_atualizada': True
-            })
+    ollama_messages = system_messages + history_messages + memorias_msg + [{'role': 'user', 'content': user_text}]
+    return {'cid': cid, 'block_idx': block_idx, 'user_id': user_id, 'user_text': user_text, 'primeira': primeira,
+            'prazo': prazo, 'futuro_analise': futuro_analise, 'mensagens': ollama_messages}, None
+
+def concluir_envio(ctx, ai_text, espera_analise=ESPERA_ANALISE):
+    # Depois da geração: guarda o texto parcial se foi cancelado; senão espera pela análise e trata
+    # dos pedidos de ficheiro/imagem. Devolve o payload final da resposta
+    cid, block_idx = ctx['cid'], ctx['block_idx']
+    # --- CANCELAMENTO: guardar apenas o texto parcial gerado até ao cancelamento ---
+    if cancelamento_pedido(cid):
+        return registar_cancelamento(cid, block_idx, ai_text)
+    with metricas.etapa('analise'):
+        analise = esperar_analise(ctx['futuro_analise'], cid, block_idx, ctx['user_id'], ctx['user_text'],
+                                  ctx['primeira'], ctx['prazo'], espera=espera_analise)
+    return finalizar_resposta(cid, block_idx, ctx['user_text'], ai_text, analise, ctx['prazo'])
 
-    # --- SUPORTE À GERAÇÃO DE IMAGEM ---
-    if is_image_request(user_text):
-        chat_folder = os.path.join(UPLOAD_FOLDER, sanitize_filename(cid))
-        os.makedirs(chat_folder, exist_ok=True)
-        filename = f"imagem_{int(time.time())}.png"
-        file_path = os.path.join(chat_folder, filename)
-        generate_image_from_text(user_text, file_path)
-        download_url = f"/files/{sanitize_filename(cid)}/{filename}"
-        ai_text = f"Imagem gerada com sucesso! [Download da imagem gerada]({download_url})"
-        with chats_lock:
-            chats[cid].data['conversation_blocks'][-1]['ai_responses'][0] = ai_text
-            save_data(CHATS_FILE, chats.chats_dict)
-        return jsonify({
-            'ai_text': ai_text,
-            'block_idx': len(chats[cid].get_conversation_blocks()) - 1,
-            'memoria_atualizada': False
-        })
-
-    # --- CANCELAMENTO: se o chat foi cancelado, não salvar resposta ---
-    if cancel_flags.get(cid):
-        cancel_flags.pop(cid, None)
-        # Atualiza o bloco com resposta de cancelamento
-        with chats_lock:
-            chats[cid].data['conversation_blocks'][-1]['ai_responses'][0] = '⏹️ Resposta cancelada pelo usuário.'
-            save_data(CHATS_FILE, chats.chats_dict)
-        return jsonify({'ai_text': '⏹️ Resposta cancelada pelo usuário.', 'memoria_atualizada': memoria_foi_atualizada})
-
-    # Atualizar o bloco com a resposta do AI
-    with chats_lock:
-        chats[cid].data['conversation_blocks'][-1]['ai_responses'][0] = ai_text
-        # NOVO: se for a primeira mensagem, gerar nome automático
-        if len(chats[cid].get_conversation_blocks()) == 1:
-            nome_sugerido = gerar_nome_conversa_primeira_mensagem(user_text)
-            if nome_sugerido:
-                chats[cid].name = nome_sugerido
-        save_data(CHATS_FILE, chats.chats_dict)
-    return jsonify({
-        'ai_text': ai_text, 
-        'block_idx': len(chats[cid].get_conversation_blocks()) - 1,
-        'memoria_atualizada': memoria_foi_atualizada
-    })
+@app.route('/chat/<cid>/send', methods=['POST'])
+def send_message(cid):
+    # Modo streaming: devolve NDJSON com um objeto {"token": ...} por chunk e um objeto final {"done": true, ...}
+    stream = bool(request.json.get('stream'))
+    ctx, erro = preparar_envio(cid, request.json.get('message'))
+    if erro:
+        return jsonify({'error': erro[0]}), erro[1]
+
+    if stream:
+        def stream_resposta():
+            partes = []
+            payload = None
+            try:
+                for token in gerar_resposta_ia(cid, ctx['mensagens'], ctx['prazo']):
+                    partes.append(token)
+                    yield json.dumps({'token': token}, ensure_ascii=False) + '\n'
+                payload = concluir_envio(ctx, ''.join(partes))
+                yield json.dumps(dict(payload, done=True), ensure_ascii=False) + '\n'
+            finally:
+                if payload is None:
+                    # O cliente desligou-se a meio: guardar o texto parcial
+                    registar_cancelamento(cid, ctx['block_idx'], ''.join(partes))
+        return Response(stream_resposta(), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    ai_text = ''.join(gerar_resposta_ia(cid, ctx['mensagens'], ctx['prazo']))
+    return jsonify(concluir_envio(ctx, ai_text))
 
 @app.route('/user_info', methods=['GET'])
 def get_user_info_endpoint():
@@ -490,156 +1122,192 @@ def update_user_info_endpoint():
             sanitized_info[k] = v
     with user_infos_lock:
         user_infos[user_id] = sanitized_info
+    persistencia.marcar_sujo('user_infos')
     return jsonify({'ok': True})
 
 @app.route('/api/settings', methods=['GET'])
 def get_settings_endpoint():
-    global settings
-    settings = load_data(SETTINGS_FILE, get_default_settings())
-    return jsonify(settings)
+    # Devolve a cópia em memória: o ficheiro pode ainda não ter a última alteração
+    with settings_lock:
+        resposta = dict(settings)
+    # Os modelos efetivos de cada tarefa (omissões + o que estiver em settings.json)
+    resposta['models'] = modelos.efetivos()
+    return jsonify(resposta)
 
 @app.route('/api/settings', methods=['POST'])
 def update_settings_endpoint():
-    global settings
+    novas = request.json or {}
+    if not isinstance(novas, dict):
+        return jsonify({'error': 'As definições devem ser um objeto JSON'}), 400
+    if 'models' in novas:
+        erro = validar_modelos(novas['models'])
+        if erro:
+            return jsonify({'error': erro}), 400
     with settings_lock:
-        settings = request.json
+        # Alterado no lugar: o SharedJsonDocument guarda uma referência a este dict.
+        # A secção "models" fica como estava se não vier no pedido (a interface não a envia).
+        novas = dict(novas)
+        if 'models' not in novas and 'models' in settings:
+            novas['models'] = settings['models']
+        settings.clear()
+        settings.update(novas)
+    persistencia.marcar_sujo('settings')
     return jsonify({"status": "success"})
 
 @app.route('/user_memory/delete', methods=['POST'])
 def delete_user_memory():
     user_id = "default_user"
     idx = request.json.get('idx')
-    if user_id in user_infos and 'memorias_resumidas' in user_infos[user_id]:
-        try:
-            idx = int(idx)
-            if 0 <= idx < len(user_infos[user_id]['memorias_resumidas']):
-                user_infos[user_id]['memorias_resumidas'].pop(idx)
-                save_data(USER_INFO_FILE, user_infos)
-                return jsonify({'ok': True})
-        except Exception as e:
-            logging.warning(f"Erro ao apagar memória do usuário: {e}")
+    removida = False
+    with user_infos_lock:
+        if user_id in user_infos and 'memorias_resumidas' in user_infos[user_id]:
+            try:
+                idx = int(idx)
+                if 0 <= idx < len(user_infos[user_id]['memorias_resumidas']):
+                    user_infos[user_id]['memorias_resumidas'].pop(idx)
+                    removida = True
+            except Exception as e:
+                logging.warning(f"Erro ao apagar memória do usuário: {e}")
+    if removida:
+        persistencia.marcar_sujo('user_infos')
+        # O embedding da memória apagada sai do índice na próxima gravação
+        persistencia.marcar_sujo('memorias')
+        return jsonify({'ok': True})
     return jsonify({'error': 'Índice inválido'}), 400
 
 @app.route('/user_memory/delete_all', methods=['POST'])
 def delete_all_user_memories():
     user_id = "default_user"
-    if user_id in user_infos and 'memorias_resumidas' in user_infos[user_id]:
-        user_infos[user_id]['memorias_resumidas'] = []
-        save_data(USER_INFO_FILE, user_infos)
+    with user_infos_lock:
+        existe = user_id in user_infos and 'memorias_resumidas' in user_infos[user_id]
+        if existe:
+            user_infos[user_id]['memorias_resumidas'] = []
+    if existe:
+        persistencia.marcar_sujo('user_infos')
+        persistencia.marcar_sujo('memorias')
         return jsonify({'ok': True})
     return jsonify({'error': 'Nada para apagar'}), 400
 
-def periodic_save():
-    with chats_lock:
-        save_data(CHATS_FILE, chats.chats_dict)
+def salvar_indice_memorias():
     with user_infos_lock:
-        save_data(USER_INFO_FILE, user_infos)
-    with settings_lock:
-        save_data(SETTINGS_FILE, settings)
-    # Reagendar
-    global save_timer
-    save_timer = threading.Timer(SAVE_INTERVAL, periodic_save)
-    save_timer.daemon = True
-    save_timer.start()
-
-def save_all():
-    with chats_lock:
-        save_data(CHATS_FILE, chats.chats_dict)
-    with user_infos_lock:
-        save_data(USER_INFO_FILE, user_infos)
-    with settings_lock:
-        save_data(SETTINGS_FILE, settings)
-
-save_timer = threading.Timer(SAVE_INTERVAL, periodic_save)
-save_timer.daemon = True
-save_timer.start()
-atexit.register(save_all)
-
-def load_feedback():
-    if not os.path.exists(FEEDBACK_FILE):
-        return {}
-    try:
-        with open(FEEDBACK_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def save_feedback(data):
-    with open(FEEDBACK_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        textos = [t for info in user_infos.values() for t in info.get('memorias_resumidas', [])]
+    indice_memorias.guardar(textos)
+
+# Só se grava o que mudou; o checkpoint do WAL dos chats segue a mesma regra, com um atraso maior.
+# Com vários workers o perfil e a configuração são gravados logo, para os outros os verem.
+ATRASO_DOCUMENTOS = 0 if estado.partilhado else SAVE_INTERVAL
+persistencia.registar('user_infos', documento_user_infos.gravar, max_atraso=ATRASO_DOCUMENTOS)
+persistencia.registar('settings', documento_settings.gravar, max_atraso=ATRASO_DOCUMENTOS)
+persistencia.registar('memorias', salvar_indice_memorias)
+persistencia.registar('chats', chat_store.compactar, max_atraso=COMPACT_INTERVAL)
+chat_store.ao_escrever = lambda: persistencia.marcar_sujo('chats')
+atexit.register(persistencia.encerrar)
+
+feedbacks = FeedbackStore(estado)
+feedbacks.migrar_json(FEEDBACK_FILE)
 
 @app.route('/feedback', methods=['POST'])
 def add_feedback():
     data = request.json
-    user_id = data.get('user_id', 'default_user')
-    tema = data.get('tema', 'geral')
-    feedback = data.get('feedback')  # 'positivo' ou 'negativo'
-    comentario = data.get('comentario', '')
-    mensagem_usuario = data.get('mensagem_usuario', '')
-    resposta_ai = data.get('resposta_ai', '')
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-
-    all_feedback = load_feedback()
-    tema_feedbacks = all_feedback.setdefault(user_id, {}).setdefault(tema, [])
-
-    # Verifica se já existe feedback para esta mensagem/resposta
-    found = False
-    for item in tema_feedbacks:
-        if (item["mensagem_usuario"] == mensagem_usuario and
-            item["resposta_ai"] == resposta_ai):
-            # Atualiza o feedback existente
-            item["feedback"] = feedback
-            item["comentario"] = comentario
-            item["timestamp"] = timestamp
-            found = True
-            break
-
-    if not found:
-        tema_feedbacks.append({
-            "mensagem_usuario": mensagem_usuario,
-            "resposta_ai": resposta_ai,
-            "feedback": feedback,
-            "comentario": comentario,
-            "timestamp": timestamp
-        })
-
-    save_feedback(all_feedback)
+    feedbacks.upsert(
+        user_id=data.get('user_id', 'default_user'),
+        tema=data.get('tema', 'geral'),
+        feedback=data.get('feedback'),  # 'positivo' ou 'negativo'
+        comentario=data.get('comentario', ''),
+        mensagem_usuario=data.get('mensagem_usuario', ''),
+        resposta_ai=data.get('resposta_ai', '')
+    )
     return jsonify({"ok": True})
 
 @app.route('/feedback/stats', methods=['GET'])
 def feedback_stats():
-    all_feedback = load_feedback()
-    stats = {}
-    for user, temas in all_feedback.items():
-        for tema, items in temas.items():
-            stats.setdefault(tema, {"positivo": 0, "negativo": 0})
-            for item in items:
-                if item["feedback"] == "positivo":
-                    stats[tema]["positivo"] += 1
-                elif item["feedback"] == "negativo":
-                    stats[tema]["negativo"] += 1
-    return jsonify(stats)
+    return jsonify(feedbacks.stats())
+
+pesquisa_web = WebSearchService(SEARCH_PROVIDERS[SEARCH_PROVIDER]())
 
 def buscar_na_web(query, max_results=3):
-    with DDGS() as ddgs:
-        results = ddgs.text(query)
-        return [r['body'] for r in results][:max_results]
+    return pesquisa_web.procurar(query, max_results)
 
 @app.route('/api/websearch', methods=['POST'])
 def websearch():
     data = request.json
+    # {"query": "..."} ou {"queries": ["...", "..."]} (pesquisadas em paralelo, até SEARCH_MAX_QUERIES)
+    queries = data.get('queries')
+    if isinstance(queries, list):
+        queries = [q for q in queries if isinstance(q, str) and len(q) >= 3][:SEARCH_MAX_QUERIES]
+        if not queries:
+            return jsonify({'error': 'Query muito curta'}), 400
+        return jsonify({'results': pesquisa_web.procurar_varias(queries)})
     query = data.get('query', '')
     if not query or len(query) < 3:
         return jsonify({'error': 'Query muito curta'}), 400
     results = buscar_na_web(query)
     return jsonify({'results': results})
 
+@app.route('/api/websearch/stats', methods=['GET'])
+def websearch_stats():
+    return jsonify(pesquisa_web.metrics())
+
+@app.before_request
+def iniciar_medicao():
+    g.inicio_pedido = time.perf_counter()
+    metricas.iniciar_pedido(SERVER_TIMING)
+
+@app.after_request
+def registar_pedido(resposta):
+    # A rota (não o caminho) como etiqueta, para não criar uma série por chat.
+    # Nas respostas em streaming mede só até ao início da resposta.
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    if 'inicio_pedido' in g:
+        duracao = time.perf_counter() - g.inicio_pedido
+        metricas.observar('chatbot_pedido_segundos', duracao, rota=rota, metodo=request.method)
+        etapas = metricas.etapas_pedido()
+        if etapas is not None:
+            resposta.headers['Server-Timing'] = ', '.join(
+                [f'{nome};dur={d * 1000:.1f}' for nome, d in etapas] + [f'total;dur={duracao * 1000:.1f}'])
+    metricas.contar('chatbot_pedidos_total', rota=rota, metodo=request.method, codigo=resposta.status_code)
+    return resposta
+
+@metricas.medidor
+def medidores_filas():
+    # Profundidade das filas e trabalho em curso, lidos das métricas de cada componente
+    st_ollama = ollama_pool.metrics()
+    for modelo, st in st_ollama['modelos'].items():
+        yield 'chatbot_ollama_ativos', 'Pedidos em curso no Ollama', {'modelo': modelo}, st['ativos']
+        yield 'chatbot_ollama_em_espera', 'Pedidos à espera de um lugar no Ollama', {'modelo': modelo}, st['em_espera']
+    yield 'chatbot_ollama_circuito_aberto', 'Circuito do Ollama aberto (1) ou fechado (0)', {}, int(st_ollama['circuito']['estado'] == 'aberto')
+    fila = tarefas.metrics()
+    yield 'chatbot_tarefas_em_fila', 'Tarefas em segundo plano à espera', {}, fila['profundidade']
+    yield 'chatbot_tarefas_em_curso', 'Tarefas em segundo plano a correr', {}, fila['em_curso']
+    fila = analises.metrics()
+    yield 'chatbot_analises_em_fila', 'Análises de mensagens à espera', {}, fila['profundidade']
+    yield 'chatbot_analises_em_curso', 'Análises de mensagens a correr', {}, fila['em_curso']
+    fila = documentos.fila.metrics()
+    yield 'chatbot_documentos_em_fila', 'Ficheiros à espera de indexação', {}, fila['profundidade']
+    yield 'chatbot_documentos_em_curso', 'Ficheiros a ser indexados', {}, fila['em_curso']
+    for nome, st in persistencia.metrics().items():
+        yield 'chatbot_persistencia_pendente', 'Stores com alterações ainda por gravar', {'store': nome}, int(st['sujo'])
+    for estado_job, n in imagens.metrics()['jobs'].items():
+        yield 'chatbot_imagem_jobs', 'Jobs de imagem guardados, por estado', {'estado': estado_job}, n
+    yield 'chatbot_pesquisa_web_em_curso', 'Pesquisas web em curso', {}, pesquisa_web.metrics()['em_curso']
+    yield 'chatbot_chats_blocos_em_cache', 'Blocos de chats carregados em memória', {}, chats.metrics()['blocos_em_cache']
+    for base, pool in (('chats', chat_store.pool), ('estado', getattr(estado, 'pool', None))):
+        if pool is not None:
+            yield 'chatbot_sqlite_ligacoes_abertas', 'Ligações SQLite abertas no pool', {'base': base}, pool.metrics()['abertas']
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Formato de texto do Prometheus (cada worker responde com as suas métricas)
+    return Response(metricas.exportar(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+documentos = DocumentService(UPLOAD_FOLDER, estado)
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     chat_id = request.form.get('chat_id')
@@ -655,7 +1323,8 @@ def upload_file():
         chat_folder = os.path.join(UPLOAD_FOLDER, sanitize_filename(chat_id))
         os.makedirs(chat_folder, exist_ok=True)
         file.save(os.path.join(chat_folder, filename))
-        return jsonify({'ok': True, 'filename': filename})
+        # A extração e a indexação correm em segundo plano; um ficheiro igual ao já indexado é ignorado
+        return jsonify({'ok': True, 'filename': filename, 'indexacao': documentos.submeter(chat_id, filename)})
     return jsonify({'error': 'Tipo de arquivo não permitido'}), 400
 
 @app.route('/api/files', methods=['GET'])
@@ -669,6 +1338,13 @@ def list_files():
     files = [f for f in os.listdir(chat_folder) if allowed_file(f)]
     return jsonify({'files': files})
 
+@app.route('/api/files/status', methods=['GET'])
+def files_status():
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({'error': 'chat_id é obrigatório'}), 400
+    return jsonify(documentos.estados(chat_id))
+
 @app.route('/api/download', methods=['GET'])
 def download_file():
     chat_id = request.args.get('chat_id')
@@ -698,47 +1374,44 @@ def write_markdown_line(pdf, line):
 
 # --- AI gera arquivo sob pedido ---
 def ai_generate_file_if_requested(user_text, ai_text, chat_id, file_type=None):
+    # fpdf, pandas, docx e pptx só são importados no ramo do tipo pedido
     import io
-    import fpdf
     import csv
     import json as pyjson
-    import pandas as pd
-    from docx import Document
-    from pptx import Presentation
-    import openpyxl
     lower = user_text.lower()
     chat_folder = os.path.join(UPLOAD_FOLDER, sanitize_filename(chat_id))
     os.makedirs(chat_folder, exist_ok=True)
     content = user_text.split('com', 1)[-1].strip() if 'com' in user_text else ai_text
-    filename = None
+    if file_type not in TIPOS_FICHEIRO:
+        logging.warning(f"Tipo de ficheiro não suportado: {file_type}")
+        return None
+    # O ficheiro só depende do tipo e do texto: pedidos iguais reutilizam o artefacto da cache
+    chave = ArtifactStore.chave('ficheiro', file_type, content if content else ai_text)
+    filename = artefactos.publicar(chave, file_type, chat_id, 'gerado')
+    if filename:
+        logging.debug(f"Ficheiro {file_type} reutilizado da cache: {filename}")
+        return filename
+    file_path = artefactos.caminho_temporario(chave, file_type)
     try:
         if file_type == 'pdf':
-            print(f"[DEBUG] Iniciando criação de PDF para chat_id={chat_id} na pasta {chat_folder}")
+            import fpdf
+            logging.debug(f"A criar PDF para chat_id={chat_id} na pasta {chat_folder}")
             pdf = fpdf.FPDF()
             pdf.add_page()
             pdf.set_font('Arial', size=12)
             for line in (content if content else ai_text).split('\n'):
                 write_markdown_line(pdf, line)
-            filename = f'gerado_{int(time.time())}.pdf'
-            file_path = os.path.join(chat_folder, filename)
             pdf.output(file_path)
-            print(f"[DEBUG] PDF criado com sucesso: {file_path}")
             logging.info(f"PDF criado: {file_path}")
         elif file_type == 'txt':
-            filename = f'gerado_{int(time.time())}.txt'
-            file_path = os.path.join(chat_folder, filename)
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(content if content else ai_text)
         elif file_type == 'csv':
-            filename = f'gerado_{int(time.time())}.csv'
-            file_path = os.path.join(chat_folder, filename)
             rows = [row.split(';') for row in (content if content else ai_text).split('\n') if row.strip()]
             with open(file_path, 'w', encoding='utf-8', newline='') as f:
                 writer = csv.writer(f)
                 writer.writerows(rows)
         elif file_type == 'json':
-            filename = f'gerado_{int(time.time())}.json'
-            file_path = os.path.join(chat_folder, filename)
             try:
                 data = pyjson.loads(content)
             except Exception:
@@ -746,78 +1419,66 @@ def ai_generate_file_if_requested(user_text, ai_text, chat_id, file_type=None):
             with open(file_path, 'w', encoding='utf-8') as f:
                 pyjson.dump(data, f, ensure_ascii=False, indent=2)
         elif file_type == 'py':
-            filename = f'gerado_{int(time.time())}.py'
-            file_path = os.path.join(chat_folder, filename)
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(content if content else ai_text)
         elif file_type == 'docx':
-            filename = f'gerado_{int(time.time())}.docx'
-            file_path = os.path.join(chat_folder, filename)
+            from docx import Document
             doc = Document()
             doc.add_paragraph(content if content else ai_text)
             doc.save(file_path)
         elif file_type == 'xlsx':
-            filename = f'gerado_{int(time.time())}.xlsx'
-            file_path = os.path.join(chat_folder, filename)
+            import pandas as pd
             try:
                 df = pd.read_csv(io.StringIO(content))
             except Exception:
                 df = pd.DataFrame({'Conteudo': [(content if content else ai_text)]})
             df.to_excel(file_path, index=False)
         elif file_type == 'pptx':
-            filename = f'gerado_{int(time.time())}.pptx'
-            file_path = os.path.join(chat_folder, filename)
+            from pptx import Presentation
             ppt = Presentation()
             slide = ppt.slides.add_slide(ppt.slide_layouts[0])
             slide.shapes.title.text = (content if content else ai_text)[:100]
             ppt.save(file_path)
-        else:
-            logging.warning(f"Tipo de ficheiro não suportado: {file_type}")
-            return None
-        logging.info(f"Ficheiro gerado: {file_path}")
-        print(f"[DEBUG] Ficheiro gerado: {file_path}")
+        artefactos.adicionar(chave, file_path, file_type)
+        filename = artefactos.publicar(chave, file_type, chat_id, 'gerado', contar=False)
+        logging.info(f"Ficheiro gerado: {filename}")
         return filename
     except Exception as e:
         logging.error(f"Erro ao gerar ficheiro {file_type}: {e}")
-        print(f"[DEBUG] Erro ao gerar ficheiro {file_type}: {e}")
+        if os.path.exists(file_path):
+            os.remove(file_path)
         return None
 
-def get_file_type(user_text):
+def tipo_ficheiro_no_texto(user_text):
     user_text_lower = user_text.lower()
-    for ext in ['pdf', 'txt', 'csv', 'json', 'py', 'docx', 'xlsx', 'pptx']:
+    for ext in TIPOS_FICHEIRO:
         if ext in user_text_lower:
-            print(f"[get_file_type] Detetado tipo '{ext}' diretamente no texto do utilizador.")
+            logging.debug(f"[get_file_type] Detetado tipo '{ext}' diretamente no texto do utilizador.")
             return ext
-    import time
+    return None
+
+def get_file_type(user_text, prazo=None):
+    ext = tipo_ficheiro_no_texto(user_text)
+    if ext:
+        return ext
     prompt = (
         "Que tipo de ficheiro é suposto ser gerado? Responde só pdf, txt, csv, json, py, docx, xlsx, pptx ou outro tipo simples, sem contexto nem formatação. "
         f"Frase: {user_text}"
     )
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = ollama.chat(model='llama3.1:8b', messages=[{'role': 'system', 'content': prompt}])
-            answer = response['message']['content'].strip().lower()
-            print(f"[AI get_file_type] Tentativa {attempt+1}: Pergunta: {prompt}\nResposta: {answer}")
-            for ext in ['pdf', 'txt', 'csv', 'json', 'py', 'docx', 'xlsx', 'pptx']:
-                if ext in answer:
-                    return ext
-            if attempt == 1:
-                # Após a segunda tentativa, se não encontrou, retorna vazio especial
-                return ''
-            if answer:
-                return answer
-            else:
-                print(f"[AI get_file_type] Resposta vazia, retry {attempt+1}")
-                time.sleep(1)
-        except Exception as e:
-            logging.warning(f"Erro ao obter tipo de ficheiro: {e}")
-            print(f"[AI get_file_type] Erro na tentativa {attempt+1}: {e}")
-            time.sleep(1)
-    return ''
+    try:
+        response = modelos.chat('classification', [{'role': 'system', 'content': prompt}],
+                                prioridade=OllamaScheduler.INTERATIVA, prazo=prazo)
+    except Exception as e:
+        logging.warning(f"Erro ao obter tipo de ficheiro: {e}")
+        return ''
+    answer = response['message']['content'].strip().lower()
+    logging.debug(f"[AI get_file_type] Pergunta: {prompt}\nResposta: {answer}")
+    for ext in TIPOS_FICHEIRO:
+        if ext in answer:
+            return ext
+    return answer
 
-def user_wants_file(user_text):
-    import time
+def pedido_ficheiro_explicito(user_text):
     # Padrões explícitos de geração de ficheiro
     explicit_patterns = [
         r'^(gera|cria|exporta|envia|faz|quero baixar|quero um|quero uma|quero o|quero a).*\b(pdf|ficheiro|arquivo|documento|word|excel|pptx|csv|json|txt|py)\b',
@@ -825,45 +1486,28 @@ def user_wants_file(user_text):
     user_text_lower = user_text.lower()
     for pattern in explicit_patterns:
         if re.search(pattern, user_text_lower):
-            print(f"[user_wants_file] Detetado padrão explícito de geração de ficheiro: {user_text}")
+            logging.debug(f"[user_wants_file] Detetado padrão explícito de geração de ficheiro: {user_text}")
             return True
+    return False
+
+def user_wants_file(user_text, prazo=None):
+    if pedido_ficheiro_explicito(user_text):
+        return True
 
     prompt = (
         "Isto é para gerar um ficheiro? Responde só sim ou não, sem contexto nem formatação. "
         f"Frase: {user_text}"
     )
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = ollama.chat(model='llama3.1:8b', messages=[{'role': 'system', 'content': prompt}])
-            answer = response['message']['content'].strip().lower()
-            print(f"[AI user_wants_file] Tentativa {attempt+1}: Pergunta: {prompt}\nResposta: {answer}")
-            if answer:
-                if (
-                    answer.startswith('sim') or
-                    'sim' in answer or
-                    'pdf' in answer or
-                    'ficheiro' in answer or
-                    'arquivo' in answer or
-                    'documento' in answer or
-                    'word' in answer or
-                    'excel' in answer or
-                    'pptx' in answer or
-                    'csv' in answer or
-                    'json' in answer or
-                    'txt' in answer or
-                    'py' in answer
-                ):
-                    return True
-                return False
-            else:
-                print(f"[AI user_wants_file] Resposta vazia, retry {attempt+1}")
-                time.sleep(1)
-        except Exception as e:
-            logging.warning(f"Erro ao decidir se deve gerar ficheiro: {e}")
-            print(f"[AI user_wants_file] Erro na tentativa {attempt+1}: {e}")
-            time.sleep(1)
-    return False
+    try:
+        response = modelos.chat('classification', [{'role': 'system', 'content': prompt}],
+                                prioridade=OllamaScheduler.INTERATIVA, prazo=prazo)
+    except Exception as e:
+        logging.warning(f"Erro ao decidir se deve gerar ficheiro: {e}")
+        return False
+    answer = response['message']['content'].strip().lower()
+    logging.debug(f"[AI user_wants_file] Pergunta: {prompt}\nResposta: {answer}")
+    palavras = ['sim', 'pdf', 'ficheiro', 'arquivo', 'documento', 'word', 'excel', 'pptx', 'csv', 'json', 'txt', 'py']
+    return any(p in answer for p in palavras)
 
 @app.route('/files/<chat_id>/<filename>')
 def download_file_simple(chat_id, filename):
@@ -871,5 +1515,36 @@ def download_file_simple(chat_id, filename):
     filename = secure_filename(filename)
     return send_from_directory(chat_folder, filename, as_attachment=True)
 
+def aguardar_servidor(port, timeout=60):
+    # Espera até o servidor aceitar ligações
+    import socket
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def aquecer_modelos(port):
+    # Modo --preload: depois de o servidor estar a ouvir, carrega o modelo do Ollama e o pipeline SDXL
+    if not aguardar_servidor(port):
+        logging.warning("Pré-carregamento cancelado: o servidor não ficou disponível")
+        return
+    # Todos os modelos configurados (chat, extrações, classificações, títulos)
+    modelos.aquecer()
+    # O pipeline SDXL é carregado nos processos de imagens, sem bloquear este
+    imagens.aquecer()
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--preload', action='store_true',
+                        help='carregar o modelo do Ollama e o SDXL em segundo plano depois do arranque')
+    args = parser.parse_args()
+    # Com o reloader do modo debug, só o processo filho (WERKZEUG_RUN_MAIN) serve pedidos
+    if args.preload and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=aquecer_modelos, args=(args.port,), daemon=True).start()
+    app.run(debug=True, port=args.port)
@@ -0,0 +1,202 @@
+# Escrita e leitura dos ficheiros de dados, pool de ligações SQLite e coordenação das gravações
+# periódicas (PersistenceCoordinator). Usado pelo app e pelos serviços dos outros módulos.
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentacao import metricas
+
+SAVE_INTERVAL = 10  # segundos
+SQLITE_POOL_MAX = 8  # ligações abertas por base de dados SQLite, partilhadas pelas threads dos pedidos
+
+
+def load_data(file_path, default_data=None):
+    if default_data is None:
+        default_data = {}
+    if not os.path.exists(file_path):
+        return default_data
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logging.warning(f"Falha ao carregar {file_path}: {e}")
+        return default_data
+
+
+def sanitize_filename(filename):
+    # Permite apenas letras, números, hífen e sublinhado
+    return re.sub(r'[^a-zA-Z0-9_.-]', '_', filename)
+
+
+def save_data(file_path, data):
+    # Caminho absoluto seguro
+    file_path = os.path.abspath(file_path)
+    dir_name = os.path.dirname(file_path)
+    # Sanitiza o nome do arquivo (apenas para arquivos novos criados a partir de input)
+    base = os.path.basename(file_path)
+    safe_base = sanitize_filename(base)
+    file_path = os.path.join(dir_name, safe_base)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+    try:
+        inicio = time.perf_counter()
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=dir_name, delete=False) as tf:
+            json.dump(data, tf, ensure_ascii=False, indent=2)
+            tf.flush()
+            os.fsync(tf.fileno())
+            tempname = tf.name
+            escritos = tf.tell()
+        os.replace(tempname, file_path)
+        os.chmod(file_path, 0o600)  # Permissões restritas
+        metricas.contar('chatbot_persistencia_bytes_total', escritos, ficheiro=safe_base)
+        metricas.observar('chatbot_persistencia_escrita_segundos', time.perf_counter() - inicio, ficheiro=safe_base)
+    except Exception as e:
+        logging.error(f"Erro ao salvar {file_path} (escrita segura): {e}")
+
+
+class PoolSQLite:
+    # Ligações a uma base de dados SQLite reutilizadas pelas threads (o servidor de desenvolvimento
+    # cria uma thread por pedido): no máximo `tamanho` abertas, com os PRAGMAs aplicados só ao abrir.
+    # Com todas em uso, quem pede espera que uma seja devolvida. Quem segura uma ligação não pede outra.
+    def __init__(self, path, pragmas=(), tamanho=SQLITE_POOL_MAX):
+        self.path = path
+        self.pragmas = pragmas
+        self.tamanho = tamanho
+        self._livres = []  # a última devolvida é a primeira a ser reutilizada
+        self._abertas = 0
+        self._cond = threading.Condition()
+
+    def _abrir(self):
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        for pragma in self.pragmas:
+            con.execute(f'PRAGMA {pragma}')
+        return con
+
+    @contextmanager
+    def ligacao(self):
+        with self._cond:
+            while not self._livres and self._abertas >= self.tamanho:
+                self._cond.wait()
+            if self._livres:
+                con = self._livres.pop()
+            else:
+                con = None
+                self._abertas += 1
+        if con is None:
+            try:
+                con = self._abrir()
+            except BaseException:
+                with self._cond:
+                    self._abertas -= 1
+                    self._cond.notify()
+                raise
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                # Transação deixada a meio por uma exceção: a próxima thread recebe a ligação limpa
+                con.execute('ROLLBACK')
+            with self._cond:
+                self._livres.append(con)
+                self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            return {'abertas': self._abertas, 'livres': len(self._livres), 'max': self.tamanho}
+
+
+class PersistenceCoordinator:
+    # Coordena a escrita dos dados em memória (user_infos, settings, checkpoint dos chats).
+    # Cada store tem um contador de geração: marcar_sujo() incrementa-o e uma única thread grava
+    # apenas os stores sujos, no máximo max_atraso segundos depois da primeira alteração.
+    # Várias alterações dentro dessa janela dão origem a uma só escrita; sem alterações não há escritas.
+    def __init__(self):
+        self._stores = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # serializa as escritas (thread de fundo vs encerramento)
+        self._parar = False
+        self._thread = threading.Thread(target=self._loop, name='persistencia', daemon=True)
+        self._thread.start()
+
+    def registar(self, nome, flush, max_atraso=SAVE_INTERVAL):
+        with self._cond:
+            self._stores[nome] = {'flush': flush, 'max_atraso': max_atraso, 'geracao': 0,
+                                  'gravada': 0, 'sujo_desde': None, 'escritas': 0}
+
+    def geracao(self, nome):
+        with self._cond:
+            return self._stores[nome]['geracao']
+
+    def marcar_sujo(self, nome):
+        with self._cond:
+            st = self._stores[nome]
+            st['geracao'] += 1
+            if st['sujo_desde'] is None:
+                st['sujo_desde'] = time.monotonic()
+                self._cond.notify()
+
+    def _vencidos(self, agora):
+        return [nome for nome, st in self._stores.items()
+                if st['sujo_desde'] is not None and agora - st['sujo_desde'] >= st['max_atraso']]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._parar:
+                    agora = time.monotonic()
+                    prazos = [st['sujo_desde'] + st['max_atraso'] for st in self._stores.values()
+                              if st['sujo_desde'] is not None]
+                    if prazos and min(prazos) <= agora:
+                        break
+                    self._cond.wait(min(prazos) - agora if prazos else None)
+                if self._parar:
+                    return
+                vencidos = self._vencidos(time.monotonic())
+            for nome in vencidos:
+                self._flush(nome)
+
+    def _flush(self, nome):
+        with self._flush_lock:
+            with self._cond:
+                st = self._stores[nome]
+                if st['sujo_desde'] is None:
+                    return
+                geracao = st['geracao']
+                st['sujo_desde'] = None
+            try:
+                st['flush']()
+            except Exception as e:
+                logging.error(f"Erro ao gravar {nome}: {e}")
+                with self._cond:
+                    if st['sujo_desde'] is None:
+                        st['sujo_desde'] = time.monotonic()
+                return
+            with self._cond:
+                st['gravada'] = max(st['gravada'], geracao)
+                st['escritas'] += 1
+
+    def flush_tudo(self):
+        with self._cond:
+            sujos = [nome for nome, st in self._stores.items() if st['sujo_desde'] is not None]
+        for nome in sujos:
+            self._flush(nome)
+
+    def encerrar(self):
+        # Hook de encerramento: pára a thread de fundo e grava o que ainda estiver sujo
+        with self._cond:
+            self._parar = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush_tudo()
+
+    def metrics(self):
+        with self._cond:
+            return {nome: {'geracao': st['geracao'], 'gravada': st['gravada'], 'escritas': st['escritas'],
+                           'sujo': st['sujo_desde'] is not None}
+                    for nome, st in self._stores.items()}
@@ -0,0 +1,282 @@
+# Servidor ASGI para muitas sessões de streaming em simultâneo:
+#   uvicorn asgi:app --port 5000
+# O envio de mensagens, a pesquisa web e o estado/eventos dos jobs de imagem correm no event loop:
+# a geração usa o cliente assíncrono do Ollama e um pedido à espera não ocupa nenhuma thread.
+# As outras rotas continuam no Flask, através do adaptador WSGI do asgiref.
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as chatbot
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '32'))
+# Intervalo mínimo entre verificações do pedido de cancelamento (pode ir ao state.db)
+INTERVALO_CANCELAMENTO = 0.25
+# Intervalo de consulta do estado de um job de imagem nos eventos SSE
+INTERVALO_EVENTOS = 0.5
+
+# Para o trabalho síncrono curto (SQLite, ficheiros, análise) e para a espera na fila do Ollama
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+flask_app = WsgiToAsgi(chatbot.app)
+
+
+async def em_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def ler_corpo(receive):
+    # Devolve o corpo do pedido, ou None se o cliente se desligou antes de o enviar
+    corpo = b''
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'http.disconnect':
+            return None
+        corpo += mensagem.get('body', b'')
+        if not mensagem.get('more_body'):
+            return corpo
+
+
+async def ler_json(receive):
+    corpo = await ler_corpo(receive)
+    if corpo is None:
+        return None
+    try:
+        dados = json.loads(corpo or b'{}')
+    except ValueError:
+        return {}
+    return dados if isinstance(dados, dict) else {}
+
+
+def vigiar_desligar(receive):
+    # Tarefa que assinala quando o cliente fecha a ligação (para parar a geração a meio)
+    desligado = asyncio.Event()
+
+    async def vigiar():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        desligado.set()
+    return desligado, asyncio.ensure_future(vigiar())
+
+
+def cabecalhos(tipo, extra=None):
+    return [(b'content-type', tipo.encode())] + [(k.encode(), str(v).encode()) for k, v in (extra or {}).items()]
+
+
+async def enviar_json(send, dados, status=200, extra=None):
+    corpo = json.dumps(dados, ensure_ascii=False).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': cabecalhos('application/json', dict(extra or {}, **{'content-length': len(corpo)}))})
+    await send({'type': 'http.response.body', 'body': corpo})
+
+
+async def iniciar_stream(send, tipo):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': cabecalhos(tipo, {'cache-control': 'no-cache', 'x-accel-buffering': 'no'})})
+
+
+async def enviar_parte(send, texto):
+    await send({'type': 'http.response.body', 'body': texto.encode(), 'more_body': True})
+
+
+async def fechar_stream(send):
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def gerar_resposta(ctx, desligado):
+    # Como chatbot.gerar_resposta_ia, no event loop: pára também quando o cliente se desliga
+    cid, prazo = ctx['cid'], ctx['prazo']
+    stream = None
+    produziu = False
+    verificado = 0
+    inicio = time.perf_counter()
+    try:
+        # Já admitido em preparar_envio: aqui espera pela vez em vez de ser rejeitado
+        modelo, opcoes = chatbot.modelos.parametros('chat')
+        stream = chatbot.ollama_pool.chat_stream_async(modelo, ctx['mensagens'], rejeitar=False, prazo=prazo,
+                                                       executor=executor, **opcoes)
+        async for chunk in stream:
+            if desligado.is_set():
+                logging.info(f"Cliente desligado durante a geração para o chat {cid}")
+                break
+            agora = time.time()
+            if agora - verificado >= INTERVALO_CANCELAMENTO:
+                verificado = agora
+                if await em_thread(chatbot.cancelamento_pedido, cid):
+                    logging.info(f"Geração cancelada para o chat {cid}")
+                    break
+            if prazo is not None and agora > prazo:
+                logging.warning(f"Prazo do pedido excedido durante a geração para o chat {cid}")
+                break
+            token = chunk['message']['content']
+            if token:
+                produziu = True
+                yield token
+    except Exception as e:
+        logging.error(f"Erro ao conectar ao Ollama: {e}")
+        if not produziu:
+            yield "Lamento, não consigo processar isso agora."
+    finally:
+        if stream is not None:
+            await stream.aclose()
+        chatbot.metricas.registar_etapa('geracao', time.perf_counter() - inicio)
+
+
+async def concluir(ctx, ai_text, desligado):
+    if desligado.is_set():
+        return await em_thread(chatbot.registar_cancelamento, ctx['cid'], ctx['block_idx'], ai_text)
+    # A espera pela análise em segundo plano é feita aqui, sem ocupar uma thread
+    futuro = ctx['futuro_analise']
+    if futuro is not None:
+        espera = chatbot.ESPERA_ANALISE
+        if ctx['prazo'] is not None:
+            espera = max(0, min(espera, ctx['prazo'] - time.time()))
+        try:
+            with chatbot.metricas.etapa('analise'):
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(futuro)), espera)
+        except Exception:
+            pass  # esperar_analise regista o erro (ou o timeout)
+    return await em_thread(chatbot.concluir_envio, ctx, ai_text, 0)
+
+
+async def enviar_mensagem(receive, send, cid):
+    dados = await ler_json(receive)
+    if dados is None:
+        return
+    ctx, erro = await em_thread(chatbot.preparar_envio, cid, dados.get('message'))
+    if erro:
+        return await enviar_json(send, {'error': erro[0]}, erro[1])
+    desligado, vigia = vigiar_desligar(receive)
+    partes = []
+    payload = None
+    try:
+        if not dados.get('stream'):
+            async for token in gerar_resposta(ctx, desligado):
+                partes.append(token)
+            payload = await concluir(ctx, ''.join(partes), desligado)
+            return await enviar_json(send, payload)
+        # Modo streaming: NDJSON com um objeto {"token": ...} por chunk e um objeto final {"done": true, ...}
+        await iniciar_stream(send, 'application/x-ndjson')
+        async for token in gerar_resposta(ctx, desligado):
+            partes.append(token)
+            await enviar_parte(send, json.dumps({'token': token}, ensure_ascii=False) + '\n')
+        payload = await concluir(ctx, ''.join(partes), desligado)
+        await enviar_parte(send, json.dumps(dict(payload, done=True), ensure_ascii=False) + '\n')
+        await fechar_stream(send)
+    finally:
+        vigia.cancel()
+        if payload is None:
+            # Erro ou pedido interrompido a meio: guardar o texto parcial sem esperar pelo resultado
+            executor.submit(chatbot.registar_cancelamento, cid, ctx['block_idx'], ''.join(partes))
+
+
+async def pesquisa_web(receive, send):
+    dados = await ler_json(receive)
+    if dados is None:
+        return
+    # {"query": "..."} ou {"queries": ["...", "..."]}, como em /api/websearch no Flask
+    queries = dados.get('queries')
+    if isinstance(queries, list):
+        queries = [q for q in queries if isinstance(q, str) and len(q) >= 3][:chatbot.SEARCH_MAX_QUERIES]
+        if not queries:
+            return await enviar_json(send, {'error': 'Query muito curta'}, 400)
+        return await enviar_json(send, {'results': await chatbot.pesquisa_web.procurar_varias_async(queries)})
+    query = dados.get('query', '')
+    if not isinstance(query, str) or len(query) < 3:
+        return await enviar_json(send, {'error': 'Query muito curta'}, 400)
+    resultados = await chatbot.pesquisa_web.procurar_varias_async([query])
+    return await enviar_json(send, {'results': resultados[query]})
+
+
+async def estado_imagem(receive, send, job_id):
+    job = await em_thread(chatbot.imagens.estado, job_id)
+    if not job:
+        return await enviar_json(send, {'error': 'Job não encontrado'}, 404)
+    return await enviar_json(send, job)
+
+
+async def eventos_imagem(receive, send, job_id):
+    # Server-Sent Events com o estado do job sempre que muda, consultado periodicamente no event loop
+    # (em vez de uma thread bloqueada em imagens.esperar por cada cliente)
+    job = await em_thread(chatbot.imagens.estado, job_id)
+    if not job:
+        return await enviar_json(send, {'error': 'Job não encontrado'}, 404)
+    desligado, vigia = vigiar_desligar(receive)
+    try:
+        await iniciar_stream(send, 'text/event-stream')
+        versao = -1
+        ultimo_envio = time.monotonic()
+        while job is not None and not desligado.is_set():
+            if job['versao'] != versao:
+                versao = job['versao']
+                ultimo_envio = time.monotonic()
+                await enviar_parte(send, f"data: {json.dumps(job, ensure_ascii=False)}\n\n")
+                # O texto final (ai_text) chega numa versão própria, depois do estado terminal
+                if job['estado'] in chatbot.ImageJobService.TERMINAIS and job['ai_text'] is not None:
+                    break
+            elif time.monotonic() - ultimo_envio >= 15:
+                ultimo_envio = time.monotonic()
+                await enviar_parte(send, ': keep-alive\n\n')
+            try:
+                await asyncio.wait_for(desligado.wait(), INTERVALO_EVENTOS)
+            except asyncio.TimeoutError:
+                pass
+            job = await em_thread(chatbot.imagens.estado, job_id)
+        await fechar_stream(send)
+    finally:
+        vigia.cancel()
+
+
+# (método, padrão, handler, rota como no Flask para as métricas)
+ROTAS = [
+    ('POST', re.compile(r'^/chat/(?P<cid>[^/]+)/send$'), enviar_mensagem, '/chat/<cid>/send'),
+    ('POST', re.compile(r'^/api/websearch$'), pesquisa_web, '/api/websearch'),
+    ('GET', re.compile(r'^/api/images/(?P<job_id>[^/]+)$'), estado_imagem, '/api/images/<job_id>'),
+    ('GET', re.compile(r'^/api/images/(?P<job_id>[^/]+)/events$'), eventos_imagem, '/api/images/<job_id>/events'),
+]
+
+
+def medir_pedido(send, rota, metodo):
+    # Regista as mesmas métricas que os hooks do Flask (até ao início da resposta)
+    inicio = time.perf_counter()
+
+    async def enviar(mensagem):
+        if mensagem['type'] == 'http.response.start':
+            chatbot.metricas.observar('chatbot_pedido_segundos', time.perf_counter() - inicio, rota=rota, metodo=metodo)
+            chatbot.metricas.contar('chatbot_pedidos_total', rota=rota, metodo=metodo, codigo=mensagem['status'])
+        await send(mensagem)
+    return enviar
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        for metodo, padrao, handler, rota in ROTAS:
+            m = padrao.match(scope['path'])
+            if m and scope['method'] == metodo:
+                send = medir_pedido(send, rota, metodo)
+                if chatbot.estado.partilhado:
+                    # Como o before_request do Flask: apanhar as alterações feitas por outros workers
+                    await em_thread(chatbot.sincronizar_estado)
+                try:
+                    return await handler(receive, send, **m.groupdict())
+                except chatbot.SobrecargaOllama as e:
+                    mensagem, retry_after = 'O servidor está ocupado. Tente novamente dentro de momentos.', e.retry_after
+                except chatbot.OllamaIndisponivel as e:
+                    mensagem, retry_after = 'O modelo está indisponível de momento. Tente novamente dentro de momentos.', e.retry_after
+                return await enviar_json(send, {'error': mensagem, 'retry_after': retry_after}, 503,
+                                         {'retry-after': retry_after})
+    elif scope['type'] == 'lifespan':
+        # O adaptador WSGI só aceita pedidos HTTP: o arranque e a paragem são confirmados aqui
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    await flask_app(scope, receive, send)
@@ -0,0 +1,182 @@
+# Servidor HTTP que imita a API do Ollama usada pelo app (/api/chat, /api/embed, /api/tags),
+# com latência e velocidade de geração configuráveis. Serve para medir o app sem modelo nem GPU.
+#
+# - /api/chat com "format": "json" (a análise da mensagem) devolve um JSON válido, com
+#   quer_ficheiro/quer_imagem conforme a mensagem peça um ficheiro ou uma imagem
+# - /api/embed devolve vetores determinísticos (o mesmo texto dá o mesmo vetor)
+#
+# Uso:
+#   python benchmarks/fake_ollama.py --port 11435 --latencia 0.2 --tokens-por-segundo 40
+#   OLLAMA_HOST=http://127.0.0.1:11435 python app.py
+import argparse
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PALAVRAS = ("o modelo simulado responde com texto de exemplo para medir o servidor sem gpu "
+            "cada palavra conta como um token e chega ao ritmo configurado").split()
+
+
+class Configuracao:
+    # Alterável em tempo de execução (ex: o loadtest acelera a preparação dos chats)
+    def __init__(self, latencia=0.2, tokens_por_segundo=40.0, tokens=120, tokens_auxiliares=12, dimensao=64):
+        self.latencia = latencia  # segundos até ao primeiro token (fila + prefill)
+        self.tokens_por_segundo = tokens_por_segundo
+        self.tokens = tokens  # tokens por resposta em streaming
+        self.tokens_auxiliares = tokens_auxiliares  # tokens das chamadas sem stream (análise, títulos, resumos)
+        self.dimensao = dimensao  # dimensão dos embeddings
+        self._lock = threading.Lock()
+        self.pedidos = {'chat': 0, 'chat_stream': 0, 'embed': 0, 'tags': 0}
+
+    def contar(self, tipo):
+        with self._lock:
+            self.pedidos[tipo] += 1
+
+
+def texto_da_mensagem(mensagens):
+    # Última mensagem do utilizador (ou o prompt inteiro das chamadas auxiliares)
+    for m in reversed(mensagens or []):
+        if m.get('role') == 'user':
+            return m.get('content') or ''
+    return (mensagens or [{}])[-1].get('content') or ''
+
+
+def analise_simulada(prompt):
+    # Resposta no esquema de validar_analise; as intenções seguem o texto da mensagem analisada
+    mensagem = prompt.rsplit('Mensagem:', 1)[-1].lower()
+    tipo = next((t for t in ('pdf', 'txt', 'csv', 'json', 'py', 'docx', 'xlsx', 'pptx') if re.search(rf'\b{t}\b', mensagem)), None)
+    return json.dumps({
+        'perfil': {},
+        'memoria': 'O utilizador gosta de benchmarks.' if 'gosto' in mensagem else None,
+        'quer_ficheiro': 'ficheiro' in mensagem,
+        'tipo_ficheiro': tipo,
+        'quer_imagem': 'imagem' in mensagem,
+        'titulo': None if '"titulo": null' in prompt else 'Conversa de teste',
+    }, ensure_ascii=False)
+
+
+def vetor(texto, dimensao):
+    semente = hashlib.sha256(texto.encode('utf-8')).digest()
+    valores = [semente[i % len(semente)] - 127.5 + i for i in range(dimensao)]
+    norma = math.sqrt(sum(v * v for v in valores)) or 1.0
+    return [v / norma for v in valores]
+
+
+class Handler(BaseHTTPRequestHandler):
+    config = None  # Configuracao, definida em criar_servidor
+
+    def log_message(self, formato, *args):
+        pass
+
+    def _json(self, dados, status=200):
+        corpo = json.dumps(dados).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _ler(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(tamanho) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self.config.contar('tags')
+            return self._json({'models': []})
+        self._json({'error': 'não encontrado'}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        pedido = self._ler()
+        if self.path == '/api/embed':
+            self.config.contar('embed')
+            textos = pedido.get('input')
+            textos = [textos] if isinstance(textos, str) else list(textos or [])
+            return self._json({'model': pedido.get('model'), 'embeddings': [vetor(t, self.config.dimensao) for t in textos]})
+        if self.path == '/api/chat':
+            return self._chat(pedido)
+        self._json({'error': 'não encontrado'}, 404)
+
+    def _chunk(self, modelo, conteudo, **extra):
+        return dict({'model': modelo, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                     'message': {'role': 'assistant', 'content': conteudo}, 'done': False}, **extra)
+
+    def _final(self, modelo, inicio, n_tokens, conteudo=''):
+        geracao = n_tokens / self.config.tokens_por_segundo
+        return self._chunk(modelo, conteudo, done=True, done_reason='stop',
+                           total_duration=int((time.perf_counter() - inicio) * 1e9),
+                           prompt_eval_count=32, prompt_eval_duration=int(self.config.latencia * 1e9),
+                           eval_count=n_tokens, eval_duration=int(geracao * 1e9))
+
+    def _chat(self, pedido):
+        c = self.config
+        modelo = pedido.get('model')
+        mensagens = pedido.get('messages') or []
+        inicio = time.perf_counter()
+        if not mensagens:
+            # Pré-carregamento (--preload): só carrega o modelo
+            c.contar('chat')
+            return self._json(self._final(modelo, inicio, 0))
+        if not pedido.get('stream', True):
+            c.contar('chat')
+            time.sleep(c.latencia + c.tokens_auxiliares / c.tokens_por_segundo)
+            prompt = texto_da_mensagem(mensagens)
+            if pedido.get('format') == 'json':
+                conteudo = analise_simulada(prompt)
+            else:
+                conteudo = ' '.join(PALAVRAS[i % len(PALAVRAS)] for i in range(c.tokens_auxiliares))
+            return self._json(self._final(modelo, inicio, c.tokens_auxiliares, conteudo))
+        c.contar('chat_stream')
+        # NDJSON sem Content-Length: a resposta termina quando a ligação fecha (HTTP/1.0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        time.sleep(c.latencia)
+        intervalo = 1 / c.tokens_por_segundo
+        proximo = time.perf_counter()
+        try:
+            for i in range(c.tokens):
+                proximo += intervalo
+                time.sleep(max(0, proximo - time.perf_counter()))
+                palavra = PALAVRAS[i % len(PALAVRAS)]
+                self.wfile.write((json.dumps(self._chunk(modelo, palavra + ' ')) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write((json.dumps(self._final(modelo, inicio, c.tokens)) + '\n').encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # o app fechou o stream (cancelamento ou prazo)
+
+
+def criar_servidor(port=0, config=None):
+    # Devolve o servidor (ainda parado); port=0 escolhe uma porta livre (servidor.server_address[1])
+    handler = type('HandlerConfigurado', (Handler,), {'config': config or Configuracao()})
+    servidor = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    servidor.daemon_threads = True
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor que imita a API do Ollama')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--latencia', type=float, default=0.2, help='segundos até ao primeiro token')
+    parser.add_argument('--tokens-por-segundo', type=float, default=40.0)
+    parser.add_argument('--tokens', type=int, default=120, help='tokens por resposta em streaming')
+    args = parser.parse_args()
+    config = Configuracao(args.latencia, args.tokens_por_segundo, args.tokens)
+    servidor = criar_servidor(args.port, config)
+    print(f"Ollama simulado em http://127.0.0.1:{servidor.server_address[1]}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+# Teste de carga do app contra o Ollama simulado (benchmarks/fake_ollama.py): não precisa de modelo nem de GPU.
+#
+# Arranca o Ollama simulado (neste processo) e o app num processo à parte, num diretório temporário, e mede:
+#   - latência p50/p95/p99 e débito de POST /chat/<cid>/send (com o TTFT em streaming), GET /chats e
+#     GET /chat/<cid>, com vários clientes em simultâneo sobre muitos chats com histórico longo e uma
+#     mistura de mensagens (texto, pedidos de ficheiro e de imagem, com o pipeline de imagens simulado)
+#   - o custo da persistência conforme o tamanho do histórico (latência do /send, etapas guardar_* de
+#     /metrics e crescimento de chats.db por mensagem)
+#   - a memória (RSS) do processo do app
+#
+# Uso:
+#   python benchmarks/loadtest.py                          # tabela
+#   python benchmarks/loadtest.py --json > resultado.json  # para comparar entre versões
+#   python benchmarks/loadtest.py --clientes 16 --duracao 60 --latencia 0.5 --tokens-por-segundo 20
+#   python benchmarks/loadtest.py --servidor uvicorn        # modo ASGI (asgi.py)
+import argparse
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from fake_ollama import Configuracao, criar_servidor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Corre no processo do app (servidor de desenvolvimento do Flask, sem o reloader do modo debug)
+LANCADOR_FLASK = "import sys; sys.path.insert(0, {raiz!r}); import app; app.app.run(port={port}, threaded=True)"
+
+MENSAGENS = [
+    "Explica a diferença entre uma lista e um tuplo em Python.",
+    "Que livros recomendas sobre sistemas distribuídos?",
+    "Resume as vantagens do SQLite em modo WAL.",
+    "Como posso melhorar a latência de um servidor web?",
+    "Gosto de ciclismo ao fim de semana, sugere um percurso.",
+]
+MENSAGEM_FICHEIRO = "Gera um ficheiro txt com a lista de tarefas desta semana"
+MENSAGEM_IMAGEM = "Gera uma imagem de um farol ao pôr do sol"
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def pedido(base, metodo, caminho, dados=None, timeout=300):
+    # Devolve (status, corpo, segundos); erros de ligação contam como status 0
+    corpo = json.dumps(dados).encode('utf-8') if dados is not None else None
+    req = urllib.request.Request(base + caminho, data=corpo, method=metodo,
+                                 headers={'Content-Type': 'application/json'} if corpo else {})
+    inicio = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resposta:
+            return resposta.status, resposta.read(), time.perf_counter() - inicio
+    except urllib.error.HTTPError as e:
+        return e.code, e.read(), time.perf_counter() - inicio
+    except OSError:
+        return 0, b'', time.perf_counter() - inicio
+
+
+def enviar_stream(base, cid, mensagem, timeout=300):
+    # POST /send em streaming; devolve (status, ttft, segundos)
+    req = urllib.request.Request(f"{base}/chat/{cid}/send", method='POST',
+                                 data=json.dumps({'message': mensagem, 'stream': True}).encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'})
+    inicio = time.perf_counter()
+    ttft = None
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resposta:
+            for linha in resposta:
+                if ttft is None and b'"token"' in linha:
+                    ttft = time.perf_counter() - inicio
+            return resposta.status, ttft, time.perf_counter() - inicio
+    except urllib.error.HTTPError as e:
+        return e.code, None, time.perf_counter() - inicio
+    except OSError:
+        return 0, None, time.perf_counter() - inicio
+
+
+def percentil(valores, p):
+    # Nearest-rank sobre a lista ordenada
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+def resumo(latencias, erros, duracao):
+    ms = [v * 1000 for v in latencias]
+    return {'pedidos': len(ms), 'erros': erros, 'debito_rps': round(len(ms) / duracao, 2) if duracao else None,
+            'p50_ms': percentil(ms, 50), 'p95_ms': percentil(ms, 95), 'p99_ms': percentil(ms, 99),
+            'media_ms': sum(ms) / len(ms) if ms else None, 'max_ms': max(ms) if ms else None}
+
+
+def rss_mb(pid):
+    # RSS atual do processo (Linux); None noutros sistemas
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for linha in f:
+                if linha.startswith('VmRSS:'):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+class AmostrasRSS(threading.Thread):
+    def __init__(self, pid, intervalo=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervalo = intervalo
+        self.amostras = []
+        self._parar = threading.Event()
+
+    def run(self):
+        while not self._parar.wait(self.intervalo):
+            valor = rss_mb(self.pid)
+            if valor is not None:
+                self.amostras.append(valor)
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+        return {'final_mb': self.amostras[-1] if self.amostras else None,
+                'max_mb': max(self.amostras) if self.amostras else None}
+
+
+def metricas_etapas(base):
+    # Soma e contagem de chatbot_etapa_segundos por etapa, lidas de /metrics
+    status, corpo, _ = pedido(base, 'GET', '/metrics')
+    etapas = {}
+    if status != 200:
+        return etapas
+    for linha in corpo.decode('utf-8').splitlines():
+        m = re.match(r'chatbot_etapa_segundos_(sum|count)\{etapa="([^"]+)"\} (\S+)', linha)
+        if m:
+            etapas.setdefault(m.group(2), {})[m.group(1)] = float(m.group(3))
+    return etapas
+
+
+def media_etapa(antes, depois, etapa):
+    a, d = antes.get(etapa, {}), depois.get(etapa, {})
+    n = d.get('count', 0) - a.get('count', 0)
+    return (d.get('sum', 0) - a.get('sum', 0)) / n * 1000 if n else None
+
+
+def tamanho_base(diretorio):
+    return sum(os.path.getsize(os.path.join(diretorio, f)) for f in ('chats.db', 'chats.db-wal')
+               if os.path.exists(os.path.join(diretorio, f)))
+
+
+def arrancar_app(args, diretorio, ollama_url):
+    # Configuração com o histórico no prompt, para o tamanho das conversas contar
+    with open(os.path.join(diretorio, 'settings.json'), 'w', encoding='utf-8') as f:
+        json.dump({'theme': 'dark', 'language': 'auto',
+                   'memory': {'reference_saved_memories': True, 'reference_chat_history': not args.sem_historico}}, f)
+    port = porta_livre()
+    # Hook do image_worker: os workers de imagens usam o pipeline simulado em vez de carregar o SDXL
+    env = dict(os.environ, OLLAMA_HOST=ollama_url, IMAGE_WORKERS='1',
+               IMAGE_PIPELINE='benchmarks.pipeline_simulado:carregar',
+               SEARCH_PROVIDER='local', OLLAMA_CONCURRENCY=str(args.concorrencia_ollama))
+    if args.servidor == 'uvicorn':
+        comando = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--app-dir', RAIZ, '--port', str(port), '--log-level', 'warning']
+    else:
+        comando = [sys.executable, '-c', LANCADOR_FLASK.format(raiz=RAIZ, port=port)]
+    saida = open(os.path.join(diretorio, 'servidor.log'), 'wb')
+    proc = subprocess.Popen(comando, cwd=diretorio, env=env, stdout=saida, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    limite = time.time() + 120
+    while time.time() < limite:
+        if proc.poll() is not None:
+            # O diretório temporário é apagado à saída: mostrar já o fim do log
+            with open(saida.name, encoding='utf-8', errors='replace') as f:
+                raise RuntimeError("O app terminou no arranque:\n" + ''.join(f.readlines()[-20:]))
+        if pedido(base, 'GET', '/chats', timeout=2)[0] == 200:
+            return proc, base
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("O app não ficou disponível a tempo")
+
+
+def criar_chat(base):
+    status, corpo, _ = pedido(base, 'POST', '/chat', {})
+    if status != 200:
+        raise RuntimeError(f"POST /chat devolveu {status}")
+    return json.loads(corpo)['id']
+
+
+def preencher(base, cids, blocos, clientes):
+    # Acrescenta `blocos` mensagens a cada chat (com o Ollama simulado em modo rápido)
+    trabalho = [cid for cid in cids for _ in range(blocos)]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not trabalho:
+                    return
+                cid = trabalho.pop()
+            pedido(base, 'POST', f'/chat/{cid}/send', {'message': random.choice(MENSAGENS)})
+    threads = [threading.Thread(target=worker) for _ in range(max(1, clientes))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def carga(base, cids, args):
+    # Cada cliente repete: GET /chats, GET /chat/<cid>, POST /chat/<cid>/send
+    rng = random.Random(args.seed)
+    sementes = [rng.random() for _ in range(args.clientes)]
+    resultados = {'POST /chat/<cid>/send': ([], [0]), 'GET /chats': ([], [0]), 'GET /chat/<cid>': ([], [0])}
+    ttfts = []
+    lock = threading.Lock()
+    fim = time.perf_counter() + args.duracao
+
+    def registar(nome, status, segundos):
+        with lock:
+            latencias, erros = resultados[nome]
+            if 200 <= status < 400:
+                latencias.append(segundos)
+            else:
+                erros[0] += 1
+
+    def cliente(semente):
+        r = random.Random(semente)
+        while time.perf_counter() < fim:
+            cid = r.choice(cids)
+            status, _, s = pedido(base, 'GET', '/chats')
+            registar('GET /chats', status, s)
+            status, _, s = pedido(base, 'GET', f'/chat/{cid}')
+            registar('GET /chat/<cid>', status, s)
+            sorteio = r.random()
+            if sorteio < args.ficheiros:
+                mensagem = MENSAGEM_FICHEIRO
+            elif sorteio < args.ficheiros + args.imagens:
+                mensagem = MENSAGEM_IMAGEM
+            else:
+                mensagem = r.choice(MENSAGENS)
+            if r.random() < args.stream:
+                status, ttft, s = enviar_stream(base, cid, mensagem)
+                if ttft is not None:
+                    with lock:
+                        ttfts.append(ttft)
+            else:
+                status, _, s = pedido(base, 'POST', f'/chat/{cid}/send', {'message': mensagem})
+            registar('POST /chat/<cid>/send', status, s)
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=cliente, args=(s,)) for s in sementes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - inicio
+    saida = {nome: resumo(latencias, erros[0], duracao) for nome, (latencias, erros) in resultados.items()}
+    saida['ttft_stream'] = resumo(ttfts, 0, duracao)
+    return saida
+
+
+def persistencia(base, diretorio, tamanhos, amostras):
+    # Latência do /send e custo de gravação conforme o número de blocos já existentes no chat
+    cid = criar_chat(base)
+    atual = 0
+    linhas = []
+    for tamanho in sorted(tamanhos):
+        preencher(base, [cid], tamanho - atual, 1)
+        atual = max(atual, tamanho)
+        blocos = atual
+        antes, bytes_antes = metricas_etapas(base), tamanho_base(diretorio)
+        latencias = []
+        for _ in range(amostras):
+            status, _, s = pedido(base, 'POST', f'/chat/{cid}/send', {'message': random.choice(MENSAGENS)})
+            if status == 200:
+                latencias.append(s)
+        atual += amostras
+        depois, bytes_depois = metricas_etapas(base), tamanho_base(diretorio)
+        leitura = [pedido(base, 'GET', f'/chat/{cid}')[2] for _ in range(amostras)]
+        linhas.append({
+            'blocos': blocos,
+            'send_p50_ms': percentil([v * 1000 for v in latencias], 50),
+            'get_chat_p50_ms': percentil([v * 1000 for v in leitura], 50),
+            'guardar_bloco_ms': media_etapa(antes, depois, 'guardar_bloco'),
+            'guardar_resposta_ms': media_etapa(antes, depois, 'guardar_resposta'),
+            'historico_ms': media_etapa(antes, depois, 'historico'),
+            'bytes_por_mensagem': (bytes_depois - bytes_antes) / amostras if amostras else None,
+        })
+    return linhas
+
+
+def versao_git():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga do app contra um Ollama simulado')
+    parser.add_argument('--clientes', type=int, default=8, help='clientes em simultâneo')
+    parser.add_argument('--duracao', type=float, default=30, help='segundos da fase de carga')
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--historico', type=int, default=40, help='mensagens já existentes em cada chat')
+    parser.add_argument('--latencia', type=float, default=0.2, help='segundos até ao primeiro token (Ollama simulado)')
+    parser.add_argument('--tokens-por-segundo', type=float, default=40.0)
+    parser.add_argument('--tokens', type=int, default=120, help='tokens por resposta')
+    parser.add_argument('--stream', type=float, default=0.5, help='fração de envios em streaming')
+    parser.add_argument('--ficheiros', type=float, default=0.1, help='fração de mensagens a pedir um ficheiro')
+    parser.add_argument('--imagens', type=float, default=0.05, help='fração de mensagens a pedir uma imagem')
+    parser.add_argument('--tamanhos', default='0,25,50,100,200', help='tamanhos do histórico na medição da persistência')
+    parser.add_argument('--amostras', type=int, default=10, help='envios por tamanho na medição da persistência')
+    parser.add_argument('--concorrencia-ollama', type=int, default=4, help='OLLAMA_CONCURRENCY do app')
+    parser.add_argument('--sem-historico', action='store_true', help='não incluir o histórico no prompt')
+    parser.add_argument('--servidor', choices=('flask', 'uvicorn'), default='flask')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    config = Configuracao(args.latencia, args.tokens_por_segundo, args.tokens)
+    ollama = criar_servidor(0, config)
+    threading.Thread(target=ollama.serve_forever, daemon=True).start()
+    ollama_url = f"http://127.0.0.1:{ollama.server_address[1]}"
+
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as diretorio:
+        proc, base = arrancar_app(args, diretorio, ollama_url)
+        try:
+            rss_inicial = rss_mb(proc.pid)
+            amostras_rss = AmostrasRSS(proc.pid)
+            amostras_rss.start()
+
+            # Preparação rápida: o Ollama simulado responde logo
+            normal = (config.latencia, config.tokens_por_segundo, config.tokens)
+            config.latencia, config.tokens_por_segundo, config.tokens = 0, 10000, 8
+            inicio = time.perf_counter()
+            cids = [criar_chat(base) for _ in range(args.chats)]
+            preencher(base, cids, args.historico, args.clientes)
+            preparacao = time.perf_counter() - inicio
+
+            config.latencia, config.tokens_por_segundo, config.tokens = normal
+            resultado_carga = carga(base, cids, args)
+
+            # Persistência com o Ollama simulado rápido, para isolar o custo do app
+            config.latencia, config.tokens_por_segundo, config.tokens = 0, 10000, 8
+            tamanhos = [int(t) for t in args.tamanhos.split(',') if t.strip()]
+            resultado_persistencia = persistencia(base, diretorio, tamanhos, args.amostras)
+            rss = dict(amostras_rss.parar(), inicial_mb=rss_inicial)
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            ollama.shutdown()
+
+    resultado = {
+        'versao': versao_git(),
+        'python': sys.version.split()[0],
+        'parametros': vars(args),
+        'preparacao_s': round(preparacao, 2),
+        'carga': resultado_carga,
+        'persistencia': resultado_persistencia,
+        'rss': rss,
+        'ollama_pedidos': config.pedidos,
+    }
+    if args.json:
+        print(json.dumps(resultado, indent=2))
+        return
+
+    def fmt(v, casas=1):
+        return '-' if v is None else f"{v:.{casas}f}"
+    print(f"{'endpoint':<26}{'pedidos':>9}{'erros':>7}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for nome, r in resultado_carga.items():
+        print(f"{nome:<26}{r['pedidos']:>9}{r['erros']:>7}{fmt(r['debito_rps']):>8}"
+              f"{fmt(r['p50_ms']):>9}{fmt(r['p95_ms']):>9}{fmt(r['p99_ms']):>9}")
+    print()
+    print(f"{'blocos':>8}{'send p50':>10}{'GET p50':>10}{'bloco ms':>10}{'resposta ms':>13}{'bytes/msg':>11}")
+    for linha in resultado_persistencia:
+        print(f"{linha['blocos']:>8}{fmt(linha['send_p50_ms']):>10}{fmt(linha['get_chat_p50_ms']):>10}"
+              f"{fmt(linha['guardar_bloco_ms'], 2):>10}{fmt(linha['guardar_resposta_ms'], 2):>13}"
+              f"{fmt(linha['bytes_por_mensagem'], 0):>11}")
+    print()
+    print(f"RSS do app: inicial {fmt(rss['inicial_mb'])} MB, máximo {fmt(rss['max_mb'])} MB, final {fmt(rss['final_mb'])} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# Pipeline SDXL simulado para o loadtest, carregado pelo hook do image_worker
+# (IMAGE_PIPELINE=benchmarks.pipeline_simulado:carregar). Não gera nada: cada passo demora
+# IMAGE_STEP_SECONDS e a imagem final é um PNG de 1x1, por isso os jobs de imagem passam pelo mesmo
+# caminho (workers, progresso, cancelamento, cache de artefactos) sem modelo nem GPU.
+import os
+import time
+
+IMAGE_STEP_SECONDS = float(os.environ.get('IMAGE_STEP_SECONDS', 0.05))
+PNG_1X1 = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de'
+                        '0000000c49444154789c636868680000030401814bd3d2100000000049454e44ae426082')
+
+
+class ImagemSimulada:
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(PNG_1X1)
+
+
+class Resultado:
+    def __init__(self, images):
+        self.images = images
+
+
+class PipelineSimulado:
+    device = 'cpu'
+
+    def __call__(self, prompt, num_inference_steps, generator, width, height, callback_on_step_end):
+        for passo in range(num_inference_steps):
+            time.sleep(IMAGE_STEP_SECONDS)
+            callback_on_step_end(self, passo, None, {})
+        return Resultado([ImagemSimulada()])
+
+
+def carregar(modelo):
+    return PipelineSimulado()
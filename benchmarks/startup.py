@@ -0,0 +1,88 @@
+# Mede o tempo de importação e a memória (RSS) de cada subsistema do app.
+# Cada medição corre num processo Python novo, para não haver módulos já em cache.
+#
+# Uso:
+#   python benchmarks/startup.py            # tabela
+#   python benchmarks/startup.py --json     # JSON (para comparar entre versões)
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SUBSISTEMAS = [
+    ('flask', 'import flask'),
+    ('ollama', 'import ollama'),
+    ('bleach', 'import bleach'),
+    ('duckduckgo_search', 'from duckduckgo_search import DDGS'),
+    ('PIL', 'from PIL import Image'),
+    ('pandas', 'import pandas'),
+    ('torch', 'import torch'),
+    ('diffusers', 'from diffusers import StableDiffusionXLPipeline'),
+    ('app', 'import app'),
+]
+
+# Corre no processo filho: importa o módulo e devolve tempo e RSS (antes/depois) em JSON
+SCRIPT_MEDICAO = """
+import json, resource, sys, time
+def rss_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+sys.path.insert(0, {raiz!r})
+antes = rss_mb()
+inicio = time.perf_counter()
+try:
+    exec({codigo!r})
+    erro = None
+except Exception as e:
+    erro = f"{{type(e).__name__}}: {{e}}"
+fim = time.perf_counter()
+print(json.dumps({{'import_s': fim - inicio, 'rss_antes_mb': antes, 'rss_mb': rss_mb(), 'erro': erro}}))
+"""
+
+
+def medir(nome, codigo):
+    # O app cria ficheiros de dados no diretório atual: usar um diretório temporário
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = subprocess.run(
+            [sys.executable, '-c', SCRIPT_MEDICAO.format(raiz=RAIZ, codigo=codigo)],
+            cwd=tmp, capture_output=True, text=True, timeout=600
+        )
+    linhas = [l for l in proc.stdout.splitlines() if l.startswith('{')]
+    if not linhas:
+        return {'subsistema': nome, 'erro': proc.stderr.strip().splitlines()[-1:] or 'sem resultado'}
+    resultado = json.loads(linhas[-1])
+    resultado['subsistema'] = nome
+    resultado['rss_delta_mb'] = resultado['rss_mb'] - resultado['rss_antes_mb']
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tempo de importação e RSS por subsistema')
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    parser.add_argument('--repeticoes', type=int, default=3, help='medições por subsistema (usa a mediana)')
+    args = parser.parse_args()
+
+    resultados = []
+    for nome, codigo in SUBSISTEMAS:
+        medicoes = [medir(nome, codigo) for _ in range(args.repeticoes)]
+        validas = sorted((m for m in medicoes if not m.get('erro')), key=lambda m: m['import_s'])
+        resultados.append(validas[len(validas) // 2] if validas else medicoes[0])
+
+    if args.json:
+        print(json.dumps({'python': sys.version.split()[0], 'resultados': resultados}, indent=2))
+        return
+    print(f"{'subsistema':<20}{'import (s)':>12}{'RSS (MB)':>12}{'delta RSS':>12}")
+    for r in resultados:
+        if r.get('erro'):
+            print(f"{r['subsistema']:<20}  indisponível ({r['erro']})")
+        else:
+            print(f"{r['subsistema']:<20}{r['import_s']:>12.3f}{r['rss_mb']:>12.1f}{r['rss_delta_mb']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
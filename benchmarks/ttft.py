@@ -0,0 +1,128 @@
+# Compara o tempo até ao primeiro token (TTFT) com e sem o prefixo estável do prompt.
+#
+# "estavel":   prefixo do app (montar_prefixo), com keep_alive e num_ctx fixos -> o Ollama reaproveita
+#              a KV cache das mensagens de sistema entre turnos
+# "instavel":  como antes: a ordem dos campos do perfil e das memórias muda a cada turno e não há
+#              keep_alive/num_ctx fixos -> o prefixo é processado (prefill) de novo em cada pedido
+#
+# Precisa de um servidor Ollama a correr (OLLAMA_HOST) com o modelo indicado.
+#
+# Uso:
+#   python benchmarks/ttft.py                 # tabela
+#   python benchmarks/ttft.py --json --turnos 10
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERFIL = {
+    'nome': 'Ana',
+    'profissao': 'engenheira de software',
+    'cidade': 'Porto',
+    'interesses': ['ciclismo', 'fotografia', 'jazz'],
+    'clube': 'FC Porto',
+    'linguas': ['português', 'inglês', 'espanhol'],
+    'memorias_resumidas': [f"O utilizador gosta do tema {i}." for i in range(20)],
+}
+
+PERGUNTAS = [
+    "Sugere um plano de treino de ciclismo para o fim de semana.",
+    "Que objetiva devo usar para fotografia de rua?",
+    "Explica a diferença entre TCP e UDP em duas frases.",
+    "Recomenda três álbuns de jazz para começar.",
+    "Como organizo um projeto Python com vários módulos?",
+]
+
+
+def importar_app():
+    # O app cria ficheiros de dados no diretório atual: importá-lo a partir de um diretório temporário
+    os.chdir(tempfile.mkdtemp(prefix='ttft-'))
+    sys.path.insert(0, RAIZ)
+    import app
+    return app
+
+
+def prefixo_instavel(app, rng):
+    # Reproduz o comportamento antigo: dict e lista de memórias com ordem variável entre pedidos
+    campos = [k for k in PERFIL if k != 'memorias_resumidas']
+    rng.shuffle(campos)
+    memorias = list(PERFIL['memorias_resumidas'])
+    rng.shuffle(memorias)
+    texto = "As informações a seguir são sobre o usuário. Use-as para personalizar suas respostas de forma implícita, sem mencioná-las diretamente.\n"
+    for key in campos:
+        texto += f"- {key.replace('_', ' ').capitalize()}: {PERFIL[key]}\n"
+    texto += "- Outras informações relevantes:\n" + ''.join(f"  - {m}\n" for m in memorias)
+    return [{'role': 'system', 'content': app.PROMPT_SISTEMA}, {'role': 'system', 'content': texto}]
+
+
+def medir_turno(client, modelo, mensagens, opcoes):
+    # Devolve (ttft em segundos, tokens do prompt avaliados, tempo de prefill em segundos)
+    inicio = time.perf_counter()
+    ttft = None
+    final = {}
+    for chunk in client.chat(model=modelo, messages=mensagens, stream=True, **opcoes):
+        if ttft is None and chunk['message']['content']:
+            ttft = time.perf_counter() - inicio
+        if chunk.get('done'):
+            final = chunk
+    return ttft, final.get('prompt_eval_count'), (final.get('prompt_eval_duration') or 0) / 1e9
+
+
+def correr(app, client, modo, modelo, turnos, seed):
+    rng = random.Random(seed)
+    if modo == 'estavel':
+        opcoes = {'keep_alive': app.OLLAMA_KEEP_ALIVE, 'options': {'num_ctx': app.OLLAMA_NUM_CTX, 'num_predict': 32}}
+    else:
+        opcoes = {'options': {'num_predict': 32}}
+    historico = []
+    medicoes = []
+    for turno in range(turnos):
+        pergunta = PERGUNTAS[turno % len(PERGUNTAS)]
+        if modo == 'estavel':
+            # Como no app: as memórias (aqui as 5 primeiras) vão junto da mensagem, depois do histórico
+            memorias = {'role': 'system', 'content': ''.join(f"- {m}\n" for m in PERFIL['memorias_resumidas'][:5])}
+            mensagens = app.montar_prefixo(PERFIL, True) + historico + [memorias, {'role': 'user', 'content': pergunta}]
+        else:
+            mensagens = prefixo_instavel(app, rng) + historico + [{'role': 'user', 'content': pergunta}]
+        ttft, avaliados, prefill = medir_turno(client, modelo, mensagens, opcoes)
+        medicoes.append({'turno': turno, 'ttft_s': ttft, 'prompt_eval_count': avaliados, 'prefill_s': prefill})
+        historico += [{'role': 'user', 'content': pergunta}, {'role': 'assistant', 'content': 'Ok.'}]
+    # O primeiro turno de cada modo inclui o carregamento do modelo: fica fora da mediana
+    seguintes = [m for m in medicoes[1:] if m['ttft_s'] is not None] or medicoes
+    return {
+        'modo': modo,
+        'turnos': medicoes,
+        'ttft_mediana_s': statistics.median(m['ttft_s'] or 0 for m in seguintes),
+        'prompt_eval_mediana': statistics.median(m['prompt_eval_count'] or 0 for m in seguintes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TTFT com e sem prefixo estável do prompt')
+    parser.add_argument('--modelo', default='llama3.1:8b')
+    parser.add_argument('--turnos', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+
+    app = importar_app()
+    import ollama
+    client = ollama.Client()
+    resultados = [correr(app, client, modo, args.modelo, args.turnos, args.seed) for modo in ('instavel', 'estavel')]
+
+    if args.json:
+        print(json.dumps({'modelo': args.modelo, 'resultados': resultados}, indent=2))
+        return
+    print(f"{'modo':<12}{'TTFT mediana (s)':>18}{'tokens avaliados':>18}")
+    for r in resultados:
+        print(f"{r['modo']:<12}{r['ttft_mediana_s']:>18.3f}{r['prompt_eval_mediana']:>18.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Pesquisa web com cache, coalescência de pesquisas iguais em curso e prazo por pesquisa, sobre o
+# DuckDuckGo ou um índice local.
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+
+from armazenamento import load_data
+
+SEARCH_TIMEOUT = 8  # prazo (s) de cada pesquisa web
+SEARCH_MAX_RESULTS = 5  # resultados pedidos ao provider (e guardados na cache)
+SEARCH_CACHE_TTL = 600  # segundos que um resultado fica na cache
+SEARCH_CACHE_MAX = 256  # pesquisas na cache antes de descartar as menos usadas
+SEARCH_WORKERS = 4  # pesquisas simultâneas
+
+
+class DuckDuckGoProvider:
+    nome = 'ddg'
+
+    def __init__(self):
+        # Uma sessão DDGS por thread, reutilizada entre pesquisas
+        self._local = threading.local()
+
+    def procurar(self, query, max_results, timeout):
+        ddgs = getattr(self._local, 'ddgs', None)
+        if ddgs is None:
+            from duckduckgo_search import DDGS
+            ddgs = self._local.ddgs = DDGS(timeout=timeout)
+        return [r['body'] for r in ddgs.text(query, max_results=max_results)][:max_results]
+
+
+class LocalIndexProvider:
+    # Índice local (ficheiro JSON com uma lista de {"titulo", "texto"}) para testes e instalações
+    # sem acesso à internet; ordena os documentos pelo nº de termos da pesquisa que contêm
+    nome = 'local'
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('SEARCH_LOCAL_INDEX', 'search_index.json')
+        documentos = load_data(self.path, [])
+        self._docs = [(d.get('texto', ''), set(re.findall(r'\w+', (d.get('titulo', '') + ' ' + d.get('texto', '')).lower())))
+                      for d in documentos]
+
+    def procurar(self, query, max_results, timeout):
+        termos = set(re.findall(r'\w+', query.lower()))
+        pontuados = [(len(termos & palavras), texto) for texto, palavras in self._docs]
+        return [texto for pontos, texto in sorted(pontuados, key=lambda p: -p[0]) if pontos][:max_results]
+
+
+SEARCH_PROVIDERS = {'ddg': DuckDuckGoProvider, 'local': LocalIndexProvider}
+
+
+class WebSearchService:
+    # Pesquisa com cache TTL+LRU por query normalizada, coalescência de pesquisas iguais em curso
+    # (partilham o mesmo Future) e um prazo por pesquisa: quem espera desiste ao fim de timeout
+    # segundos, mas o resultado, quando chegar, fica na cache para a próxima vez.
+    def __init__(self, provider, workers=SEARCH_WORKERS, ttl=SEARCH_CACHE_TTL, max_entradas=SEARCH_CACHE_MAX):
+        self.provider = provider
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._cache = OrderedDict()  # query normalizada -> (expira, resultados)
+        self._em_curso = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pesquisa')
+        self.stats = {'hits': 0, 'misses': 0, 'coalescidas': 0, 'timeouts': 0, 'erros': 0}
+
+    @staticmethod
+    def normalizar(query):
+        return ' '.join(query.lower().split())
+
+    def _futuro(self, query):
+        chave = self.normalizar(query)
+        with self._lock:
+            entrada = self._cache.get(chave)
+            if entrada and entrada[0] > time.time():
+                self._cache.move_to_end(chave)
+                self.stats['hits'] += 1
+                fut = Future()
+                fut.set_result(entrada[1])
+                return fut
+            if chave in self._em_curso:
+                self.stats['coalescidas'] += 1
+                return self._em_curso[chave]
+            self.stats['misses'] += 1
+            fut = self._executor.submit(self.provider.procurar, chave, SEARCH_MAX_RESULTS, SEARCH_TIMEOUT)
+            self._em_curso[chave] = fut
+        fut.add_done_callback(lambda f: self._concluida(chave, f))
+        return fut
+
+    def _concluida(self, chave, fut):
+        with self._lock:
+            self._em_curso.pop(chave, None)
+            if fut.exception() is not None:
+                return
+            self._cache[chave] = (time.time() + self.ttl, fut.result())
+            self._cache.move_to_end(chave)
+            while len(self._cache) > self.max_entradas:
+                self._cache.popitem(last=False)
+
+    def _resultado(self, query, fut, restante, max_results):
+        try:
+            return fut.result(timeout=max(0, restante))[:max_results]
+        except FuturesTimeout:
+            self.stats['timeouts'] += 1
+            logging.warning(f"Pesquisa web excedeu o prazo: {query!r}")
+        except Exception as e:
+            self.stats['erros'] += 1
+            logging.warning(f"Erro na pesquisa web ({self.provider.nome}) para {query!r}: {e}")
+        return []
+
+    def procurar(self, query, max_results=3, timeout=SEARCH_TIMEOUT):
+        return self._resultado(query, self._futuro(query), timeout, max_results)
+
+    def procurar_varias(self, queries, max_results=3, timeout=SEARCH_TIMEOUT):
+        # Várias pesquisas em paralelo (ex: para fundamentar uma resposta) com um prazo comum
+        prazo = time.time() + timeout
+        futuros = [(q, self._futuro(q)) for q in queries]
+        return {q: self._resultado(q, fut, prazo - time.time(), max_results) for q, fut in futuros}
+
+    async def procurar_varias_async(self, queries, max_results=3, timeout=SEARCH_TIMEOUT):
+        # Para o modo ASGI: espera pelos Futures sem ocupar uma thread (as pesquisas correm no executor).
+        # asyncio.wait não cancela os que não acabarem a tempo: esses ficam na cache quando chegarem.
+        futuros = [(q, self._futuro(q)) for q in queries]
+        await asyncio.wait([asyncio.wrap_future(fut) for _, fut in futuros], timeout=timeout)
+        return {q: self._resultado(q, fut, 0, max_results) for q, fut in futuros}
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, provider=self.provider.nome, em_cache=len(self._cache), em_curso=len(self._em_curso))
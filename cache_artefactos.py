@@ -0,0 +1,123 @@
+# Cache dos artefactos gerados (imagens e ficheiros), endereçada pelo conteúdo do pedido.
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from armazenamento import sanitize_filename
+
+ARTIFACTS_FOLDER = 'artifacts'  # cache de imagens e ficheiros gerados, endereçada pelo conteúdo
+ARTIFACTS_MAX_MB = int(os.environ.get('ARTIFACTS_MAX_MB', 2048))  # tamanho máximo da cache antes de descartar os menos usados
+
+
+class ArtifactStore:
+    # Cache dos artefactos gerados (imagens, ficheiros), endereçada por um hash do pedido
+    # (prompt, modelo, seed, tamanho/formato). Cada artefacto fica uma única vez em <pasta>/<hash>.<ext>;
+    # os chats recebem um hard link (ou uma cópia) em <pasta_chats>/<chat_id>/, com o hash no nome,
+    # por isso dois pedidos nunca escrevem no mesmo ficheiro e descartar da cache não parte links já enviados.
+    def __init__(self, pasta_chats, pasta=ARTIFACTS_FOLDER, max_bytes=ARTIFACTS_MAX_MB * 1024 * 1024):
+        self.pasta_chats = pasta_chats
+        self.pasta = pasta
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entradas = OrderedDict()  # nome -> tamanho, do menos para o mais recentemente usado
+        self._total = 0
+        self.stats = {'hits': 0, 'misses': 0, 'adicionados': 0, 'descartados': 0}
+        os.makedirs(pasta, exist_ok=True)
+        self._indexar()
+
+    @staticmethod
+    def chave(*partes):
+        h = hashlib.sha256()
+        for parte in partes:
+            h.update(str(parte).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _indexar(self):
+        # A ordem LRU sobrevive a reinícios: o mtime é atualizado a cada hit
+        ficheiros = []
+        for nome in os.listdir(self.pasta):
+            caminho = os.path.join(self.pasta, nome)
+            if '.tmp.' in nome:
+                # Restos de uma geração interrompida
+                os.remove(caminho)
+                continue
+            st = os.stat(caminho)
+            ficheiros.append((st.st_mtime, nome, st.st_size))
+        for _, nome, tamanho in sorted(ficheiros):
+            self._entradas[nome] = tamanho
+            self._total += tamanho
+        self._descartar()
+
+    def caminho_temporario(self, chave, ext):
+        # A extensão fica no fim: PIL, pandas, etc. escolhem o formato por ela
+        return os.path.join(self.pasta, f"{chave}.{uuid.uuid4().hex}.tmp.{ext}")
+
+    def adicionar(self, chave, caminho_tmp, ext):
+        nome = f"{chave}.{ext}"
+        os.replace(caminho_tmp, os.path.join(self.pasta, nome))
+        tamanho = os.path.getsize(os.path.join(self.pasta, nome))
+        with self._lock:
+            self._total += tamanho - self._entradas.pop(nome, 0)
+            self._entradas[nome] = tamanho
+            self.stats['adicionados'] += 1
+            self._descartar()
+
+    def _descartar(self):
+        # Chamado com _lock adquirido (ou no arranque); o artefacto mais recente nunca é descartado
+        while self._total > self.max_bytes and len(self._entradas) > 1:
+            nome, tamanho = self._entradas.popitem(last=False)
+            self._total -= tamanho
+            self.stats['descartados'] += 1
+            try:
+                os.remove(os.path.join(self.pasta, nome))
+            except OSError as e:
+                logging.warning(f"Falha ao descartar o artefacto {nome}: {e}")
+
+    @staticmethod
+    def nome_publico(chave, prefixo, ext):
+        return f"{prefixo}_{chave[:16]}.{ext}"
+
+    def publicar(self, chave, ext, chat_id, prefixo, contar=True):
+        # Expõe o artefacto em uploads/<chat_id>/ e devolve o nome do ficheiro (None se não estiver na cache)
+        nome = f"{chave}.{ext}"
+        origem = os.path.join(self.pasta, nome)
+        chat_folder = os.path.join(self.pasta_chats, sanitize_filename(chat_id))
+        filename = self.nome_publico(chave, prefixo, ext)
+        destino = os.path.join(chat_folder, filename)
+        # Com o lock o artefacto não pode ser descartado entre a consulta e o link
+        with self._lock:
+            if nome not in self._entradas and os.path.exists(origem):
+                # Gerado por outro worker depois do arranque deste
+                self._entradas[nome] = os.path.getsize(origem)
+                self._total += self._entradas[nome]
+            if nome not in self._entradas or not os.path.exists(origem):
+                if nome in self._entradas:
+                    self._total -= self._entradas.pop(nome)
+                if contar:
+                    self.stats['misses'] += 1
+                return None
+            self._entradas.move_to_end(nome)
+            if contar:
+                self.stats['hits'] += 1
+            os.utime(origem)
+            os.makedirs(chat_folder, exist_ok=True)
+            if not os.path.exists(destino):
+                try:
+                    os.link(origem, destino)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    # Sistemas de ficheiros sem hard links
+                    tmp = destino + '.tmp'
+                    shutil.copyfile(origem, tmp)
+                    os.replace(tmp, destino)
+        return filename
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, artefactos=len(self._entradas), bytes=self._total, max_bytes=self.max_bytes)
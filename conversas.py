@@ -0,0 +1,652 @@
+# Conversas: o modelo Chat, a persistência em SQLite (ChatStore) e o gestor em memória com locks por
+# chat, LRU dos conteúdos e números de sequência para a listagem (ChatManager).
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from armazenamento import PoolSQLite, load_data
+from instrumentacao import LockMedido
+
+CHATS_DB = 'chats.db'
+CHAT_LOCK_STRIPES = 64  # número de locks partilhados pelos chats
+CHAT_CACHE_MAX_BLOCOS = 5000  # blocos em memória (soma de todos os chats carregados) antes de descartar os menos usados
+CHATS_TOMBSTONES = 1000  # chats apagados lembrados para GET /chats?since= (além disso, lista completa)
+
+
+class Chat:
+    def __init__(self, cid, data):
+        self.cid = cid
+        self.data = data
+
+    @property
+    def name(self):
+        return self.data.get('name', 'Novo Chat')
+
+    @name.setter
+    def name(self, value):
+        self.data['name'] = value
+
+    def add_message(self, user_text, ai_text):
+        self.data.setdefault('conversation_blocks', []).append({
+            'user_variants': [user_text],
+            'ai_responses': [ai_text],
+            'selected': 0
+        })
+
+    def get_conversation_blocks(self):
+        return self.data.get('conversation_blocks', [])
+
+    def to_dict(self):
+        return self.data
+
+
+ESQUEMA_CHATS = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    ordem INTEGER NOT NULL,
+    versao INTEGER NOT NULL DEFAULT 0,
+    versao_meta INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    n_blocos INTEGER NOT NULL DEFAULT 0,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    versao INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, idx)
+) WITHOUT ROWID;
+"""
+
+
+# Índice de pesquisa (FTS5) dos chats: uma linha por bloco (perguntas e respostas) e uma pelo nome do
+# chat (idx = -1). Mantido por triggers, por isso acompanha cada escrita de bloco, renomeação e
+# remoção (em cascata) sem código extra. O tokenizer remove acentos ("informação" = "informacao").
+TEXTO_BLOCO_SQL = (
+    "COALESCE((SELECT group_concat(value, ' ') FROM json_each(new.data, '$.user_variants')), '') || ' ' || "
+    "COALESCE((SELECT group_concat(value, ' ') FROM json_each(new.data, '$.ai_responses')), '')"
+)
+ESQUEMA_PESQUISA = f"""
+CREATE TABLE IF NOT EXISTS pesquisa_docs (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    UNIQUE (chat_id, idx)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS pesquisa USING fts5(texto, tokenize = 'unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS pesquisa_docs_apagar AFTER DELETE ON pesquisa_docs BEGIN
+    DELETE FROM pesquisa WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS pesquisa_bloco_inserir AFTER INSERT ON blocks BEGIN
+    INSERT OR IGNORE INTO pesquisa_docs (chat_id, idx) VALUES (new.chat_id, new.idx);
+    DELETE FROM pesquisa WHERE rowid = (SELECT id FROM pesquisa_docs WHERE chat_id = new.chat_id AND idx = new.idx);
+    INSERT INTO pesquisa (rowid, texto) SELECT id, {TEXTO_BLOCO_SQL} FROM pesquisa_docs WHERE chat_id = new.chat_id AND idx = new.idx;
+END;
+CREATE TRIGGER IF NOT EXISTS pesquisa_bloco_atualizar AFTER UPDATE OF data ON blocks BEGIN
+    DELETE FROM pesquisa WHERE rowid = (SELECT id FROM pesquisa_docs WHERE chat_id = new.chat_id AND idx = new.idx);
+    INSERT INTO pesquisa (rowid, texto) SELECT id, {TEXTO_BLOCO_SQL} FROM pesquisa_docs WHERE chat_id = new.chat_id AND idx = new.idx;
+END;
+CREATE TRIGGER IF NOT EXISTS pesquisa_chat_inserir AFTER INSERT ON chats BEGIN
+    INSERT OR IGNORE INTO pesquisa_docs (chat_id, idx) VALUES (new.id, -1);
+    INSERT INTO pesquisa (rowid, texto) SELECT id, new.name FROM pesquisa_docs WHERE chat_id = new.id AND idx = -1;
+END;
+CREATE TRIGGER IF NOT EXISTS pesquisa_chat_renomear AFTER UPDATE OF name ON chats WHEN new.name IS NOT old.name BEGIN
+    DELETE FROM pesquisa WHERE rowid = (SELECT id FROM pesquisa_docs WHERE chat_id = new.id AND idx = -1);
+    INSERT INTO pesquisa (rowid, texto) SELECT id, new.name FROM pesquisa_docs WHERE chat_id = new.id AND idx = -1;
+END;
+"""
+
+
+class ChatStore:
+    # Persistência dos chats em SQLite (modo WAL). Cada alteração grava só a linha do chat ou do
+    # bloco modificado; a compactação (checkpoint do WAL + vacuum incremental) corre em segundo plano.
+    # As escritas levam a versão do chat e nunca substituem uma versão mais recente. A linha do chat
+    # (nome, resumo) compara com versao_meta, que só ela escreve: a escrita de um bloco com uma versão
+    # mais alta (que avança chats.versao) não pode descartar uma renomeação que chegue depois.
+    def __init__(self, path=CHATS_DB):
+        self.path = path
+        self.pool = PoolSQLite(path, ('journal_mode=WAL', 'synchronous=NORMAL', 'foreign_keys=ON'))
+        self.ao_escrever = None  # chamado depois de cada escrita (marca o WAL para compactação)
+        with self._ligacao() as con:
+            con.execute('PRAGMA auto_vacuum=INCREMENTAL')  # só tem efeito numa base de dados nova
+            con.executescript(ESQUEMA_CHATS)
+            colunas = [linha[1] for linha in con.execute("PRAGMA table_info(chats)")]
+            if 'n_blocos' not in colunas:
+                # Bases de dados criadas antes do índice de metadados
+                con.execute("ALTER TABLE chats ADD COLUMN n_blocos INTEGER NOT NULL DEFAULT 0")
+                con.execute("UPDATE chats SET n_blocos = (SELECT COUNT(*) FROM blocks WHERE chat_id = chats.id)")
+            if 'versao_meta' not in colunas:
+                # Bases de dados em que a versão do chat também guardava a linha do chat (nome, resumo)
+                con.execute("ALTER TABLE chats ADD COLUMN versao_meta INTEGER NOT NULL DEFAULT 0")
+            self.pesquisa_disponivel = self._criar_pesquisa(con)
+
+    def _criar_pesquisa(self, con):
+        # Sem FTS5 (SQLite compilado sem ele) o app funciona, só sem /api/search
+        try:
+            con.executescript(ESQUEMA_PESQUISA)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Pesquisa nos chats indisponível (FTS5): {e}")
+            return False
+        if con.execute("SELECT 1 FROM pesquisa_docs LIMIT 1").fetchone() is None and \
+                con.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is not None:
+            # Base de dados criada antes do índice: indexar uma vez o que já existe
+            inicio = time.time()
+            texto_bloco = TEXTO_BLOCO_SQL.replace('new.data', 'b.data')
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                con.execute("INSERT INTO pesquisa_docs (chat_id, idx) SELECT id, -1 FROM chats")
+                con.execute("INSERT INTO pesquisa_docs (chat_id, idx) SELECT chat_id, idx FROM blocks")
+                con.execute("INSERT INTO pesquisa (rowid, texto) SELECT d.id, c.name FROM pesquisa_docs d "
+                            "JOIN chats c ON c.id = d.chat_id WHERE d.idx = -1")
+                con.execute(f"INSERT INTO pesquisa (rowid, texto) SELECT d.id, {texto_bloco} FROM pesquisa_docs d "
+                            "JOIN blocks b ON b.chat_id = d.chat_id AND b.idx = d.idx")
+                con.execute('COMMIT')
+            except sqlite3.Error as e:
+                # Fica vazio e a indexação repete-se no próximo arranque
+                logging.error(f"Erro ao indexar os chats para pesquisa: {e}")
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                return False
+            logging.info(f"Índice de pesquisa dos chats criado em {time.time() - inicio:.1f}s")
+        return True
+
+    def pesquisar(self, consulta, limite, offset):
+        # consulta: expressão FTS5 já montada. Devolve (total, resultados ordenados por relevância)
+        with self._ligacao() as con:
+            total = con.execute("SELECT COUNT(*) FROM pesquisa WHERE pesquisa MATCH ?", (consulta,)).fetchone()[0]
+            linhas = con.execute(
+                "SELECT d.chat_id, d.idx, c.name, snippet(pesquisa, 0, '**', '**', '…', 16), bm25(pesquisa) "
+                "FROM pesquisa JOIN pesquisa_docs d ON d.id = pesquisa.rowid JOIN chats c ON c.id = d.chat_id "
+                "WHERE pesquisa MATCH ? ORDER BY bm25(pesquisa) LIMIT ? OFFSET ?",
+                (consulta, limite, offset)).fetchall()
+        return total, [{'chat_id': cid, 'chat_name': nome, 'block_idx': idx if idx >= 0 else None,
+                        'snippet': snippet, 'score': round(-score, 4)}
+                       for cid, idx, nome, snippet, score in linhas]
+
+    def _ligacao(self):
+        # Uma ligação do pool, só durante o bloco `with`; o SQLite trata da concorrência entre elas
+        return self.pool.ligacao()
+
+    def _escreveu(self):
+        if self.ao_escrever:
+            self.ao_escrever()
+
+    def _extra(self, data):
+        return json.dumps({k: v for k, v in data.items() if k not in ('name', 'conversation_blocks', 'versao')},
+                          ensure_ascii=False)
+
+    def guardar_chat(self, cid, data):
+        try:
+            with self._ligacao() as con:
+                con.execute(
+                    "INSERT INTO chats (id, name, ordem, versao, versao_meta, updated_at, extra) "
+                    "VALUES (?, ?, (SELECT COALESCE(MAX(ordem), 0) + 1 FROM chats), ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET name = excluded.name, versao = MAX(chats.versao, excluded.versao), "
+                    "versao_meta = excluded.versao_meta, updated_at = excluded.updated_at, extra = excluded.extra "
+                    "WHERE excluded.versao_meta >= chats.versao_meta",
+                    (cid, data.get('name', 'Novo Chat'), data.get('versao', 0), data.get('versao', 0), time.time(),
+                     self._extra(data)))
+            self._escreveu()
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao guardar chat {cid}: {e}")
+
+    def guardar_bloco(self, cid, idx, bloco, versao):
+        with self._ligacao() as con:
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                con.execute(
+                    "INSERT INTO blocks (chat_id, idx, versao, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id, idx) DO UPDATE SET versao = excluded.versao, data = excluded.data "
+                    "WHERE excluded.versao >= blocks.versao",
+                    (cid, idx, versao, json.dumps(bloco, ensure_ascii=False)))
+                con.execute("UPDATE chats SET versao = MAX(versao, ?), updated_at = ?, n_blocos = MAX(n_blocos, ?) "
+                            "WHERE id = ?", (versao, time.time(), idx + 1, cid))
+                con.execute('COMMIT')
+            except sqlite3.IntegrityError:
+                # O chat foi apagado entretanto
+                con.execute('ROLLBACK')
+                return
+            except sqlite3.Error as e:
+                logging.error(f"Erro ao guardar bloco {idx} do chat {cid}: {e}")
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                return
+        self._escreveu()
+
+    def acrescentar_bloco(self, cid, bloco, versao):
+        # Novo bloco no fim do chat. O índice e a versão são decididos dentro da transação, por isso dois
+        # workers que acrescentem ao mesmo chat (com a cache de um deles desatualizada) nunca escrevem
+        # no mesmo índice. Devolve (idx, versão gravada) ou None se o chat já não existir
+        with self._ligacao() as con:
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                linha = con.execute(
+                    "SELECT versao, (SELECT COALESCE(MAX(idx), -1) + 1 FROM blocks WHERE chat_id = chats.id) "
+                    "FROM chats WHERE id = ?", (cid,)).fetchone()
+                if linha is None:
+                    con.execute('ROLLBACK')
+                    return None
+                versao, idx = max(versao, linha[0] + 1), linha[1]
+                con.execute("INSERT INTO blocks (chat_id, idx, versao, data) VALUES (?, ?, ?, ?)",
+                            (cid, idx, versao, json.dumps(bloco, ensure_ascii=False)))
+                con.execute("UPDATE chats SET versao = ?, updated_at = ?, n_blocos = MAX(n_blocos, ?) WHERE id = ?",
+                            (versao, time.time(), idx + 1, cid))
+                con.execute('COMMIT')
+            except sqlite3.Error as e:
+                # Sem o bloco gravado a mensagem não tem índice: o pedido falha
+                logging.error(f"Erro ao acrescentar bloco ao chat {cid}: {e}")
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                raise
+        self._escreveu()
+        return idx, versao
+
+    def remover_chat(self, cid):
+        try:
+            with self._ligacao() as con:
+                con.execute("DELETE FROM chats WHERE id = ?", (cid,))
+            self._escreveu()
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao apagar chat {cid}: {e}")
+
+    def carregar_metadados(self):
+        # Índice leve para a listagem: não lê o conteúdo das conversas
+        with self._ligacao() as con:
+            return {cid: {'name': name, 'versao': versao, 'updated_at': updated_at, 'n_blocos': n_blocos}
+                    for cid, name, versao, updated_at, n_blocos in con.execute(
+                        "SELECT id, name, versao, updated_at, n_blocos FROM chats ORDER BY ordem")}
+
+    def carregar_chat(self, cid):
+        with self._ligacao() as con:
+            linha = con.execute("SELECT name, versao, extra FROM chats WHERE id = ?", (cid,)).fetchone()
+            if linha is None:
+                return None
+            blocos = con.execute("SELECT data FROM blocks WHERE chat_id = ? ORDER BY idx", (cid,)).fetchall()
+        name, versao, extra = linha
+        data = json.loads(extra)
+        data.update({'name': name, 'versao': versao})
+        data['conversation_blocks'] = [json.loads(b) for (b,) in blocos]
+        return data
+
+    def migrar_json(self, file_path):
+        # Migração única do antigo chats_data.json. Tudo numa transação: se o processo morrer a meio,
+        # a base de dados fica vazia e a migração repete-se no próximo arranque.
+        if not os.path.exists(file_path):
+            return
+        with self._ligacao() as con:
+            if con.execute("SELECT 1 FROM chats LIMIT 1").fetchone():
+                return
+            antigos = load_data(file_path)
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                agora = time.time()
+                for ordem, (cid, data) in enumerate(antigos.items(), start=1):
+                    blocks = data.get('conversation_blocks', [])
+                    con.execute("INSERT INTO chats (id, name, ordem, versao, updated_at, n_blocos, extra) "
+                                "VALUES (?, ?, ?, 0, ?, ?, ?)",
+                                (cid, data.get('name', 'Novo Chat'), ordem, agora, len(blocks), self._extra(data)))
+                    con.executemany("INSERT INTO blocks (chat_id, idx, versao, data) VALUES (?, ?, 0, ?)",
+                                    [(cid, idx, json.dumps(b, ensure_ascii=False))
+                                     for idx, b in enumerate(blocks)])
+                con.execute('COMMIT')
+            except sqlite3.Error as e:
+                logging.error(f"Erro ao migrar {file_path}: {e}")
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                return
+        os.replace(file_path, file_path + '.migrado')
+        logging.info(f"{len(antigos)} chats migrados de {file_path} para {self.path}")
+
+    def compactar(self):
+        try:
+            with self._ligacao() as con:
+                con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                con.execute('PRAGMA incremental_vacuum')
+        except sqlite3.Error as e:
+            logging.warning(f"Erro ao compactar {self.path}: {e}")
+
+
+class ChatManager:
+    # Cada chat é protegido por um de CHAT_LOCK_STRIPES locks (lock striping), por isso chats
+    # diferentes avançam em paralelo. A listagem lê um snapshot imutável, sem locks.
+    # Regra: nunca fazer I/O nem chamadas ao modelo com um destes locks adquirido.
+    # Cada alteração incrementa data['versao'] e grava apenas o que mudou no ChatStore.
+    # Em memória fica só o índice de metadados; o conteúdo dos chats é carregado quando é preciso
+    # para uma LRU limitada a CHAT_CACHE_MAX_BLOCOS blocos.
+    # Cada alteração de metadados recebe um número de sequência (_seq), usado pelos clientes para
+    # pedir só o que mudou (alteracoes); os chats apagados ficam como tombstones.
+    # Com estado partilhado (vários workers) cada escrita incrementa a versão 'chats' do estado e
+    # sincronizar() relê os metadados quando outro worker a incrementou.
+    def __init__(self, store, estado, stripes=CHAT_LOCK_STRIPES, max_blocos=CHAT_CACHE_MAX_BLOCOS,
+                 max_tombstones=CHATS_TOMBSTONES):
+        self.store = store
+        self.estado = estado
+        self._versao_estado = estado.versao('chats')
+        self._meta = store.carregar_metadados()
+        self._epoca = uuid.uuid4().hex[:8]  # os números de sequência só valem dentro deste arranque
+        self._seq = 0
+        self._seq_listagem = 0
+        self._removidos = OrderedDict()  # cid -> seq da remoção
+        self._removidos_desde = 0  # cursores anteriores a isto podem ter perdido remoções
+        self.max_tombstones = max_tombstones
+        self._cache = OrderedDict()  # cid -> data, do menos para o mais recentemente usado
+        self._cache_blocos = 0
+        self._em_uso = {}  # cid -> nº de operações em curso (não podem ser descartados)
+        self._cache_lock = threading.Lock()
+        self.max_blocos = max_blocos
+        self._stripes = [LockMedido('chats') for _ in range(stripes)]
+        # Ordena os blocos acrescentados ao mesmo chat (o índice vem do store, fora do lock do chat)
+        self._stripes_acrescentar = [LockMedido('chats_acrescentar') for _ in range(stripes)]
+        self._estrutura = threading.Lock()  # criação/remoção de chats e atualização da listagem
+        self._listagem = ()
+        self._atualizar_listagem()
+    def lock(self, cid):
+        return self._stripes[hash(cid) % len(self._stripes)]
+    def _atualizar_listagem(self):
+        # Copy-on-write: a tupla anterior continua válida para quem a estiver a ler
+        self._listagem = tuple((cid, meta['name']) for cid, meta in list(self._meta.items()))
+        self._seq_listagem = self._seq
+    def _publicar(self):
+        # Chamado depois de cada escrita no store
+        if not self.estado.partilhado:
+            return
+        versao = self.estado.incrementar('chats')
+        with self._estrutura:
+            if versao == self._versao_estado + 1:
+                # Nenhum outro worker escreveu entretanto: não é preciso reler
+                self._versao_estado = versao
+    def sincronizar(self):
+        # Relê os metadados se outro worker alterou chats e descarta da cache os chats desatualizados
+        if not self.estado.partilhado:
+            return
+        versao = self.estado.versao('chats')
+        if versao == self._versao_estado:
+            return
+        meta = self.store.carregar_metadados()
+        with self._estrutura:
+            for cid in [c for c in self._meta if c not in meta]:
+                del self._meta[cid]
+                self._tombstone(cid)
+            for cid, novo in meta.items():
+                atual = self._meta.get(cid)
+                if atual is None or novo['versao'] > atual.get('versao', 0):
+                    self._seq += 1
+                    self._removidos.pop(cid, None)
+                    self._meta[cid] = dict(novo, seq=self._seq)
+            self._atualizar_listagem()
+            self._versao_estado = max(self._versao_estado, versao)
+            versoes = {cid: m.get('versao', 0) for cid, m in self._meta.items()}
+        with self._cache_lock:
+            for cid in list(self._cache):
+                if cid not in self._em_uso and self._cache[cid].get('versao', 0) < versoes.get(cid, float('inf')):
+                    data = self._cache.pop(cid)
+                    self._cache_blocos -= len(data.get('conversation_blocks', []))
+    def _tombstone(self, cid):
+        # Chamado com _estrutura adquirido
+        self._seq += 1
+        self._removidos[cid] = self._seq
+        while len(self._removidos) > self.max_tombstones:
+            _, self._removidos_desde = self._removidos.popitem(last=False)
+    def _tocar_meta(self, cid, listagem=False, **campos):
+        # Chamado sem o lock do chat; a versão só avança (escritas concorrentes podem chegar fora de ordem)
+        with self._estrutura:
+            meta = self._meta.get(cid)
+            if meta is None:
+                return
+            if 'versao' in campos:
+                campos['versao'] = max(campos['versao'], meta.get('versao', 0))
+            self._seq += 1
+            self._meta[cid] = dict(meta, seq=self._seq, updated_at=time.time(), **campos)
+            if listagem:
+                self._atualizar_listagem()
+    def _carregar(self, cid, fixar=False):
+        # Devolve o dict do chat (da cache ou da base de dados); fixar impede o descarte até _libertar
+        with self._cache_lock:
+            data = self._cache.get(cid)
+            if data is not None:
+                self._cache.move_to_end(cid)
+                if fixar:
+                    self._em_uso[cid] = self._em_uso.get(cid, 0) + 1
+                return data
+        if cid not in self._meta:
+            return None
+        carregado = self.store.carregar_chat(cid)  # I/O fora de qualquer lock
+        if carregado is None:
+            return None
+        with self._cache_lock:
+            data = self._cache.get(cid)
+            if data is None:
+                data = carregado
+                self._cache[cid] = data
+                self._cache_blocos += len(data.get('conversation_blocks', []))
+            self._cache.move_to_end(cid)
+            if fixar:
+                self._em_uso[cid] = self._em_uso.get(cid, 0) + 1
+            self._descartar()
+        return data
+    def _libertar(self, cid):
+        with self._cache_lock:
+            n = self._em_uso.get(cid, 0) - 1
+            if n > 0:
+                self._em_uso[cid] = n
+            else:
+                self._em_uso.pop(cid, None)
+            self._descartar()
+    def _descartar(self):
+        # Chamado com _cache_lock; descarta os menos usados até caber no limite
+        for cid in list(self._cache):
+            if self._cache_blocos <= self.max_blocos or len(self._cache) <= 1:
+                break
+            if cid in self._em_uso:
+                continue
+            data = self._cache.pop(cid)
+            self._cache_blocos -= len(data.get('conversation_blocks', []))
+    def __getitem__(self, cid):
+        chat = self.get(cid)
+        if chat is None:
+            raise KeyError(cid)
+        return chat
+    def __setitem__(self, cid, chat_obj):
+        data = chat_obj.to_dict()
+        data.setdefault('versao', 0)
+        with self._cache_lock:
+            self._cache[cid] = data
+            self._cache_blocos += len(data.get('conversation_blocks', []))
+        with self._estrutura:
+            self._seq += 1
+            self._removidos.pop(cid, None)
+            self._meta[cid] = {'name': data.get('name', 'Novo Chat'), 'versao': data['versao'], 'seq': self._seq,
+                               'updated_at': time.time(), 'n_blocos': len(data.get('conversation_blocks', []))}
+            self._atualizar_listagem()
+        self.store.guardar_chat(cid, data)
+        self._publicar()
+    def __delitem__(self, cid):
+        self.remover(cid)
+    def get(self, cid):
+        data = self._carregar(cid)
+        if data is not None:
+            return Chat(cid, data)
+        return None
+    def __contains__(self, cid):
+        return cid in self._meta
+    def listar(self):
+        return [{'id': cid, 'name': name} for cid, name in self._listagem]
+    def etag_listagem(self):
+        return f"{self._epoca}-{self._seq_listagem}"
+    def versao(self, cid):
+        meta = self._meta.get(cid)
+        return None if meta is None else meta.get('versao', 0)
+    def alteracoes(self, desde):
+        # desde: cursor devolvido num pedido anterior ('<época>:<seq>'). Um cursor de outro arranque,
+        # do futuro ou mais antigo do que as tombstones guardadas recebe a lista completa.
+        with self._estrutura:
+            epoca, _, seq = (desde or '').partition(':')
+            seq = int(seq) if seq.isdigit() else -1
+            resultado = {'cursor': f"{self._epoca}:{self._seq}"}
+            if epoca != self._epoca or seq < self._removidos_desde or seq > self._seq:
+                resultado['full'] = True
+                resultado['chats'] = [self._resumo_meta(cid, meta) for cid, meta in self._meta.items()]
+                return resultado
+            resultado['full'] = False
+            resultado['changed'] = [self._resumo_meta(cid, meta) for cid, meta in self._meta.items()
+                                    if meta.get('seq', 0) > seq]
+            resultado['deleted'] = [cid for cid, removido in self._removidos.items() if removido > seq]
+            return resultado
+    def _resumo_meta(self, cid, meta):
+        return {'id': cid, 'name': meta['name'], 'versao': meta.get('versao', 0), 'n_blocos': meta.get('n_blocos', 0)}
+    def remover(self, cid):
+        with self._estrutura:
+            if self._meta.pop(cid, None) is None:
+                return False
+            self._tombstone(cid)
+            self._atualizar_listagem()
+        with self._cache_lock:
+            data = self._cache.pop(cid, None)
+            if data is not None:
+                self._cache_blocos -= len(data.get('conversation_blocks', []))
+        self.store.remover_chat(cid)
+        self._publicar()
+        return True
+    def renomear(self, cid, nome, apenas_se_nome=None):
+        # apenas_se_nome: só renomeia se o nome atual for este (ex: 'Novo Chat')
+        data = self._carregar(cid, fixar=True)
+        if data is None:
+            return False
+        try:
+            with self.lock(cid):
+                if apenas_se_nome is not None and data.get('name', 'Novo Chat') != apenas_se_nome:
+                    return False
+                data['name'] = nome
+                versao = data['versao'] = data.get('versao', 0) + 1
+                meta = {k: v for k, v in data.items() if k != 'conversation_blocks'}
+            self._tocar_meta(cid, listagem=True, name=nome, versao=versao)
+            self.store.guardar_chat(cid, meta)
+            self._publicar()
+            return True
+        finally:
+            self._libertar(cid)
+    def adicionar_bloco(self, cid, user_text):
+        # Devolve (block_idx, cópia dos blocos anteriores) ou None se o chat não existir.
+        # O índice é o que o store atribuiu; se não for o seguinte na cache, outro worker acrescentou
+        # blocos entretanto e o chat é relido antes de devolver o histórico
+        data = self._carregar(cid, fixar=True)
+        if data is None:
+            return None
+        try:
+            with self._stripes_acrescentar[hash(cid) % len(self._stripes_acrescentar)]:
+                bloco = {
+                    'user_variants': [user_text],
+                    'ai_responses': [None],
+                    'selected': 0
+                }
+                with self.lock(cid):
+                    versao = data.get('versao', 0) + 1
+                gravado = self.store.acrescentar_bloco(cid, bloco, versao)
+                if gravado is None:
+                    return None
+                block_idx, versao = gravado
+                with self.lock(cid):
+                    blocks = data.setdefault('conversation_blocks', [])
+                    atualizado = block_idx == len(blocks)
+                    if atualizado:
+                        blocks.append(bloco)
+                        data['versao'] = max(data.get('versao', 0), versao)
+                if not atualizado and not self._reler(cid, data):
+                    return None
+                with self.lock(cid):
+                    anteriores = list(data['conversation_blocks'][:block_idx])
+            if atualizado:
+                with self._cache_lock:
+                    if cid in self._cache:
+                        self._cache_blocos += 1
+            self._tocar_meta(cid, n_blocos=block_idx + 1, versao=versao)
+            self._publicar()
+            return block_idx, anteriores
+        finally:
+            self._libertar(cid)
+    def _reler(self, cid, data):
+        # Substitui no próprio dict (quem o tem fixado continua a ver o chat) o conteúdo do chat pelo
+        # que está no store. Devolve False se o chat tiver sido apagado
+        carregado = self.store.carregar_chat(cid)  # I/O fora de qualquer lock
+        if carregado is None:
+            return False
+        with self.lock(cid):
+            antes = len(data.get('conversation_blocks', []))
+            carregado['versao'] = max(carregado.get('versao', 0), data.get('versao', 0))
+            data.clear()
+            data.update(carregado)
+        with self._cache_lock:
+            if self._cache.get(cid) is data:
+                self._cache_blocos += len(carregado['conversation_blocks']) - antes
+        return True
+    def definir_resposta(self, cid, block_idx, ai_text):
+        data = self._carregar(cid, fixar=True)
+        if data is None:
+            return
+        try:
+            with self.lock(cid):
+                blocks = data.get('conversation_blocks', [])
+                if block_idx >= len(blocks):
+                    return
+                blocks[block_idx]['ai_responses'][0] = ai_text
+                versao = data['versao'] = data.get('versao', 0) + 1
+                bloco = copy.deepcopy(blocks[block_idx])
+            self._tocar_meta(cid, versao=versao)
+            self.store.guardar_bloco(cid, block_idx, bloco, versao)
+            self._publicar()
+        finally:
+            self._libertar(cid)
+    def resumo(self, cid):
+        # Devolve {'texto': ..., 'ate': nº de blocos resumidos} (vazio se ainda não houver resumo)
+        data = self._carregar(cid)
+        if data is None:
+            return None
+        with self.lock(cid):
+            return dict(data.get('resumo') or {'texto': '', 'ate': 0})
+    def guardar_resumo(self, cid, texto, ate):
+        # Só avança: um resumo mais antigo nunca substitui um que já cobre mais blocos
+        data = self._carregar(cid, fixar=True)
+        if data is None:
+            return False
+        try:
+            with self.lock(cid):
+                if (data.get('resumo') or {}).get('ate', 0) >= ate:
+                    return False
+                data['resumo'] = {'texto': texto, 'ate': ate}
+                versao = data['versao'] = data.get('versao', 0) + 1
+                meta = {k: v for k, v in data.items() if k != 'conversation_blocks'}
+            self._tocar_meta(cid, versao=versao)
+            self.store.guardar_chat(cid, meta)
+            self._publicar()
+            return True
+        finally:
+            self._libertar(cid)
+    def copia_blocos(self, cid):
+        data = self._carregar(cid)
+        if data is None:
+            return None
+        with self.lock(cid):
+            return list(data.get('conversation_blocks', []))
+    def janela_blocos(self, cid, antes, limite):
+        # Os `limite` blocos anteriores ao índice `antes` (None: os mais recentes), por ordem cronológica.
+        # Devolve (versão, total, índice do primeiro bloco, blocos) ou None se o chat não existir
+        data = self._carregar(cid)
+        if data is None:
+            return None
+        with self.lock(cid):
+            blocks = data.get('conversation_blocks', [])
+            fim = len(blocks) if antes is None else max(0, min(antes, len(blocks)))
+            inicio = max(0, fim - limite)
+            return data.get('versao', 0), len(blocks), inicio, blocks[inicio:fim]
+    def metrics(self):
+        with self._cache_lock:
+            return {'chats': len(self._meta), 'chats_em_cache': len(self._cache),
+                    'blocos_em_cache': self._cache_blocos, 'max_blocos': self.max_blocos}
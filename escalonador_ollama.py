@@ -0,0 +1,356 @@
+# Cliente do Ollama partilhado por todo o app: limite de pedidos simultâneos por modelo, fila de
+# prioridade, retries em erros transitórios e circuit breaker.
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import ollama
+
+from instrumentacao import metricas
+
+OLLAMA_CONCURRENCY = int(os.environ.get('OLLAMA_CONCURRENCY', 2))  # pedidos simultâneos ao Ollama por modelo
+OLLAMA_QUEUE_MAX = 32  # pedidos em espera por modelo antes de responder 503 (tarefas auxiliares: metade)
+OLLAMA_TIMEOUT = 60  # segundos sem resposta do Ollama (leitura) antes de a chamada falhar
+OLLAMA_CONNECT_TIMEOUT = 5  # segundos para estabelecer a ligação ao Ollama
+OLLAMA_RETRIES = 2  # tentativas por chamada em erros transitórios (ligação, timeout, 5xx)
+OLLAMA_FAILURES_MAX = 3  # falhas seguidas que abrem o circuito (chamadas falham logo até o Ollama recuperar)
+OLLAMA_PROBE_INTERVAL = 5  # segundos entre sondas ao Ollama com o circuito aberto
+
+
+class SobrecargaOllama(Exception):
+    def __init__(self, modelo, retry_after):
+        super().__init__(f"Ollama sobrecarregado ({modelo})")
+        self.modelo = modelo
+        self.retry_after = retry_after
+
+
+class OllamaIndisponivel(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Ollama indisponível (circuito aberto)")
+        self.retry_after = retry_after
+
+
+class PrazoExcedido(Exception):
+    pass
+
+
+def erro_transitorio(e):
+    # Erros que justificam repetir a chamada e que contam como falha do Ollama
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code >= 500
+    return isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    # Depois de OLLAMA_FAILURES_MAX falhas seguidas o circuito abre: as chamadas falham logo
+    # (OllamaIndisponivel) em vez de prenderem threads em timeouts e retries. Uma thread sonda o
+    # Ollama a cada intervalo e fecha o circuito quando ele voltar a responder.
+    def __init__(self, sonda, falhas_max=OLLAMA_FAILURES_MAX, intervalo=OLLAMA_PROBE_INTERVAL):
+        self.sonda = sonda
+        self.falhas_max = falhas_max
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self.estado = 'fechado'
+        self.falhas = 0
+        self.aberto_desde = None
+        self.stats = {'aberturas': 0, 'rejeitados': 0, 'sondas': 0}
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == 'aberto':
+                self.stats['rejeitados'] += 1
+                raise OllamaIndisponivel(self.intervalo)
+
+    def sucesso(self):
+        with self._lock:
+            self.falhas = 0
+
+    def falha(self):
+        with self._lock:
+            self.falhas += 1
+            if self.estado == 'aberto' or self.falhas < self.falhas_max:
+                return
+            self.estado = 'aberto'
+            self.aberto_desde = time.time()
+            self.stats['aberturas'] += 1
+        logging.error(f"Circuito do Ollama aberto após {self.falhas} falhas seguidas")
+        threading.Thread(target=self._sondar, name='ollama-sonda', daemon=True).start()
+
+    def _sondar(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.stats['sondas'] += 1
+            try:
+                self.sonda()
+            except Exception as e:
+                logging.info(f"Ollama ainda indisponível: {e}")
+                continue
+            with self._lock:
+                self.estado = 'fechado'
+                self.falhas = 0
+                duracao = time.time() - self.aberto_desde
+            logging.info(f"Circuito do Ollama fechado ao fim de {duracao:.0f}s")
+            return
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, estado=self.estado, falhas_seguidas=self.falhas,
+                        aberto_ha_s=round(time.time() - self.aberto_desde, 1) if self.estado == 'aberto' else None)
+
+
+class OllamaScheduler:
+    # Cliente do Ollama partilhado (o httpx por baixo reutiliza as ligações) com um limite de pedidos
+    # simultâneos por modelo. Quem espera fica numa fila de prioridade: as respostas ao utilizador
+    # passam à frente das tarefas auxiliares (análise, títulos). Com a fila cheia o pedido é rejeitado
+    # logo (SobrecargaOllama -> 503 + Retry-After) em vez de esperar indefinidamente.
+    INTERATIVA = 0
+    AUXILIAR = 1
+
+    def __init__(self, keep_alive, num_ctx, concorrencia=OLLAMA_CONCURRENCY, fila_max=OLLAMA_QUEUE_MAX):
+        # Lê OLLAMA_HOST do ambiente; o timeout de leitura aplica-se entre chunks, não à geração toda
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.client = ollama.Client(timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT))
+        self._client_async = None  # criado no primeiro uso, dentro do event loop do modo ASGI
+        self.breaker = CircuitBreaker(sonda=self.client.list)
+        self.concorrencia = max(1, concorrencia)
+        self.fila_max = fila_max
+        self._cond = threading.Condition()
+        self._modelos = {}
+        self._seq = itertools.count()
+
+    def _estado(self, modelo):
+        # Chamado com _cond adquirido
+        st = self._modelos.get(modelo)
+        if st is None:
+            st = self._modelos[modelo] = {'ativos': 0, 'fila': [], 'duracao_media': 5.0,
+                                          'pedidos': 0, 'rejeitados': 0, 'espera_max': 0.0}
+        return st
+
+    def _limite_fila(self, prioridade):
+        return self.fila_max if prioridade == self.INTERATIVA else self.fila_max // 2
+
+    def _retry_after(self, st):
+        # Estimativa do tempo até a fila esvaziar, com base na duração média dos pedidos
+        return max(1, int(st['duracao_media'] * (len(st['fila']) + 1) / self.concorrencia + 0.5))
+
+    def verificar_carga(self, modelo, prioridade=INTERATIVA):
+        # Admissão antecipada (antes de criar o bloco do chat ou abrir o stream)
+        self.breaker.permitir()
+        with self._cond:
+            st = self._estado(modelo)
+            if len(st['fila']) >= self._limite_fila(prioridade):
+                st['rejeitados'] += 1
+                raise SobrecargaOllama(modelo, self._retry_after(st))
+
+    def _entrar(self, modelo, prioridade, rejeitar, prazo):
+        # Bloqueia até haver lugar para o modelo; devolve o estado do modelo (para _sair)
+        chegada = time.time()
+        with self._cond:
+            st = self._estado(modelo)
+            if rejeitar and len(st['fila']) >= self._limite_fila(prioridade):
+                st['rejeitados'] += 1
+                raise SobrecargaOllama(modelo, self._retry_after(st))
+            entrada = (prioridade, next(self._seq))
+            heapq.heappush(st['fila'], entrada)
+            pronto = self._cond.wait_for(lambda: st['fila'][0] == entrada and st['ativos'] < self.concorrencia,
+                                         None if prazo is None else max(0, prazo - time.time()))
+            if not pronto:
+                st['fila'].remove(entrada)
+                heapq.heapify(st['fila'])
+                self._cond.notify_all()
+                raise PrazoExcedido(f"Prazo excedido à espera do Ollama ({modelo})")
+            heapq.heappop(st['fila'])
+            st['ativos'] += 1
+            st['pedidos'] += 1
+            st['espera_max'] = max(st['espera_max'], time.time() - chegada)
+            metricas.observar('chatbot_ollama_fila_segundos', time.time() - chegada, modelo=modelo)
+            # O próximo da fila pode também ter um lugar livre
+            self._cond.notify_all()
+        return st
+
+    def _sair(self, st, inicio):
+        with self._cond:
+            st['ativos'] -= 1
+            st['duracao_media'] = 0.8 * st['duracao_media'] + 0.2 * (time.time() - inicio)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, modelo, prioridade=AUXILIAR, rejeitar=True, prazo=None):
+        st = self._entrar(modelo, prioridade, rejeitar, prazo)
+        inicio = time.time()
+        try:
+            yield self.client
+        finally:
+            self._sair(st, inicio)
+
+    def _parametros(self, kwargs):
+        # keep_alive e num_ctx iguais em todas as chamadas: o modelo fica carregado e o Ollama
+        # reaproveita a KV cache do prefixo comum (mensagens de sistema) entre turnos
+        kwargs.setdefault('keep_alive', self.keep_alive)
+        kwargs['options'] = dict({'num_ctx': self.num_ctx}, **(kwargs.get('options') or {}))
+        return kwargs
+
+    def _pausa(self, tentativa, prazo):
+        # Backoff curto entre tentativas (0 na primeira); sem tempo falha logo
+        pausa = 0.25 * 2 ** (tentativa - 1) if tentativa else 0
+        if prazo is not None and tentativa and time.time() + pausa >= prazo:
+            raise PrazoExcedido("Prazo excedido antes de repetir a chamada ao Ollama")
+        if prazo is not None and time.time() >= prazo:
+            raise PrazoExcedido("Prazo excedido antes da chamada ao Ollama")
+        return pausa
+
+    def _antes_da_tentativa(self, tentativa, prazo):
+        # Com o circuito aberto falha logo
+        pausa = self._pausa(tentativa, prazo)
+        if pausa:
+            time.sleep(pausa)
+        self.breaker.permitir()
+
+    def _chamar(self, model, prioridade, prazo, tentativas, fn):
+        # Uma chamada não-stream com retries em erros transitórios e circuit breaker
+        inicio = time.perf_counter()
+        try:
+            return self._tentar(model, prioridade, prazo, tentativas, fn)
+        finally:
+            metricas.observar('chatbot_ollama_chamada_segundos', time.perf_counter() - inicio, modelo=model)
+
+    def _tentar(self, model, prioridade, prazo, tentativas, fn):
+        for tentativa in range(tentativas):
+            self._antes_da_tentativa(tentativa, prazo)
+            try:
+                with self.slot(model, prioridade, rejeitar=tentativa == 0, prazo=prazo) as client:
+                    resposta = fn(client)
+            except Exception as e:
+                if not erro_transitorio(e):
+                    raise
+                self.breaker.falha()
+                if tentativa == tentativas - 1:
+                    raise
+                logging.warning(f"Erro transitório no Ollama (tentativa {tentativa+1}): {e}")
+                continue
+            self.breaker.sucesso()
+            return resposta
+
+    def chat(self, model, messages, prioridade=AUXILIAR, prazo=None, tentativas=OLLAMA_RETRIES, **kwargs):
+        kwargs = self._parametros(kwargs)
+        return self._chamar(model, prioridade, prazo, tentativas,
+                            lambda client: client.chat(model=model, messages=messages, **kwargs))
+
+    def embed(self, model, textos, prioridade=AUXILIAR, prazo=None, tentativas=OLLAMA_RETRIES):
+        return self._chamar(model, prioridade, prazo, tentativas,
+                            lambda client: client.embed(model=model, input=textos, keep_alive=self.keep_alive))
+
+    def _medir(self, model, chunk, inicio, com_token):
+        # TTFT (desde o pedido, incluindo a fila e as tentativas) e velocidade reportada no chunk final
+        if not com_token and chunk['message']['content']:
+            ttft = time.perf_counter() - inicio
+            metricas.observar('chatbot_ollama_ttft_segundos', ttft, modelo=model)
+            etapas = metricas.etapas_pedido()
+            if etapas is not None:
+                etapas.append(('ttft', ttft))
+            com_token = True
+        if chunk.get('done') and chunk.get('eval_count'):
+            metricas.contar('chatbot_ollama_tokens_total', chunk['eval_count'], modelo=model)
+            if chunk.get('eval_duration'):
+                metricas.observar('chatbot_ollama_tokens_por_segundo',
+                                  chunk['eval_count'] / (chunk['eval_duration'] / 1e9), modelo=model)
+        return com_token
+
+    def chat_stream(self, model, messages, prioridade=INTERATIVA, rejeitar=True, prazo=None,
+                    tentativas=OLLAMA_RETRIES, **kwargs):
+        # O lugar fica ocupado até o stream terminar (ou ser fechado pelo consumidor).
+        # Só se repete a chamada se o erro acontecer antes do primeiro chunk.
+        kwargs = self._parametros(kwargs)
+        inicio, com_token = time.perf_counter(), False
+        for tentativa in range(tentativas):
+            self._antes_da_tentativa(tentativa, prazo)
+            produziu = False
+            try:
+                with self.slot(model, prioridade, rejeitar and tentativa == 0, prazo) as client:
+                    stream = client.chat(model=model, messages=messages, stream=True, **kwargs)
+                    try:
+                        for chunk in stream:
+                            com_token = self._medir(model, chunk, inicio, com_token)
+                            if not produziu:
+                                produziu = True
+                                self.breaker.sucesso()
+                            yield chunk
+                    finally:
+                        if hasattr(stream, 'close'):
+                            stream.close()
+            except Exception as e:
+                if not erro_transitorio(e):
+                    raise
+                self.breaker.falha()
+                if produziu or tentativa == tentativas - 1:
+                    raise
+                logging.warning(f"Erro transitório no stream do Ollama (tentativa {tentativa+1}): {e}")
+                continue
+            if not produziu:
+                self.breaker.sucesso()
+            return
+
+    async def chat_stream_async(self, model, messages, prioridade=INTERATIVA, rejeitar=True, prazo=None,
+                                tentativas=OLLAMA_RETRIES, executor=None, **kwargs):
+        # O mesmo que chat_stream, para o modo ASGI: a geração usa o AsyncClient e não ocupa nenhuma
+        # thread. Só a espera pela vez na fila corre numa thread do executor, para a prioridade e o
+        # limite por modelo serem partilhados com os pedidos síncronos.
+        loop = asyncio.get_running_loop()
+        kwargs = self._parametros(kwargs)
+        inicio_pedido, com_token = time.perf_counter(), False
+        if self._client_async is None:
+            self._client_async = ollama.AsyncClient(timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT))
+        for tentativa in range(tentativas):
+            pausa = self._pausa(tentativa, prazo)
+            if pausa:
+                await asyncio.sleep(pausa)
+            self.breaker.permitir()
+            produziu = False
+            try:
+                entrada = loop.run_in_executor(executor, self._entrar, model, prioridade, rejeitar and tentativa == 0, prazo)
+                try:
+                    st = await asyncio.shield(entrada)
+                except asyncio.CancelledError:
+                    # A espera continua na thread: o lugar é devolvido assim que for obtido
+                    entrada.add_done_callback(lambda f: f.cancelled() or f.exception() or self._sair(f.result(), time.time()))
+                    raise
+                inicio = time.time()
+                try:
+                    stream = await self._client_async.chat(model=model, messages=messages, stream=True, **kwargs)
+                    try:
+                        async for chunk in stream:
+                            com_token = self._medir(model, chunk, inicio_pedido, com_token)
+                            if not produziu:
+                                produziu = True
+                                self.breaker.sucesso()
+                            yield chunk
+                    finally:
+                        await stream.aclose()
+                finally:
+                    self._sair(st, inicio)
+            except Exception as e:
+                if not erro_transitorio(e):
+                    raise
+                self.breaker.falha()
+                if produziu or tentativa == tentativas - 1:
+                    raise
+                logging.warning(f"Erro transitório no stream do Ollama (tentativa {tentativa+1}): {e}")
+                continue
+            if not produziu:
+                self.breaker.sucesso()
+            return
+
+    def metrics(self):
+        with self._cond:
+            return {'concorrencia': self.concorrencia, 'fila_max': self.fila_max, 'circuito': self.breaker.metrics(),
+                    'modelos': {m: {'ativos': st['ativos'], 'em_espera': len(st['fila']), 'pedidos': st['pedidos'],
+                                    'rejeitados': st['rejeitados'], 'duracao_media_s': round(st['duracao_media'], 3),
+                                    'espera_max_s': round(st['espera_max'], 3)}
+                                for m, st in self._modelos.items()}}
@@ -0,0 +1,258 @@
+# Estado partilhado pelos pedidos (cancelamentos, notificações, estado dos jobs): em memória com um só
+# processo (LocalState) ou em SQLite com vários workers (SQLiteState), e os documentos JSON
+# (user_infos, settings) que cada worker copia para memória (SharedJsonDocument).
+import copy
+import json
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: os bloqueios de ficheiros ficam só entre threads do mesmo processo
+
+from armazenamento import PoolSQLite, load_data, sanitize_filename, save_data
+
+STATE_DB = 'state.db'  # estado partilhado entre workers (STATE_BACKEND=sqlite)
+STATE_TTL = 24 * 3600  # segundos que o estado de um job fica visível para os outros workers
+
+
+class LocalState:
+    # Estado partilhado pelos pedidos de um só processo: cancelamentos, notificações, estado dos jobs.
+    # Cada namespace (ns) é um dict chave -> valor; os contadores de versão dizem a quem tem uma cópia
+    # em memória quando recarregar. Com vários workers usar o SQLiteState (STATE_BACKEND=sqlite).
+    partilhado = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dados = {}  # ns -> {chave: (valor, expira)}
+        self._versoes = {}
+        self._bloqueios = {}
+
+    def _ler(self, ns, chave):
+        # Chamado com _lock adquirido
+        item = self._dados.get(ns, {}).get(chave)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self._dados[ns][chave]
+            return None
+        return item
+
+    def obter(self, ns, chave, omissao=None):
+        with self._lock:
+            item = self._ler(ns, chave)
+        return omissao if item is None else item[0]
+
+    def definir(self, ns, chave, valor, ttl=None):
+        with self._lock:
+            self._dados.setdefault(ns, {})[chave] = (valor, time.time() + ttl if ttl else None)
+
+    def remover(self, ns, chave):
+        with self._lock:
+            self._dados.get(ns, {}).pop(chave, None)
+
+    def retirar(self, ns, chave, omissao=None):
+        # Lê e apaga de forma atómica
+        with self._lock:
+            item = self._ler(ns, chave)
+            if item is not None:
+                del self._dados[ns][chave]
+        return omissao if item is None else item[0]
+
+    def juntar(self, ns, chave, campos):
+        # dict.update atómico (o valor guardado é substituído, nunca alterado no lugar)
+        with self._lock:
+            item = self._ler(ns, chave)
+            valor = dict(item[0]) if item else {}
+            valor.update(campos)
+            self._dados.setdefault(ns, {})[chave] = (valor, None)
+
+    def itens(self, ns):
+        with self._lock:
+            agora = time.time()
+            return {k: v for k, (v, expira) in self._dados.get(ns, {}).items() if expira is None or expira > agora}
+
+    def versao(self, ns):
+        with self._lock:
+            return self._versoes.get(ns, 0)
+
+    def incrementar(self, ns):
+        with self._lock:
+            self._versoes[ns] = self._versoes.get(ns, 0) + 1
+            return self._versoes[ns]
+
+    def bloqueio(self, nome):
+        # Exclusão mútua para escritas em ficheiros (aqui basta entre threads)
+        with self._lock:
+            return self._bloqueios.setdefault(nome, threading.Lock())
+
+
+ESQUEMA_ESTADO = """
+CREATE TABLE IF NOT EXISTS kv (
+    ns TEXT NOT NULL,
+    chave TEXT NOT NULL,
+    valor TEXT NOT NULL,
+    expira REAL,
+    PRIMARY KEY (ns, chave)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS versoes (
+    ns TEXT PRIMARY KEY,
+    versao INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteState:
+    # O mesmo que o LocalState, mas numa base de dados SQLite (WAL) partilhada por todos os workers
+    # do servidor. Os valores são guardados em JSON. bloqueio() coordena escritas em ficheiros entre
+    # processos com flock num ficheiro <path>.<nome>.lock.
+    partilhado = True
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.pool = PoolSQLite(path, ('journal_mode=WAL', 'synchronous=NORMAL'))
+        self._bloqueios = {}
+        self._bloqueios_lock = threading.Lock()
+        self._limpeza = 0
+        with self._ligacao() as con:
+            con.executescript(ESQUEMA_ESTADO)
+
+    def _ligacao(self):
+        return self.pool.ligacao()
+
+    @contextmanager
+    def _transacao(self):
+        with self._ligacao() as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                yield con
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            con.execute('COMMIT')
+
+    def _ler(self, con, ns, chave):
+        linha = con.execute("SELECT valor FROM kv WHERE ns = ? AND chave = ? AND (expira IS NULL OR expira > ?)",
+                            (ns, chave, time.time())).fetchone()
+        return None if linha is None else json.loads(linha[0])
+
+    def _escrever(self, con, ns, chave, valor, ttl=None):
+        agora = time.time()
+        con.execute("INSERT INTO kv (ns, chave, valor, expira) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(ns, chave) DO UPDATE SET valor = excluded.valor, expira = excluded.expira",
+                    (ns, chave, json.dumps(valor, ensure_ascii=False), agora + ttl if ttl else None))
+        if agora - self._limpeza > 60:
+            self._limpeza = agora
+            con.execute("DELETE FROM kv WHERE expira IS NOT NULL AND expira <= ?", (agora,))
+
+    def obter(self, ns, chave, omissao=None):
+        with self._ligacao() as con:
+            valor = self._ler(con, ns, chave)
+        return omissao if valor is None else valor
+
+    def definir(self, ns, chave, valor, ttl=None):
+        with self._ligacao() as con:
+            self._escrever(con, ns, chave, valor, ttl)
+
+    def remover(self, ns, chave):
+        with self._ligacao() as con:
+            con.execute("DELETE FROM kv WHERE ns = ? AND chave = ?", (ns, chave))
+
+    def retirar(self, ns, chave, omissao=None):
+        with self._transacao() as con:
+            valor = self._ler(con, ns, chave)
+            if valor is not None:
+                con.execute("DELETE FROM kv WHERE ns = ? AND chave = ?", (ns, chave))
+        return omissao if valor is None else valor
+
+    def juntar(self, ns, chave, campos):
+        with self._transacao() as con:
+            valor = self._ler(con, ns, chave) or {}
+            valor.update(campos)
+            self._escrever(con, ns, chave, valor)
+
+    def itens(self, ns):
+        with self._ligacao() as con:
+            return {chave: json.loads(valor) for chave, valor in con.execute(
+                "SELECT chave, valor FROM kv WHERE ns = ? AND (expira IS NULL OR expira > ?)", (ns, time.time()))}
+
+    def versao(self, ns):
+        with self._ligacao() as con:
+            linha = con.execute("SELECT versao FROM versoes WHERE ns = ?", (ns,)).fetchone()
+        return linha[0] if linha else 0
+
+    def incrementar(self, ns):
+        with self._transacao() as con:
+            con.execute("INSERT INTO versoes (ns, versao) VALUES (?, 1) "
+                        "ON CONFLICT(ns) DO UPDATE SET versao = versao + 1", (ns,))
+            return con.execute("SELECT versao FROM versoes WHERE ns = ?", (ns,)).fetchone()[0]
+
+    @contextmanager
+    def bloqueio(self, nome):
+        # Entre threads (lock) e entre processos (flock, libertado ao fechar o ficheiro)
+        with self._bloqueios_lock:
+            lock = self._bloqueios.setdefault(nome, threading.Lock())
+        with lock:
+            with open(f"{self.path}.{sanitize_filename(nome)}.lock", 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield
+
+
+STATE_BACKENDS = {'local': LocalState, 'sqlite': SQLiteState}
+
+
+class SharedJsonDocument:
+    # Um dict em memória (user_infos, settings) gravado num ficheiro JSON. Com estado partilhado cada
+    # worker tem a sua cópia: gravar() junta as chaves de topo que este worker alterou com o que está
+    # no ficheiro (sob o bloqueio entre processos) em vez de o substituir, e sincronizar() recarrega a
+    # cópia quando outro worker gravou. Alterações locais ainda por gravar nunca são descartadas.
+    def __init__(self, nome, path, dados, lock, estado, ao_recarregar=None):
+        self.nome = nome
+        self.path = path
+        self.dados = dados
+        self.lock = lock  # protege `dados` (ex: user_infos_lock)
+        self.estado = estado
+        self.ao_recarregar = ao_recarregar
+        self._base = copy.deepcopy(dados)  # o ficheiro tal como este worker o viu pela última vez
+        self._versao = estado.versao('doc:' + nome)
+
+    def _aplicar(self, disco, referencia):
+        # O que em memória ainda é igual à referência passa a ser o que está no disco
+        with self.lock:
+            for chave in set(self.dados) | set(disco):
+                if self.dados.get(chave) != referencia.get(chave):
+                    continue  # alterado aqui e ainda não gravado
+                if chave in disco:
+                    self.dados[chave] = copy.deepcopy(disco[chave])
+                else:
+                    self.dados.pop(chave, None)
+        self._base = disco
+        if self.ao_recarregar:
+            self.ao_recarregar()
+
+    def gravar(self):
+        with self.lock:
+            local = copy.deepcopy(self.dados)
+        if not self.estado.partilhado:
+            save_data(self.path, local)
+            return
+        with self.estado.bloqueio(self.nome):
+            disco = load_data(self.path)
+            for chave in set(local) | set(self._base):
+                if local.get(chave) == self._base.get(chave):
+                    continue
+                if chave in local:
+                    disco[chave] = local[chave]
+                else:
+                    disco.pop(chave, None)
+            save_data(self.path, disco)
+            self._versao = self.estado.incrementar('doc:' + self.nome)
+            self._aplicar(disco, local)
+
+    def sincronizar(self):
+        # Sem alterações noutros workers só lê um contador
+        if not self.estado.partilhado or self.estado.versao('doc:' + self.nome) == self._versao:
+            return
+        with self.estado.bloqueio(self.nome):
+            self._versao = self.estado.versao('doc:' + self.nome)
+            self._aplicar(load_data(self.path), self._base)
@@ -0,0 +1,72 @@
+# Fila limitada de tarefas em segundo plano, com threads próprias. O app tem uma para o trabalho
+# depois das respostas (tarefas), uma para as análises das mensagens e uma para a indexação de ficheiros.
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+TASK_WORKERS = 2  # threads para tarefas em segundo plano
+TASK_QUEUE_MAX = 100  # tarefas em espera antes de rejeitar novas
+
+
+class BackgroundTaskQueue:
+    # Fila limitada de tarefas em segundo plano (write-behind) com deduplicação por chave.
+    # Tarefas com a mesma chave ainda pendentes partilham o mesmo Future.
+    def __init__(self, workers=TASK_WORKERS, maxsize=TASK_QUEUE_MAX, nome='tarefas'):
+        self._fila = queue.Queue(maxsize)
+        self._pendentes = {}
+        self._lock = threading.Lock()
+        self._em_curso = 0
+        self.stats = {'submetidas': 0, 'concluidas': 0, 'falhadas': 0, 'deduplicadas': 0, 'rejeitadas': 0}
+        self.workers = workers
+        self.nome = nome
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f'{nome}-{i}', daemon=True)
+            t.start()
+
+    def submit(self, key, fn, *args, **kwargs):
+        # Devolve um Future, ou None se a fila estiver cheia (o chamador decide o que fazer)
+        with self._lock:
+            if key in self._pendentes:
+                self.stats['deduplicadas'] += 1
+                return self._pendentes[key]
+            fut = Future()
+            try:
+                self._fila.put_nowait((key, fut, fn, args, kwargs))
+            except queue.Full:
+                self.stats['rejeitadas'] += 1
+                logging.warning(f"Fila de {self.nome} cheia, tarefa rejeitada: {key}")
+                return None
+            self._pendentes[key] = fut
+            self.stats['submetidas'] += 1
+            return fut
+
+    def _worker(self):
+        while True:
+            key, fut, fn, args, kwargs = self._fila.get()
+            with self._lock:
+                self._em_curso += 1
+            try:
+                if fut.set_running_or_notify_cancel():
+                    try:
+                        fut.set_result(fn(*args, **kwargs))
+                        self.stats['concluidas'] += 1
+                    except Exception as e:
+                        logging.error(f"Erro na tarefa em segundo plano {key}: {e}")
+                        self.stats['falhadas'] += 1
+                        fut.set_exception(e)
+            finally:
+                with self._lock:
+                    self._em_curso -= 1
+                    self._pendentes.pop(key, None)
+                self._fila.task_done()
+
+    def tem_pendentes(self, cid):
+        # As chaves das tarefas de um chat são tuplos (tipo, cid, ...)
+        with self._lock:
+            return any(len(k) > 1 and k[1] == cid for k in self._pendentes)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, profundidade=self._fila.qsize(), em_curso=self._em_curso,
+                        capacidade=self._fila.maxsize, workers=self.workers)
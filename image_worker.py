@@ -0,0 +1,94 @@
+# Processo dedicado à geração de imagens (Stable Diffusion XL).
+# Corre fora do processo do Flask: o pipeline vive aqui e os pedidos de chat não ficam bloqueados.
+# Este módulo não importa o app, para que o processo filho arranque só com o necessário.
+import importlib
+import logging
+import os
+import queue
+
+SD_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+# Hook para testes e benchmarks: 'modulo:funcao' que devolve um pipeline com a interface do SDXL
+# (ex: 'benchmarks.pipeline_simulado:carregar'). Com ele o worker não importa o torch nem o diffusers.
+IMAGE_PIPELINE = os.environ.get('IMAGE_PIPELINE')
+
+
+class JobCancelado(Exception):
+    pass
+
+
+def carregar_pipeline(modelo=SD_MODEL):
+    if IMAGE_PIPELINE:
+        nome_modulo, _, funcao = IMAGE_PIPELINE.partition(':')
+        logging.warning(f"[image_worker] A usar o pipeline {IMAGE_PIPELINE} em vez do SDXL")
+        return getattr(importlib.import_module(nome_modulo), funcao)(modelo)
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+    if torch.cuda.is_available():
+        pipe = StableDiffusionXLPipeline.from_pretrained(modelo, torch_dtype=torch.float16)
+        return pipe.to("cuda")
+    pipe = StableDiffusionXLPipeline.from_pretrained(modelo, torch_dtype=torch.float32)
+    return pipe.to("cpu")
+
+
+def criar_gerador(pipe, seed):
+    # Seed fixa: o mesmo pedido gera a mesma imagem, o que torna a cache de artefactos válida
+    if IMAGE_PIPELINE:
+        return None  # o pipeline do hook trata da seed (ou ignora-a)
+    import torch
+    return torch.Generator(device=pipe.device).manual_seed(seed)
+
+
+def ler_cancelamentos(controlo, cancelados):
+    # Lê, sem bloquear, os ids de jobs cancelados enviados pelo processo principal
+    while True:
+        try:
+            cancelados.add(controlo.get_nowait())
+        except queue.Empty:
+            return
+
+
+def worker_main(worker_id, jobs, eventos, controlo, modelo=SD_MODEL):
+    # jobs: fila FIFO partilhada pelos workers; eventos: progresso/resultado para o processo principal;
+    # controlo: cancelamentos (cada worker tem a sua fila, o principal envia para todas)
+    pipe = None
+    cancelados = set()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        ler_cancelamentos(controlo, cancelados)
+        if job.get('tipo') == 'aquecer':
+            if pipe is None:
+                try:
+                    pipe = carregar_pipeline(modelo)
+                except Exception as e:
+                    logging.warning(f"[image_worker {worker_id}] Falha ao pré-carregar o pipeline: {e}")
+            continue
+        job_id = job['id']
+        if job_id in cancelados:
+            cancelados.discard(job_id)
+            eventos.put({'id': job_id, 'estado': 'cancelado'})
+            continue
+        eventos.put({'id': job_id, 'estado': 'a_gerar', 'passo': 0, 'total': job['passos'], 'worker': worker_id})
+        try:
+            if pipe is None:
+                pipe = carregar_pipeline(modelo)
+
+            def ao_fim_do_passo(p, passo, timestep, callback_kwargs):
+                eventos.put({'id': job_id, 'estado': 'a_gerar', 'passo': passo + 1, 'total': job['passos']})
+                ler_cancelamentos(controlo, cancelados)
+                if job_id in cancelados:
+                    raise JobCancelado()
+                return callback_kwargs
+
+            gerador = criar_gerador(pipe, job['seed'])
+            image = pipe(job['prompt'], num_inference_steps=job['passos'], generator=gerador,
+                         width=job['largura'], height=job['altura'],
+                         callback_on_step_end=ao_fim_do_passo).images[0]
+            image.save(job['output_path'])
+            eventos.put({'id': job_id, 'estado': 'concluido'})
+        except JobCancelado:
+            cancelados.discard(job_id)
+            eventos.put({'id': job_id, 'estado': 'cancelado'})
+        except Exception as e:
+            eventos.put({'id': job_id, 'estado': 'erro', 'erro': str(e)})
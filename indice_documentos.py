@@ -0,0 +1,398 @@
+# Ficheiros carregados nos chats: extração do texto, divisão em excertos e índice BM25 por chat,
+# com a indexação em segundo plano numa fila própria.
+import copy
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from armazenamento import load_data, sanitize_filename, save_data
+from conversas import CHAT_LOCK_STRIPES
+from fila_tarefas import BackgroundTaskQueue
+from instrumentacao import LockMedido
+
+DOCS_CHUNK_WORDS = 180  # palavras por excerto dos ficheiros carregados
+DOCS_CHUNK_OVERLAP = 30  # palavras repetidas entre excertos seguidos
+DOCS_TOP_K = 4  # excertos dos ficheiros do chat incluídos em cada prompt
+DOCS_TOKENS = 1200  # orçamento (estimado) para esses excertos
+DOCS_CACHE_CHATS = 32  # índices de chats mantidos em memória
+DOCS_WORKERS = 1  # threads de indexação dos ficheiros carregados (fila própria, separada das tarefas)
+DOCS_QUEUE_MAX = 50  # ficheiros à espera de indexação antes de rejeitar novos
+
+
+def estimar_tokens(texto):
+    # Estimativa sem tokenizer: ~4 caracteres por token (suficiente para o orçamento do contexto)
+    return len(texto) // 4 + 1
+
+
+def termos_pesquisa(texto):
+    # Palavras em minúsculas e sem acentos ("informação" e "informacao" são o mesmo termo)
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return re.findall(r'\w+', ''.join(c for c in texto if not unicodedata.combining(c)))
+
+
+def extrair_paginas(path):
+    # Gera (página, texto) sem carregar o ficheiro todo: o PDF é lido página a página (pypdf)
+    # e o TXT em blocos de linhas
+    if path.lower().endswith('.pdf'):
+        from pypdf import PdfReader
+        # Com um caminho o PdfReader lê o ficheiro todo para memória; com o ficheiro aberto lê só o
+        # que cada página precisa (o ficheiro fica aberto enquanto as páginas são lidas)
+        with open(path, 'rb') as f:
+            reader = PdfReader(f)
+            for numero, pagina in enumerate(reader.pages, start=1):
+                yield numero, pagina.extract_text() or ''
+        return
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        bloco = []
+        for linha in f:
+            bloco.append(linha)
+            if len(bloco) >= 200:
+                yield None, ''.join(bloco)
+                bloco = []
+        if bloco:
+            yield None, ''.join(bloco)
+
+
+def dividir_excertos(paginas, palavras=DOCS_CHUNK_WORDS, sobreposicao=DOCS_CHUNK_OVERLAP):
+    # Excertos de ~palavras palavras com sobreposição; só guarda em memória o excerto atual
+    atual = []
+    novas = 0  # palavras do excerto atual que ainda não saíram noutro excerto
+    pagina_inicio = None
+    for pagina, texto in paginas:
+        for palavra in texto.split():
+            if not atual:
+                pagina_inicio = pagina
+            atual.append(palavra)
+            novas += 1
+            if len(atual) >= palavras:
+                yield {'texto': ' '.join(atual), 'pagina': pagina_inicio}
+                atual = atual[-sobreposicao:] if sobreposicao else []
+                novas = 0
+                pagina_inicio = pagina
+    if novas:
+        yield {'texto': ' '.join(atual), 'pagina': pagina_inicio}
+
+
+def hash_ficheiro(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def ler_excertos(path):
+    # Gera (posição, excerto) de um ficheiro de excertos (uma linha JSON por excerto)
+    with open(path, 'rb') as f:
+        while True:
+            posicao = f.tell()
+            linha = f.readline()
+            if not linha:
+                return
+            yield posicao, json.loads(linha)
+
+
+def ler_excerto(path, posicao):
+    with open(path, 'rb') as f:
+        f.seek(posicao)
+        return json.loads(f.readline())
+
+
+class ChatDocumentIndex:
+    # Índice invertido (BM25) dos excertos dos ficheiros de um chat. O texto dos excertos fica em
+    # ficheiros .jsonl (um por conteúdo, <hash>.jsonl); em memória ficam só as listas de termos e a
+    # posição de cada excerto, e o texto é lido do disco apenas para os excertos devolvidos.
+    # Um ficheiro é indexado à parte (sem o lock do serviço) e depois junto ao índice do chat;
+    # substituir um ficheiro retira os seus excertos sem reler os outros.
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, pasta, ficheiros=None):
+        self.pasta = pasta  # onde ficam os ficheiros de excertos
+        self.ficheiros = ficheiros or {}  # nome -> {'hash', 'excertos', 'paginas'}
+        self._postings = {}
+        self._refs = []  # (ficheiro, hash, página, posição no ficheiro de excertos)
+        self._comprimentos = []
+        self._total = 0
+        for nome, info in list(self.ficheiros.items()):
+            try:
+                for posicao, excerto in ler_excertos(self.caminho_excertos(info['hash'])):
+                    self.indexar(nome, info['hash'], excerto, posicao)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Excertos de {nome} ilegíveis, ficheiro ignorado: {e}")
+                self._retirar(nome)
+
+    def caminho_excertos(self, hash_):
+        return os.path.join(self.pasta, hash_ + '.jsonl')
+
+    def indexar(self, nome, hash_, excerto, posicao):
+        i = len(self._refs)
+        termos = termos_pesquisa(excerto['texto'])
+        for termo in termos:
+            lista = self._postings.setdefault(termo, {})
+            lista[i] = lista.get(i, 0) + 1
+        self._refs.append((nome, hash_, excerto['pagina'], posicao))
+        self._comprimentos.append(len(termos))
+        self._total += len(termos)
+
+    def _retirar(self, nome):
+        # Renumera os excertos que ficam (em memória, sem voltar ao disco)
+        self.ficheiros.pop(nome, None)
+        manter = [i for i, ref in enumerate(self._refs) if ref[0] != nome]
+        if len(manter) == len(self._refs):
+            return
+        novos = {antigo: novo for novo, antigo in enumerate(manter)}
+        self._refs = [self._refs[i] for i in manter]
+        self._comprimentos = [self._comprimentos[i] for i in manter]
+        self._total = sum(self._comprimentos)
+        postings = {}
+        for termo, lista in self._postings.items():
+            lista = {novos[i]: tf for i, tf in lista.items() if i in novos}
+            if lista:
+                postings[termo] = lista
+        self._postings = postings
+
+    def adicionar(self, nome, hash_, parte):
+        # parte: ChatDocumentIndex só com o ficheiro `nome`. Devolve o hash substituído que deixou de
+        # ser usado (o seu ficheiro de excertos pode ser apagado) ou None
+        anterior = self.ficheiros.get(nome, {}).get('hash')
+        self._retirar(nome)
+        base = len(self._refs)
+        for termo, lista in parte._postings.items():
+            destino = self._postings.setdefault(termo, {})
+            for i, tf in lista.items():
+                destino[base + i] = tf
+        self._refs.extend(parte._refs)
+        self._comprimentos.extend(parte._comprimentos)
+        self._total += parte._total
+        self.ficheiros[nome] = parte.ficheiros[nome]
+        if anterior and anterior != hash_ and all(f['hash'] != anterior for f in self.ficheiros.values()):
+            return anterior
+        return None
+
+    def procurar(self, consulta, k):
+        # Devolve [(ficheiro, página, caminho do ficheiro de excertos, posição)]
+        n = len(self._refs)
+        if not n:
+            return []
+        media = self._total / n or 1
+        scores = {}
+        for termo in set(termos_pesquisa(consulta)):
+            lista = self._postings.get(termo)
+            if not lista:
+                continue
+            idf = math.log(1 + (n - len(lista) + 0.5) / (len(lista) + 0.5))
+            for i, tf in lista.items():
+                norm = tf + self.K1 * (1 - self.B + self.B * self._comprimentos[i] / media)
+                scores[i] = scores.get(i, 0) + idf * tf * (self.K1 + 1) / norm
+        melhores = heapq.nlargest(k, scores.items(), key=lambda s: s[1])
+        return [(nome, pagina, self.caminho_excertos(hash_), posicao)
+                for nome, hash_, pagina, posicao in (self._refs[i] for i, _ in melhores)]
+
+    def to_dict(self):
+        return {'ficheiros': self.ficheiros}
+
+
+class DocumentService:
+    # Ingestão dos ficheiros carregados (em segundo plano, numa fila própria para não atrasar a análise
+    # das mensagens na fila de tarefas) e pesquisa dos excertos relevantes. Por chat, em uploads/<chat_id>/:
+    # .indice_documentos.json com a lista dos ficheiros indexados e .excertos/<hash>.jsonl com os
+    # excertos de cada conteúdo, escritos à medida que o ficheiro é lido. O índice é carregado quando
+    # é preciso para uma LRU de DOCS_CACHE_CHATS chats; se a lista mudar (indexação noutro worker)
+    # é relido. O estado da indexação fica no estado partilhado.
+    # Locks: _lock protege só a LRU; o índice de cada chat tem um lock (striping) para a pesquisa e a
+    # junção de um ficheiro, ambas em memória. A leitura e a escrita dos ficheiros do índice são feitas
+    # sem estes locks; as escritas de indexações concorrentes são ordenadas pelo bloqueio 'documentos'.
+    NOME_INDICE = '.indice_documentos.json'
+    PASTA_EXCERTOS = '.excertos'
+
+    def __init__(self, pasta_chats, estado, max_chats=DOCS_CACHE_CHATS):
+        self.pasta_chats = pasta_chats  # uploads/: uma pasta por chat
+        self.max_chats = max_chats
+        self.estado = estado  # ns 'documentos': chat_id -> {ficheiro: 'a_indexar' | 'indexado' | 'erro: ...'}
+        self.fila = BackgroundTaskQueue(DOCS_WORKERS, DOCS_QUEUE_MAX, nome='documentos')
+        self._indices = OrderedDict()
+        self._mtimes = {}  # chat_id -> mtime do índice quando foi lido/gravado
+        self._lock = threading.Lock()
+        self._stripes = [LockMedido('documentos') for _ in range(CHAT_LOCK_STRIPES)]
+
+    def _lock_indice(self, chat_id):
+        return self._stripes[hash(chat_id) % len(self._stripes)]
+
+    def _caminho_indice(self, chat_id):
+        return os.path.join(self.pasta_chats, sanitize_filename(chat_id), self.NOME_INDICE)
+
+    def _pasta_excertos(self, chat_id):
+        return os.path.join(self.pasta_chats, sanitize_filename(chat_id), self.PASTA_EXCERTOS)
+
+    def _mtime(self, chat_id):
+        try:
+            return os.stat(self._caminho_indice(chat_id)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _indice(self, chat_id, criar=False):
+        # Chamado sem locks: o stat, a leitura e a construção do índice são feitos fora do _lock e só a
+        # troca na LRU o adquire. O mtime é lido antes do ficheiro, por isso uma gravação que aconteça
+        # entretanto faz o índice ser relido no pedido seguinte
+        mtime = self._mtime(chat_id)
+        with self._lock:
+            indice = self._indices.get(chat_id)
+            if indice is not None and self._mtimes.get(chat_id) == mtime:
+                self._indices.move_to_end(chat_id)
+                return indice
+        if mtime is None and not criar:
+            return None
+        dados = load_data(self._caminho_indice(chat_id))
+        if 'excertos' in dados:
+            dados = self._converter(chat_id, dados)
+            mtime = self._mtime(chat_id)
+        indice = ChatDocumentIndex(self._pasta_excertos(chat_id), dados.get('ficheiros'))
+        with self._lock:
+            self._indices[chat_id] = indice
+            self._mtimes[chat_id] = mtime
+            self._indices.move_to_end(chat_id)
+            while len(self._indices) > self.max_chats:
+                self._mtimes.pop(self._indices.popitem(last=False)[0], None)
+        return indice
+
+    def _converter(self, chat_id, dados):
+        # Índice no formato anterior, com o texto dos excertos no próprio .json: passa para .excertos/
+        pasta = self._pasta_excertos(chat_id)
+        os.makedirs(pasta, exist_ok=True)
+        ficheiros = dados.get('ficheiros', {})
+        for nome, info in ficheiros.items():
+            with open(os.path.join(pasta, info['hash'] + '.jsonl'), 'w', encoding='utf-8') as f:
+                for excerto in dados['excertos']:
+                    if excerto['ficheiro'] == nome:
+                        f.write(json.dumps({'texto': excerto['texto'], 'pagina': excerto['pagina']}, ensure_ascii=False) + '\n')
+        save_data(self._caminho_indice(chat_id), {'ficheiros': ficheiros})
+        return {'ficheiros': ficheiros}
+
+    def _marcar(self, chat_id, filename, valor):
+        self.estado.juntar('documentos', chat_id, {filename: valor})
+
+    def estados(self, chat_id):
+        return self.estado.obter('documentos', chat_id, {})
+
+    def submeter(self, chat_id, filename):
+        # Devolve 'inalterado' se o ficheiro já estiver indexado com o mesmo conteúdo
+        path = os.path.join(self.pasta_chats, sanitize_filename(chat_id), filename)
+        hash_ = hash_ficheiro(path)
+        indice = self._indice(chat_id)
+        if indice:
+            with self._lock_indice(chat_id):
+                if indice.ficheiros.get(filename, {}).get('hash') == hash_:
+                    return 'inalterado'
+        self._marcar(chat_id, filename, 'a_indexar')
+        if self.fila.submit(('indexar', chat_id, filename), self._ingerir, chat_id, filename, path, hash_) is None:
+            self._marcar(chat_id, filename, 'erro: fila de indexação cheia')
+            return 'erro'
+        return 'a_indexar'
+
+    def _extrair(self, pasta, filename, path, hash_):
+        # Lê o ficheiro e grava os excertos à medida que são gerados, indexando-os num índice só deste
+        # ficheiro; em memória fica só o excerto atual e as listas de termos
+        parte = ChatDocumentIndex(pasta)
+        destino = parte.caminho_excertos(hash_)
+        n, paginas = 0, set()
+        with tempfile.NamedTemporaryFile('wb', dir=pasta, suffix='.tmp', delete=False) as tf:
+            try:
+                for excerto in dividir_excertos(extrair_paginas(path)):
+                    parte.indexar(filename, hash_, excerto, tf.tell())
+                    tf.write(json.dumps(excerto, ensure_ascii=False).encode('utf-8') + b'\n')
+                    n += 1
+                    paginas.add(excerto['pagina'])
+                tf.flush()
+                os.fsync(tf.fileno())
+            except BaseException:
+                tf.close()
+                os.remove(tf.name)
+                raise
+        os.replace(tf.name, destino)
+        parte.ficheiros[filename] = {'hash': hash_, 'excertos': n, 'paginas': len(paginas - {None})}
+        return parte
+
+    def _ingerir(self, chat_id, filename, path, hash_):
+        inicio = time.time()
+        pasta = self._pasta_excertos(chat_id)
+        os.makedirs(pasta, exist_ok=True)
+        try:
+            parte = self._extrair(pasta, filename, path, hash_)
+        except ImportError:
+            self._marcar(chat_id, filename, 'erro: pypdf não instalado')
+            logging.warning("Indexação de PDFs indisponível: instale o pypdf")
+            return
+        except Exception as e:
+            self._marcar(chat_id, filename, f'erro: {e}')
+            logging.error(f"Erro ao indexar {filename} do chat {chat_id}: {e}")
+            return
+        with self.estado.bloqueio('documentos'):
+            # Relido se outro worker o gravou; gravado com o bloqueio: duas indexações no mesmo chat
+            # não podem gravar fora de ordem nem perder os ficheiros uma da outra. Só a lista dos
+            # ficheiros é regravada; os excertos já estão no seu ficheiro. A pesquisa não usa este
+            # bloqueio e só espera pela junção em memória
+            indice = self._indice(chat_id, criar=True)
+            with self._lock_indice(chat_id):
+                substituido = indice.adicionar(filename, hash_, parte)
+                dados = copy.deepcopy(indice.to_dict())
+            save_data(self._caminho_indice(chat_id), dados)
+            mtime = self._mtime(chat_id)
+            with self._lock:
+                if self._indices.get(chat_id) is indice:
+                    self._mtimes[chat_id] = mtime
+            if substituido:
+                try:
+                    os.remove(indice.caminho_excertos(substituido))
+                except OSError:
+                    pass
+        self._marcar(chat_id, filename, 'indexado')
+        logging.info(f"{filename} indexado no chat {chat_id}: {parte.ficheiros[filename]['excertos']} excertos "
+                     f"em {time.time() - inicio:.1f}s")
+
+    def contexto(self, chat_id, consulta, k=DOCS_TOP_K, orcamento=DOCS_TOKENS):
+        # Mensagem de sistema com os excertos mais relevantes que cabem no orçamento (None se não houver)
+        indice = self._indice(chat_id)
+        if indice is None:
+            return None
+        with self._lock_indice(chat_id):
+            encontrados = indice.procurar(consulta, k)
+        partes = []
+        for ficheiro, pagina, caminho, posicao in encontrados:
+            try:
+                texto = ler_excerto(caminho, posicao)['texto']
+            except (OSError, ValueError):
+                continue  # ficheiro substituído entretanto
+            origem = ficheiro + (f", p. {pagina}" if pagina else '')
+            parte = f"[{origem}] {texto}\n"
+            custo = estimar_tokens(parte)
+            if custo > orcamento:
+                break
+            orcamento -= custo
+            partes.append(parte)
+        if not partes:
+            return None
+        return {'role': 'system', 'content': "Excertos dos ficheiros carregados neste chat (usa-os se forem relevantes para a pergunta):\n" + ''.join(partes)}
+
+    def remover_chat(self, chat_id):
+        with self._lock:
+            self._indices.pop(chat_id, None)
+            self._mtimes.pop(chat_id, None)
+        self.estado.remover('documentos', chat_id)
+
+    def metrics(self):
+        estados = {}
+        for ficheiros in self.estado.itens('documentos').values():
+            for e in ficheiros.values():
+                estados[e.split(':')[0]] = estados.get(e.split(':')[0], 0) + 1
+        with self._lock:
+            return {'chats_em_memoria': len(self._indices), 'ficheiros': estados, 'fila': self.fila.metrics()}
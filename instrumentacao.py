@@ -0,0 +1,157 @@
+# Métricas do processo (contadores, histogramas e medidores) exportadas em /metrics, e locks que
+# registam a espera para os adquirir. Não importa o app: os outros módulos usam o registo `metricas`.
+import bisect
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Metricas:
+    # Registo de métricas em memória (contadores e histogramas), exportado em /metrics no formato de
+    # texto do Prometheus. Os medidores (profundidade das filas, pedidos ativos) são funções lidas só
+    # na exportação. Com vários workers cada processo tem o seu registo.
+    LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metricas = OrderedDict()  # nome -> {'tipo', 'ajuda', 'limites', 'series'}
+        self._medidores = []
+        # Etapas do pedido HTTP atual (para o cabeçalho Server-Timing); None fora de um pedido
+        self._pedido = contextvars.ContextVar('metricas_pedido', default=None)
+
+    def contador(self, nome, ajuda):
+        self._metricas[nome] = {'tipo': 'counter', 'ajuda': ajuda, 'limites': None, 'series': {}}
+
+    def histograma(self, nome, ajuda, limites=LIMITES_SEGUNDOS):
+        self._metricas[nome] = {'tipo': 'histogram', 'ajuda': ajuda, 'limites': tuple(limites), 'series': {}}
+
+    def medidor(self, fn):
+        # fn() devolve [(nome, ajuda, {etiquetas}, valor)]
+        self._medidores.append(fn)
+        return fn
+
+    def contar(self, nome, valor=1, **etiquetas):
+        chave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            series = self._metricas[nome]['series']
+            series[chave] = series.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **etiquetas):
+        chave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            m = self._metricas[nome]
+            serie = m['series'].get(chave)
+            if serie is None:
+                serie = m['series'][chave] = {'contagens': [0] * (len(m['limites']) + 1), 'soma': 0.0}
+            serie['contagens'][bisect.bisect_left(m['limites'], valor)] += 1
+            serie['soma'] += valor
+
+    def iniciar_pedido(self, ativo):
+        # Chamado no início de cada pedido: as threads dos servidores são reutilizadas entre pedidos
+        self._pedido.set([] if ativo else None)
+
+    def etapas_pedido(self):
+        return self._pedido.get()
+
+    def registar_etapa(self, nome, duracao):
+        self.observar('chatbot_etapa_segundos', duracao, etapa=nome)
+        etapas = self._pedido.get()
+        if etapas is not None:
+            etapas.append((nome, duracao))
+
+    @contextmanager
+    def etapa(self, nome):
+        # Span: mede o bloco e regista-o no histograma das etapas (e no Server-Timing do pedido)
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registar_etapa(nome, time.perf_counter() - inicio)
+
+    @staticmethod
+    def _etiquetas(chave, extra=()):
+        pares = list(chave) + list(extra)
+        if not pares:
+            return ''
+        valores = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pares)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pares, valores)) + '}'
+
+    def exportar(self):
+        linhas = []
+        with self._lock:
+            for nome, m in self._metricas.items():
+                linhas += [f"# HELP {nome} {m['ajuda']}", f"# TYPE {nome} {m['tipo']}"]
+                for chave, serie in m['series'].items():
+                    if m['tipo'] == 'counter':
+                        linhas.append(f"{nome}{self._etiquetas(chave)} {serie}")
+                        continue
+                    acumulado = 0
+                    for limite, n in zip(m['limites'] + (math.inf,), serie['contagens']):
+                        acumulado += n
+                        le = '+Inf' if limite == math.inf else f'{limite:g}'
+                        linhas.append(f"{nome}_bucket{self._etiquetas(chave, [('le', le)])} {acumulado}")
+                    linhas.append(f"{nome}_sum{self._etiquetas(chave)} {serie['soma']:.6f}")
+                    linhas.append(f"{nome}_count{self._etiquetas(chave)} {acumulado}")
+        # Medidores fora do lock: leem o estado de outros componentes
+        medidores = OrderedDict()
+        for fn in self._medidores:
+            try:
+                for nome, ajuda, etiquetas, valor in fn():
+                    medidores.setdefault(nome, (ajuda, []))[1].append((etiquetas, valor))
+            except Exception as e:
+                logging.warning(f"Erro ao ler o medidor {fn.__name__}: {e}")
+        for nome, (ajuda, valores) in medidores.items():
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} gauge"]
+            linhas += [f"{nome}{self._etiquetas(tuple(sorted(etiquetas.items())))} {valor}" for etiquetas, valor in valores]
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = Metricas()
+metricas.histograma('chatbot_etapa_segundos', 'Duração de cada etapa do processamento de um pedido')
+metricas.histograma('chatbot_ollama_chamada_segundos', 'Duração das chamadas ao Ollama (sem stream), incluindo a fila')
+metricas.histograma('chatbot_ollama_fila_segundos', 'Espera por um lugar livre no Ollama')
+metricas.histograma('chatbot_ollama_ttft_segundos', 'Tempo até ao primeiro token das respostas em streaming')
+metricas.histograma('chatbot_ollama_tokens_por_segundo', 'Velocidade de geração reportada pelo Ollama',
+                    limites=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400))
+metricas.contador('chatbot_ollama_tokens_total', 'Tokens gerados pelo Ollama nas respostas em streaming')
+metricas.histograma('chatbot_lock_espera_segundos', 'Espera para adquirir os locks partilhados',
+                    limites=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1))
+metricas.contador('chatbot_persistencia_bytes_total', 'Bytes escritos nos ficheiros JSON de dados')
+metricas.histograma('chatbot_persistencia_escrita_segundos', 'Duração de cada escrita segura (inclui fsync)')
+metricas.histograma('chatbot_imagem_fila_segundos', 'Espera dos jobs de imagem até um worker os começar')
+metricas.histograma('chatbot_imagem_geracao_segundos', 'Duração da inferência SDXL por job de imagem',
+                    limites=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+metricas.contador('chatbot_pedidos_total', 'Pedidos HTTP por rota e código de resposta')
+metricas.histograma('chatbot_pedido_segundos', 'Duração dos pedidos HTTP até à resposta (sem o corpo em streaming)')
+
+
+class LockMedido:
+    # Lock que regista a espera para o adquirir (chatbot_lock_espera_segundos{lock=nome}).
+    # Uma aquisição sem contenção conta como espera 0.
+    def __init__(self, nome):
+        self.nome = nome
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            metricas.observar('chatbot_lock_espera_segundos', 0.0, lock=self.nome)
+            return True
+        if not blocking:
+            return False
+        inicio = time.perf_counter()
+        adquirido = self._lock.acquire(True, timeout)
+        metricas.observar('chatbot_lock_espera_segundos', time.perf_counter() - inicio, lock=self.nome)
+        return adquirido
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
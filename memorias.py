@@ -0,0 +1,160 @@
+# Índice vetorial das memórias dos utilizadores e backends de embeddings (Ollama ou feature hashing).
+import hashlib
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from escalonador_ollama import OllamaScheduler
+
+MEMORY_INDEX_FILE = 'memory_index.npz'  # embeddings das memórias (cache; reconstruída se faltar)
+EMBED_MODEL = os.environ.get('EMBED_MODEL', 'nomic-embed-text')  # modelo de embeddings do Ollama
+MEMORY_TOP_K = 5  # memórias mais relevantes incluídas em cada prompt
+
+
+class OllamaEmbeddings:
+    # Embeddings por um modelo local do Ollama (passa pelo ollama_pool: fila, retries e circuit breaker)
+    limiar_duplicada = 0.92  # similaridade a partir da qual duas memórias dizem o mesmo
+    limiar_relevante = 0.35  # similaridade mínima para uma memória entrar no prompt
+
+    def __init__(self, pool, modelo=EMBED_MODEL):
+        self.pool = pool
+        self.nome = f"ollama:{modelo}"
+        self.modelo = modelo
+
+    def embed(self, textos, prioridade=OllamaScheduler.AUXILIAR):
+        resposta = self.pool.embed(self.modelo, textos, prioridade=prioridade)
+        return np.asarray(resposta['embeddings'], dtype=np.float32)
+
+
+class HashEmbeddings:
+    # Alternativa sem modelo: saco de palavras e bigramas com feature hashing (crc32, estável entre
+    # processos). Só apanha sobreposição de palavras, mas não depende do Ollama.
+    limiar_duplicada = 0.9
+    limiar_relevante = 0.1
+
+    def __init__(self, pool=None, dimensoes=1024):
+        # pool não é usado; mesma assinatura do OllamaEmbeddings para EMBEDDING_BACKENDS
+        self.nome = f"hash:{dimensoes}"
+        self.dimensoes = dimensoes
+
+    def embed(self, textos, prioridade=None):
+        matriz = np.zeros((len(textos), self.dimensoes), dtype=np.float32)
+        for i, texto in enumerate(textos):
+            palavras = re.findall(r'\w+', texto.lower())
+            for termo in palavras + [a + ' ' + b for a, b in zip(palavras, palavras[1:])]:
+                matriz[i, zlib.crc32(termo.encode('utf-8')) % self.dimensoes] += 1
+        return matriz
+
+
+EMBEDDING_BACKENDS = {'ollama': OllamaEmbeddings, 'hash': HashEmbeddings}
+
+
+class MemoryIndex:
+    # Índice vetorial das memórias dos utilizadores. O texto das memórias continua em
+    # user_infos[...]['memorias_resumidas'] (a UI e os endpoints de apagar usam-no); aqui ficam os
+    # embeddings normalizados, indexados pelo hash do texto, e uma matriz por utilizador alinhada
+    # com essa lista, reconstruída só quando a lista muda. A similaridade é o produto interno.
+    def __init__(self, backend, persistencia, path=MEMORY_INDEX_FILE):
+        self.backend = backend
+        self.persistencia = persistencia  # marcado como sujo quando há embeddings novos a gravar
+        self.path = path
+        self._lock = threading.Lock()
+        self._vetores = {}  # sha1(texto) -> vetor normalizado
+        self._matrizes = {}  # user_id -> (chaves, matriz)
+        self.stats = {'embeddings': 0, 'duplicadas': 0, 'pesquisas': 0, 'falhas': 0}
+        self._carregar()
+
+    @staticmethod
+    def _chave(texto):
+        return hashlib.sha1(texto.encode('utf-8')).hexdigest()
+
+    def _carregar(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as dados:
+                if str(dados['backend']) != self.backend.nome:
+                    logging.info(f"Backend de embeddings mudou para {self.backend.nome}; índice de memórias será reconstruído")
+                    return
+                self._vetores = dict(zip(dados['chaves'].tolist(), dados['vetores']))
+        except Exception as e:
+            logging.warning(f"Falha ao carregar {self.path}: {e}")
+
+    def guardar(self, textos_ativos):
+        # Grava os embeddings ainda em uso (os de memórias apagadas são descartados)
+        ativos = {self._chave(t) for t in textos_ativos}
+        with self._lock:
+            self._vetores = {k: v for k, v in self._vetores.items() if k in ativos}
+            chaves = list(self._vetores)
+            vetores = np.stack([self._vetores[k] for k in chaves]) if chaves else np.zeros((0, 0), np.float32)
+        tmp = f"{self.path}.{os.getpid()}.tmp"  # vários workers podem gravar ao mesmo tempo
+        with open(tmp, 'wb') as f:
+            np.savez(f, backend=np.array(self.backend.nome), chaves=np.array(chaves), vetores=vetores)
+        os.replace(tmp, self.path)
+
+    def _embed(self, textos, prioridade=OllamaScheduler.AUXILIAR):
+        # Chamado sem o lock (pode demorar); devolve vetores normalizados
+        matriz = self.backend.embed(textos, prioridade=prioridade)
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        normas[normas == 0] = 1
+        self.stats['embeddings'] += len(textos)
+        return matriz / normas
+
+    def _matriz(self, user_id, textos):
+        chaves = tuple(self._chave(t) for t in textos)
+        with self._lock:
+            em_cache = self._matrizes.get(user_id)
+            if em_cache and em_cache[0] == chaves:
+                return em_cache[1]
+            em_falta = [t for t, k in zip(textos, chaves) if k not in self._vetores]
+        if em_falta:
+            novos = self._embed(em_falta)
+            with self._lock:
+                for texto, vetor in zip(em_falta, novos):
+                    self._vetores[self._chave(texto)] = vetor
+            self.persistencia.marcar_sujo('memorias')
+        with self._lock:
+            matriz = np.stack([self._vetores[k] for k in chaves]) if chaves else None
+            self._matrizes[user_id] = (chaves, matriz)
+        return matriz
+
+    def duplicada(self, user_id, textos, frase):
+        # True se a frase já existir ou for quase igual (cosseno) a uma memória existente
+        if frase in textos:
+            return True
+        matriz = self._matriz(user_id, textos)
+        if matriz is None:
+            return False
+        vetor = self._embed([frase])[0]
+        with self._lock:
+            self._vetores[self._chave(frase)] = vetor
+        self.persistencia.marcar_sujo('memorias')
+        if float(np.max(matriz @ vetor)) >= self.backend.limiar_duplicada:
+            self.stats['duplicadas'] += 1
+            return True
+        return False
+
+    def relevantes(self, user_id, textos, consulta, k=MEMORY_TOP_K):
+        # As k memórias mais próximas da mensagem atual, pela ordem em que foram guardadas
+        if len(textos) <= k:
+            return list(textos)
+        self.stats['pesquisas'] += 1
+        try:
+            matriz = self._matriz(user_id, textos)
+            vetor = self._embed([consulta], prioridade=OllamaScheduler.INTERATIVA)[0]
+        except Exception as e:
+            # Sem embeddings (ex: Ollama indisponível): as memórias mais recentes
+            self.stats['falhas'] += 1
+            logging.warning(f"Pesquisa de memórias indisponível: {e}")
+            return list(textos[-k:])
+        scores = matriz @ vetor
+        melhores = np.argsort(-scores)[:k]
+        return [textos[i] for i in sorted(melhores) if scores[i] >= self.backend.limiar_relevante]
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, backend=self.backend.nome, vetores=len(self._vetores))
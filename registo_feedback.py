@@ -0,0 +1,143 @@
+# Feedback dos utilizadores: log append-only (JSONL, com fsync) e índice em memória com contadores por tema.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from armazenamento import load_data
+from instrumentacao import metricas
+
+FEEDBACK_LOG = 'feedback_log.jsonl'
+
+
+class FeedbackStore:
+    # Feedback em memória, indexado por um hash de (utilizador, mensagem, resposta), com contadores
+    # positivo/negativo por tema atualizados em cada upsert. Cada upsert acrescenta uma linha ao
+    # log (JSONL, com fsync); no arranque o log é relido (a última linha de cada chave ganha) e,
+    # se tiver demasiadas linhas substituídas, é reescrito só com o estado atual.
+    # Vários workers podem partilhar o log: as escritas são feitas sob o bloqueio do estado e cada
+    # worker lê as linhas que os outros acrescentaram (ou relê tudo se o log foi reescrito).
+    def __init__(self, estado, path=FEEDBACK_LOG):
+        self.path = path
+        self.estado = estado
+        self._lock = threading.Lock()
+        self._itens = {}
+        self._contadores = {}
+        self._linhas = 0
+        self._posicao = 0  # bytes do log já lidos
+        self._inode = None
+        with self._lock, self.estado.bloqueio('feedback'):
+            self._log = open(self.path, 'ab')
+            self._acompanhar()
+            if self._linhas > 2 * len(self._itens) + 100:
+                self._reescrever()
+
+    @staticmethod
+    def chave(user_id, mensagem_usuario, resposta_ai):
+        return hashlib.sha1(json.dumps([user_id, mensagem_usuario, resposta_ai], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _contar(self, item, delta):
+        contadores = self._contadores.setdefault(item['tema'], {"positivo": 0, "negativo": 0})
+        if item['feedback'] in contadores:
+            contadores[item['feedback']] += delta
+
+    def _aplicar(self, item):
+        antigo = self._itens.get(item['chave'])
+        if antigo is not None:
+            self._contar(antigo, -1)
+        self._itens[item['chave']] = item
+        self._contar(item, 1)
+
+    def _acompanhar(self):
+        # Aplica as linhas acrescentadas desde a última leitura. Chamado com _lock e o bloqueio adquiridos
+        info = os.stat(self.path)
+        if info.st_ino != self._inode or info.st_size < self._posicao:
+            # Primeira leitura, ou o log foi reescrito por outro worker: reler tudo
+            self._itens, self._contadores, self._linhas, self._posicao = {}, {}, 0, 0
+            if self._inode is not None:
+                self._log.close()
+                self._log = open(self.path, 'ab')
+            self._inode = os.fstat(self._log.fileno()).st_ino
+        if info.st_size == self._posicao:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._posicao)
+            novos = f.read()
+        # Só linhas completas; uma linha sem fim fica para a próxima leitura
+        novos = novos[:novos.rfind(b'\n') + 1]
+        self._posicao += len(novos)
+        for linha in novos.splitlines():
+            try:
+                self._aplicar(json.loads(linha))
+            except (json.JSONDecodeError, KeyError):
+                # Linha incompleta (o processo morreu a meio da escrita)
+                continue
+            self._linhas += 1
+
+    def _reescrever(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for item in self._itens.values():
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._linhas = len(self._itens)
+        # O ficheiro antigo foi substituído: voltar a abrir o log
+        self._log.close()
+        self._log = open(self.path, 'ab')
+        self._inode = os.fstat(self._log.fileno()).st_ino
+        self._posicao = os.fstat(self._log.fileno()).st_size
+
+    def migrar_json(self, file_path):
+        # Migração única do antigo feedback_data.json ({user: {tema: [itens]}})
+        if not os.path.exists(file_path) or self._itens:
+            return
+        antigos = load_data(file_path)
+        with self._lock, self.estado.bloqueio('feedback'):
+            self._acompanhar()
+            if self._itens:
+                return
+            for user_id, temas in antigos.items():
+                for tema, itens in temas.items():
+                    for item in itens:
+                        self._aplicar(dict(item, tema=tema, user_id=user_id,
+                                           chave=self.chave(user_id, item.get('mensagem_usuario', ''), item.get('resposta_ai', ''))))
+            self._reescrever()
+        os.replace(file_path, file_path + '.migrado')
+        logging.info(f"{len(self._itens)} feedbacks migrados de {file_path} para {self.path}")
+
+    def upsert(self, user_id, tema, feedback, comentario, mensagem_usuario, resposta_ai):
+        item = {
+            "chave": self.chave(user_id, mensagem_usuario, resposta_ai),
+            "user_id": user_id,
+            "tema": tema,
+            "mensagem_usuario": mensagem_usuario,
+            "resposta_ai": resposta_ai,
+            "feedback": feedback,
+            "comentario": comentario,
+            "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        linha = (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock, self.estado.bloqueio('feedback'):
+            self._acompanhar()
+            # Primeiro o log: só depois de gravado o feedback conta
+            inicio = time.perf_counter()
+            self._log.write(linha)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._posicao = os.fstat(self._log.fileno()).st_size
+            nome = os.path.basename(self.path)
+            metricas.contar('chatbot_persistencia_bytes_total', len(linha), ficheiro=nome)
+            metricas.observar('chatbot_persistencia_escrita_segundos', time.perf_counter() - inicio, ficheiro=nome)
+            self._linhas += 1
+            self._aplicar(item)
+            if self._linhas > 2 * len(self._itens) + 100:
+                self._reescrever()
+
+    def stats(self):
+        with self._lock, self.estado.bloqueio('feedback'):
+            self._acompanhar()
+            return {tema: dict(c) for tema, c in self._contadores.items()}
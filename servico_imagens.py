@@ -0,0 +1,280 @@
+# Jobs de geração de imagens: fila, progresso e cancelamento, com os processos do image_worker.py
+# a gerar e a cache de artefactos a guardar o resultado.
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from armazenamento import sanitize_filename
+from cache_artefactos import ArtifactStore
+from estado_partilhado import STATE_TTL
+from instrumentacao import metricas
+
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 1))  # processos de geração de imagens (1..N)
+IMAGE_STEPS = 30  # passos de inferência por imagem
+IMAGE_JOBS_MAX = 500  # jobs de imagem guardados para consulta
+IMAGE_SEED = int(os.environ.get('IMAGE_SEED', 0))  # seed por omissão: o mesmo prompt dá a mesma imagem (e acerta na cache)
+IMAGE_SIZE = 1024  # largura/altura por omissão (SDXL)
+
+
+class ImageJobService:
+    # Geração de imagens em processos dedicados (image_worker.py), que são donos do pipeline SDXL.
+    # Os jobs entram numa fila FIFO; o progresso de cada passo chega por uma fila de eventos e é
+    # recolhido por uma thread deste processo. Os workers só arrancam no primeiro pedido.
+    # Com estado partilhado (vários workers do servidor) o estado de cada job é publicado no estado,
+    # para que qualquer worker responda a consultas e cancelamentos; o dono do job aplica os
+    # cancelamentos pedidos noutro worker.
+    TERMINAIS = ('concluido', 'erro', 'cancelado')
+
+    def __init__(self, artefactos, estado, workers=IMAGE_WORKERS, ao_terminar=None):
+        self.artefactos = artefactos
+        self.partilhado = estado if estado.partilhado else None
+        self._verificado = 0
+        self.n_workers = max(1, workers)
+        self.ao_terminar = ao_terminar  # chamado com o job terminado; devolve o texto final para o chat
+        self.jobs = OrderedDict()
+        self._cond = threading.Condition()
+        self._iniciado = False
+        self._processos = []
+        self._controlo = []
+
+    def _iniciar(self):
+        # Chamado com _cond adquirido
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')
+        self._ctx = ctx
+        self._fila = ctx.Queue()
+        self._eventos = ctx.Queue()
+        for i in range(self.n_workers):
+            self._lancar_worker(i)
+        threading.Thread(target=self._recolher, name='imagens-eventos', daemon=True).start()
+        self._iniciado = True
+
+    def _lancar_worker(self, i):
+        import image_worker
+        controlo = self._ctx.Queue()
+        p = self._ctx.Process(target=image_worker.worker_main, args=(i, self._fila, self._eventos, controlo),
+                              name=f'image-worker-{i}', daemon=True)
+        # Com 'spawn' o filho reexecuta o módulo __main__ (o app.py: Flask, base de dados, threads...).
+        # Durante o start o __main__ aponta para o image_worker, que é leve e não tem efeitos colaterais.
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = image_worker
+        try:
+            p.start()
+        finally:
+            sys.modules['__main__'] = main
+        if i < len(self._processos):
+            self._processos[i], self._controlo[i] = p, controlo
+        else:
+            self._processos.append(p)
+            self._controlo.append(controlo)
+
+    def _publico(self, job):
+        return {k: v for k, v in job.items() if k != 'output_path'}
+
+    def submeter(self, prompt, chat_id, block_idx=None, passos=IMAGE_STEPS, seed=IMAGE_SEED,
+                 largura=IMAGE_SIZE, altura=IMAGE_SIZE):
+        import image_worker
+        chave = ArtifactStore.chave('imagem', image_worker.SD_MODEL, prompt, seed, f'{largura}x{altura}', passos)
+        filename = ArtifactStore.nome_publico(chave, 'imagem', 'png')
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'estado': 'em_fila', 'chat_id': chat_id, 'block_idx': block_idx,
+               'url': f"/files/{sanitize_filename(chat_id)}/{filename}", 'chave': chave, 'output_path': None,
+               'passo': 0, 'total': passos, 'erro': None, 'ai_text': None, 'cache': False,
+               'versao': 0, 'criado': time.time(), 'iniciado': None}
+        if self.artefactos.publicar(chave, 'png', chat_id, 'imagem'):
+            # Já foi gerada antes: o job nasce concluído, sem passar pelos workers
+            job.update(estado='concluido', passo=passos, cache=True)
+            with self._cond:
+                self.jobs[job_id] = job
+                self._podar()
+                self._publicar(job)
+            self._terminar(job)
+            return self.estado(job_id)
+        job['output_path'] = self.artefactos.caminho_temporario(chave, 'png')
+        with self._cond:
+            if not self._iniciado:
+                self._iniciar()
+            self.jobs[job_id] = job
+            self._podar()
+            self._publicar(job)
+            self._fila.put({'id': job_id, 'prompt': prompt, 'output_path': job['output_path'], 'passos': passos,
+                            'seed': seed, 'largura': largura, 'altura': altura})
+            return self._publico(job)
+
+    def _guardar_artefacto(self, job):
+        # O worker escreveu num ficheiro temporário: passa para a cache e fica visível no chat
+        try:
+            self.artefactos.adicionar(job['chave'], job['output_path'], 'png')
+            if not self.artefactos.publicar(job['chave'], 'png', job['chat_id'], 'imagem', contar=False):
+                raise IOError('artefacto descartado da cache antes de ser publicado')
+        except Exception as e:
+            logging.error(f"Erro ao guardar a imagem do job {job['id']}: {e}")
+            with self._cond:
+                self._atualizar(job, {'estado': 'erro', 'erro': str(e)})
+
+    def _podar(self):
+        # Mantém no máximo IMAGE_JOBS_MAX jobs, descartando primeiro os terminados mais antigos
+        excesso = len(self.jobs) - IMAGE_JOBS_MAX
+        for job_id in [j for j, job in self.jobs.items() if job['estado'] in self.TERMINAIS][:max(0, excesso)]:
+            del self.jobs[job_id]
+
+    def _publicar(self, job):
+        # Chamado com _cond adquirido
+        if self.partilhado:
+            self.partilhado.definir('imagens', job['id'], self._publico(job), ttl=STATE_TTL)
+
+    def _remoto(self, job_id):
+        # Job de outro worker (None sem estado partilhado)
+        return self.partilhado.obter('imagens', job_id) if self.partilhado else None
+
+    def estado(self, job_id):
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job:
+                return self._publico(job)
+        return self._remoto(job_id)
+
+    def esperar(self, job_id, versao, timeout):
+        # Bloqueia até o job mudar de versão (ou até ao timeout)
+        with self._cond:
+            if job_id in self.jobs:
+                self._cond.wait_for(lambda: job_id not in self.jobs or self.jobs[job_id]['versao'] != versao, timeout)
+                job = self.jobs.get(job_id)
+                return self._publico(job) if job else None
+        # Job de outro worker: consultar o estado partilhado periodicamente
+        limite = time.monotonic() + timeout
+        while True:
+            job = self._remoto(job_id)
+            if job is None or job['versao'] != versao or time.monotonic() >= limite:
+                return job
+            time.sleep(0.5)
+
+    def cancelar(self, job_id):
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if not job:
+                remoto = self._remoto(job_id)
+                if not remoto or remoto['estado'] in self.TERMINAIS:
+                    return False
+                # O worker dono do job aplica-o (_cancelamentos_remotos)
+                self.partilhado.definir('cancelar_imagem', job_id, True, ttl=STATE_TTL)
+                return True
+            if job['estado'] in self.TERMINAIS:
+                return False
+            for controlo in self._controlo:
+                controlo.put(job_id)
+            if job['estado'] == 'em_fila':
+                # Ainda não começou: o worker que o apanhar descarta-o
+                self._atualizar(job, {'estado': 'cancelado'})
+                terminado = True
+            else:
+                terminado = False
+        if terminado:
+            self._terminar(job)
+        return True
+
+    def cancelar_chat(self, chat_id):
+        with self._cond:
+            ids = [j for j, job in self.jobs.items() if job['chat_id'] == chat_id and job['estado'] not in self.TERMINAIS]
+        if self.partilhado:
+            ids += [j for j, job in self.partilhado.itens('imagens').items()
+                    if job['chat_id'] == chat_id and job['estado'] not in self.TERMINAIS and j not in ids]
+        for job_id in ids:
+            self.cancelar(job_id)
+
+    def _cancelamentos_remotos(self):
+        # No máximo uma vez por segundo, na thread que recolhe os eventos
+        if not self.partilhado or time.monotonic() - self._verificado < 1:
+            return
+        self._verificado = time.monotonic()
+        with self._cond:
+            ativos = [j for j, job in self.jobs.items() if job['estado'] not in self.TERMINAIS]
+        for job_id in ativos:
+            if self.partilhado.retirar('cancelar_imagem', job_id):
+                self.cancelar(job_id)
+
+    def aquecer(self):
+        with self._cond:
+            if not self._iniciado:
+                self._iniciar()
+            for _ in range(self.n_workers):
+                self._fila.put({'tipo': 'aquecer'})
+
+    def _atualizar(self, job, campos):
+        # Chamado com _cond adquirido
+        job.update(campos)
+        job['versao'] += 1
+        self._publicar(job)
+        self._cond.notify_all()
+
+    def _terminar(self, job):
+        if not self.ao_terminar:
+            return
+        try:
+            ai_text = self.ao_terminar(self._publico(job))
+        except Exception as e:
+            logging.error(f"Erro ao concluir o job de imagem {job['id']}: {e}")
+            ai_text = "Lamento, não foi possível gerar a imagem."
+        with self._cond:
+            self._atualizar(job, {'ai_text': ai_text})
+
+    def _recolher(self):
+        while True:
+            self._cancelamentos_remotos()
+            try:
+                ev = self._eventos.get(timeout=1 if self.partilhado else 5)
+            except queue.Empty:
+                self._verificar_workers()
+                continue
+            with self._cond:
+                job = self.jobs.get(ev.pop('id'))
+                if job is None or job['estado'] in self.TERMINAIS:
+                    continue
+                if 'worker' in ev:
+                    # Primeiro evento do worker que pegou no job
+                    ev['iniciado'] = time.time()
+                    metricas.observar('chatbot_imagem_fila_segundos', ev['iniciado'] - job['criado'])
+                self._atualizar(job, ev)
+                terminal = job['estado'] in self.TERMINAIS
+            if terminal:
+                if job['iniciado'] is not None:
+                    metricas.observar('chatbot_imagem_geracao_segundos', time.time() - job['iniciado'], estado=job['estado'])
+                if job['estado'] == 'concluido':
+                    self._guardar_artefacto(job)
+                elif job['output_path'] and os.path.exists(job['output_path']):
+                    os.remove(job['output_path'])
+                self._terminar(job)
+
+    def _verificar_workers(self):
+        # Um worker que morreu (ex: falta de memória) é relançado e o job que tinha falha
+        with self._cond:
+            mortos = [i for i, p in enumerate(self._processos) if not p.is_alive()]
+            falhados = []
+            for i in mortos:
+                logging.error(f"Worker de imagens {i} terminou inesperadamente; a relançar")
+                self._lancar_worker(i)
+                for job in self.jobs.values():
+                    if job.get('worker') == i and job['estado'] == 'a_gerar':
+                        self._atualizar(job, {'estado': 'erro', 'erro': 'O processo de geração terminou inesperadamente'})
+                        falhados.append(job)
+        for job in falhados:
+            self._terminar(job)
+
+    def encerrar(self):
+        with self._cond:
+            if not self._iniciado:
+                return
+            for _ in self._processos:
+                self._fila.put(None)
+
+    def metrics(self):
+        with self._cond:
+            estados = {}
+            for job in self.jobs.values():
+                estados[job['estado']] = estados.get(job['estado'], 0) + 1
+            return {'workers': self.n_workers, 'iniciado': self._iniciado, 'jobs': estados}
@@ -23,8 +23,7 @@ window.onload = async function() {
 
     // Recupera o último chat selecionado do localStorage
     const lastChatId = localStorage.getItem('lastChatId');
-    const res = await fetch('/chats');
-    const chats = await res.json();
+    const chats = Array.from(chatListState.chats.values());
     if (lastChatId && chats.some(chat => chat.id === lastChatId)) {
         await selectChat(lastChatId);
     } else if (chats.length > 0) {
@@ -92,15 +91,16 @@ window.onload = async function() {
         aiAbortController = new AbortController();
         let data = null;
         let aborted = false;
+        let streamDiv = null;
         try {
             const res = await fetch(`/chat/${chatIdToUse}/send`, {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({message: msg}),
+                body: JSON.stringify({message: msg, stream: true}),
                 signal: aiAbortController.signal
             });
-            data = await res.json();
             if (!res.ok) {
+                data = await res.json();
                 hideLoadingIndicator();
                 addTypewriterBubble(data.error || 'Erro ao processar resposta.', 'bot');
                 isProcessing = false;
@@ -109,12 +109,28 @@ window.onload = async function() {
                 chatInput.focus();
                 return;
             }
+            // Mostra os tokens à medida que chegam
+            let textoParcial = '';
+            data = await lerStreamResposta(res, function(token) {
+                if (!streamDiv) {
+                    hideLoadingIndicator();
+                    streamDiv = document.createElement('div');
+                    streamDiv.className = 'bubble bot';
+                    document.getElementById('chat-area').appendChild(streamDiv);
+                }
+                textoParcial += token;
+                streamDiv.innerHTML = formatAIText(textoParcial);
+                forceScrollToBottom();
+            });
+            if (!data) throw new Error('Stream terminou sem resposta final');
         } catch (err) {
             hideLoadingIndicator();
             if (err.name === 'AbortError') {
-                addTypewriterBubble('⏹️ Resposta cancelada pelo usuário.', 'bot');
+                // Mantém o texto parcial já mostrado
+                if (!streamDiv) addTypewriterBubble('⏹️ Resposta cancelada pelo usuário.', 'bot');
                 aborted = true;
             } else {
+                if (streamDiv) streamDiv.remove();
                 addTypewriterBubble('Erro ao processar resposta.', 'bot');
             }
             isProcessing = false;
@@ -126,10 +142,12 @@ window.onload = async function() {
         // Só agora, depois de tudo pronto, atualize a interface (se não foi abortado):
         if (!aborted) {
             hideLoadingIndicator();
-            addTypewriterBubble(data.ai_text, 'bot', true, msg);
-            if (data.memoria_atualizada) {
-                showMemoryNotification('A Memória foi atualizada!');
+            if (streamDiv) streamDiv.remove();
+            addTypewriterBubble(data.ai_text, 'bot', false, msg);
+            if (data.image_job) {
+                acompanharImagem(data.image_job, document.getElementById('chat-area').lastElementChild, msg);
             }
+            aplicarAtualizacoes(chatIdToUse, data);
         }
         isProcessing = false;
         sendBtn.innerHTML = '<svg width="24" height="24" viewBox="0 0 24 24" fill="none" xmlns="http://www.w3.org/2000/svg"><path d="M7 11L12 6L17 11M12 18V7" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"/></svg>';
@@ -146,11 +164,104 @@ window.onload = async function() {
     });
 };
 
+// Lê a resposta NDJSON de /chat/<cid>/send em modo stream.
+// Chama onToken para cada token e devolve o objeto final ({done: true, ai_text, ...}).
+async function lerStreamResposta(res, onToken) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = null;
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let nl;
+        while ((nl = buffer.indexOf('\n')) >= 0) {
+            const linha = buffer.slice(0, nl).trim();
+            buffer = buffer.slice(nl + 1);
+            if (!linha) continue;
+            const evento = JSON.parse(linha);
+            if (evento.done) {
+                final = evento;
+            } else if (evento.token) {
+                onToken(evento.token);
+            }
+        }
+    }
+    if (buffer.trim()) {
+        const evento = JSON.parse(buffer);
+        if (evento.done) final = evento;
+    }
+    return final;
+}
+
+// Aplica as notificações das tarefas em segundo plano (memória, nome do chat)
+// e continua a perguntar ao servidor enquanto houver tarefas pendentes
+function aplicarAtualizacoes(chatId, data, tentativas = 0) {
+    if (data.memoria_atualizada) {
+        showMemoryNotification('A Memória foi atualizada!');
+    }
+    if (data.nome) {
+        const li = document.querySelector(`#chat-list .chat-list-item[data-id="${chatId}"]`);
+        if (li) {
+            li.childNodes[0].textContent = truncateChatName(data.nome);
+            li.title = data.nome;
+        }
+    }
+    if (data.tarefas_pendentes && tentativas < 20) {
+        setTimeout(async () => {
+            try {
+                const res = await fetch(`/chat/${chatId}/updates`);
+                aplicarAtualizacoes(chatId, await res.json(), tentativas + 1);
+            } catch (e) { console.error('Erro ao obter atualizações:', e); }
+        }, 1500);
+    }
+}
+
+// Acompanha um job de geração de imagem (Server-Sent Events) e mostra o progresso na bolha.
+// Quando o job termina, a bolha é substituída pela resposta final (imagem, erro ou cancelamento).
+function acompanharImagem(jobId, bubble, userMsg) {
+    const fonte = new EventSource(`/api/images/${jobId}/events`);
+    fonte.onmessage = function(e) {
+        const job = JSON.parse(e.data);
+        if (job.estado === 'em_fila') {
+            bubble.innerText = '🖼️ Na fila para gerar a imagem...';
+        } else if (job.estado === 'a_gerar') {
+            bubble.innerText = `🖼️ A gerar imagem... ${job.passo}/${job.total}`;
+        }
+        if (job.ai_text) {
+            fonte.close();
+            bubble.remove();
+            addTypewriterBubble(job.ai_text, 'bot', false, userMsg);
+        }
+    };
+    fonte.onerror = function() {
+        // O servidor fechou o stream (job terminado ou removido)
+        fonte.close();
+    };
+}
+
 // --- Funções globais para manipulação de chats ---
+// Lista de chats mantida no cliente: depois do primeiro pedido só vêm as alterações (/chats?since=)
+const chatListState = {cursor: '', chats: new Map()};
+const JANELA_BLOCOS = 50;  // blocos carregados de cada vez ao abrir um chat
+
+async function fetchChatList() {
+    const response = await fetch(`/chats?since=${encodeURIComponent(chatListState.cursor)}`);
+    const delta = await response.json();
+    if (delta.full) {
+        chatListState.chats = new Map(delta.chats.map(chat => [chat.id, chat]));
+    } else {
+        delta.changed.forEach(chat => chatListState.chats.set(chat.id, chat));
+        delta.deleted.forEach(id => chatListState.chats.delete(id));
+    }
+    chatListState.cursor = delta.cursor;
+    return Array.from(chatListState.chats.values());
+}
+
 async function loadChats() {
     try {
-        const response = await fetch(`/chats`);
-        const chats = await response.json();
+        const chats = await fetchChatList();
         // Atualiza cache global de chats
         window.chatListCache = {};
         const chatList = document.getElementById('chat-list');
@@ -197,12 +308,7 @@ async function loadChats() {
     } catch (error) { console.error('Erro ao carregar chats:', error); }
 }
 
-async function selectChat(chatId) {
-    currentChatId = chatId;
-    pendingNewChat = false;
-    document.getElementById('chat-area').innerHTML = '<div id="fim-chat"></div>';
-    const res = await fetch(`/chat/${chatId}`);
-    const blocks = await res.json();
+function mostrarBlocos(blocks) {
     for (const block of blocks) {
         addBubble(block.user_variants[block.selected], 'user');
         // Só mostra a resposta da IA se ela existir e não for vazia
@@ -211,6 +317,43 @@ async function selectChat(chatId) {
             addTypewriterBubble(aiResp, 'bot', false);
         }
     }
+}
+
+// Botão no topo da conversa para carregar a janela de blocos anterior
+function mostrarBotaoAnteriores(chatId, antes) {
+    const area = document.getElementById('chat-area');
+    const btn = document.createElement('button');
+    btn.className = 'load-older-btn';
+    btn.innerText = 'Mostrar mensagens anteriores';
+    btn.onclick = () => carregarAnteriores(chatId, antes, btn);
+    area.insertBefore(btn, area.firstChild);
+}
+
+async function carregarAnteriores(chatId, antes, btn) {
+    btn.disabled = true;
+    const res = await fetch(`/chat/${chatId}?limit=${JANELA_BLOCOS}&before=${antes}`);
+    const janela = await res.json();
+    if (chatId !== currentChatId) return;
+    // As bolhas são sempre acrescentadas no fim: desenha a janela antiga e volta a pôr as atuais depois
+    const area = document.getElementById('chat-area');
+    const atuais = Array.from(area.childNodes).filter(n => n !== btn);
+    area.innerHTML = '';
+    mostrarBlocos(janela.blocks);
+    atuais.forEach(n => area.appendChild(n));
+    if (janela.next_before !== null) mostrarBotaoAnteriores(chatId, janela.next_before);
+}
+
+async function selectChat(chatId) {
+    currentChatId = chatId;
+    pendingNewChat = false;
+    document.getElementById('chat-area').innerHTML = '<div id="fim-chat"></div>';
+    const res = await fetch(`/chat/${chatId}?limit=${JANELA_BLOCOS}`);
+    const janela = await res.json();
+    if (chatId !== currentChatId) return;
+    mostrarBlocos(janela.blocks || []);
+    if (janela.next_before !== null && janela.next_before !== undefined) {
+        mostrarBotaoAnteriores(chatId, janela.next_before);
+    }
     setTimeout(() => {
         forceScrollToBottom();
     }, 100);
@@ -0,0 +1,29 @@
+# O app cria os seus ficheiros (chats.db, settings.json, uploads, ...) no diretório atual ao ser
+# importado: os testes correm num diretório temporário e sem o Ollama (embeddings por hash).
+import os
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault('MEMORY_EMBEDDINGS', 'hash')
+os.chdir(tempfile.mkdtemp(prefix='chatbot-testes-'))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def caminho_db(tmp_path):
+    return str(tmp_path / 'chats.db')
+
+
+@pytest.fixture
+def store(caminho_db):
+    return app.ChatStore(caminho_db)
+
+
+@pytest.fixture
+def gestor(store):
+    return app.ChatManager(store, app.LocalState())
@@ -0,0 +1,57 @@
+# Análise da mensagem: só uma resposta fora do esquema leva às extrações individuais; se o modelo
+# não responder (fila cheia, prazo, circuito aberto) não há mais chamadas e contam só as verificações locais.
+from concurrent.futures import Future
+
+import pytest
+
+import app
+from escalonador_ollama import OllamaIndisponivel, PrazoExcedido, SobrecargaOllama
+
+
+@pytest.fixture
+def submetidas(monkeypatch):
+    registo = []
+    monkeypatch.setattr(app.tarefas, 'submit', lambda key, fn, *args: registo.append(key[0]))
+    return registo
+
+
+@pytest.fixture
+def chamadas(monkeypatch):
+    # Tarefas pedidas ao modelo; `resposta` é o conteúdo devolvido ou a exceção a lançar
+    registo = {'tarefas': [], 'resposta': None}
+
+    def chat(tarefa, mensagens, **kwargs):
+        registo['tarefas'].append(tarefa)
+        if isinstance(registo['resposta'], Exception):
+            raise registo['resposta']
+        return {'message': {'content': registo['resposta']}}
+
+    monkeypatch.setattr(app.modelos, 'chat', chat)
+    return registo
+
+
+@pytest.mark.parametrize('erro', [SobrecargaOllama('modelo', 1), OllamaIndisponivel(5),
+                                  PrazoExcedido('prazo'), ConnectionError('recusada')])
+def test_modelo_sem_resposta_nao_faz_trabalho_extra(submetidas, chamadas, erro):
+    chamadas['resposta'] = erro
+    analise = app.processar_analise_mensagem('c', 0, 'u', 'fala-me de json', primeira=True)
+    assert analise == app.analise_sem_modelo()
+    assert not submetidas
+    assert app.decidir_ficheiro('fala-me de json', analise) == (False, None)
+    assert app.decidir_ficheiro('gera um pdf com o resumo', analise) == (True, 'pdf')
+    # Só a chamada da análise chegou ao modelo
+    assert chamadas['tarefas'] == ['extraction']
+
+
+def test_resposta_fora_do_esquema_usa_as_extracoes_individuais(submetidas, chamadas):
+    chamadas['resposta'] = '{"perfil": "não é um objeto"}'
+    assert app.processar_analise_mensagem('c', 0, 'u', 'olá', primeira=True) is None
+    assert sorted(submetidas) == ['memoria', 'nome', 'perfil']
+
+
+def test_espera_esgotada_decide_so_com_as_verificacoes_locais(chamadas):
+    futuro = Future()
+    analise = app.esperar_analise(futuro, 'c', 0, 'u', 'olá', False, espera=0)
+    assert analise == app.analise_sem_modelo()
+    assert app.decidir_ficheiro('olá', analise) == (False, None)
+    assert chamadas['tarefas'] == []
@@ -0,0 +1,96 @@
+# Lock striping do ChatManager: chats em stripes diferentes avançam em paralelo, e uma operação
+# demorada num chat não atrasa os outros nem a listagem.
+import threading
+
+import app
+
+N_CHATS = 8
+
+
+def chats_em_stripes_diferentes(gestor, n):
+    # Ids cujos locks são todos diferentes (o hash das strings muda de processo para processo)
+    cids, stripes = [], set()
+    i = 0
+    while len(cids) < n:
+        cid = f'chat-{i}'
+        i += 1
+        if id(gestor.lock(cid)) not in stripes:
+            stripes.add(id(gestor.lock(cid)))
+            cids.append(cid)
+    return cids
+
+
+def criar_chats(gestor, cids):
+    for cid in cids:
+        gestor[cid] = app.Chat(cid, app.new_chat_obj())
+
+
+def test_chats_diferentes_seguram_os_locks_ao_mesmo_tempo(gestor):
+    # Cada thread segura o lock do seu chat até todas chegarem à barreira: só é possível se nenhum
+    # lock bloquear os outros
+    cids = chats_em_stripes_diferentes(gestor, N_CHATS)
+    barreira = threading.Barrier(N_CHATS, timeout=10)
+    erros = []
+
+    def segurar(cid):
+        try:
+            with gestor.lock(cid):
+                barreira.wait()
+        except threading.BrokenBarrierError as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=segurar, args=(cid,)) for cid in cids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(15)
+    assert not erros
+    assert not any(t.is_alive() for t in threads)
+
+
+def test_lock_de_um_chat_nao_bloqueia_os_outros(gestor):
+    ocupado, *livres = chats_em_stripes_diferentes(gestor, N_CHATS)
+    criar_chats(gestor, [ocupado] + livres)
+    feitos = []
+
+    def conversar(cid):
+        idx, _ = gestor.adicionar_bloco(cid, 'olá')
+        gestor.definir_resposta(cid, idx, 'resposta')
+        gestor.renomear(cid, f'Nome de {cid}')
+        feitos.append(cid)
+
+    with gestor.lock(ocupado):
+        threads = [threading.Thread(target=conversar, args=(cid,)) for cid in livres]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        # Com o lock do primeiro chat ainda adquirido, todos os outros terminaram
+        assert sorted(feitos) == sorted(livres)
+        assert {c['name'] for c in gestor.listar() if c['id'] in livres} == {f'Nome de {cid}' for cid in livres}
+
+        # O próprio chat ocupado espera pelo lock
+        bloqueado = threading.Thread(target=conversar, args=(ocupado,))
+        bloqueado.start()
+        bloqueado.join(0.2)
+        assert bloqueado.is_alive()
+    bloqueado.join(10)
+    assert ocupado in feitos
+    assert gestor.copia_blocos(ocupado)[0]['ai_responses'] == ['resposta']
+
+
+def test_listagem_nao_usa_os_locks_dos_chats(gestor):
+    cids = chats_em_stripes_diferentes(gestor, N_CHATS)
+    criar_chats(gestor, cids)
+    resultado = []
+    for lock in gestor._stripes:
+        lock.acquire()
+    try:
+        t = threading.Thread(target=lambda: resultado.append(gestor.listar()))
+        t.start()
+        t.join(5)
+        assert not t.is_alive()
+    finally:
+        for lock in gestor._stripes:
+            lock.release()
+    assert [c['id'] for c in resultado[0]] == cids
@@ -0,0 +1,253 @@
+# Persistência dos chats em SQLite: migração do JSON antigo, versões das escritas e recuperação
+# depois de o processo morrer.
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import app
+import armazenamento
+from conftest import RAIZ
+
+
+def bloco(pergunta, resposta=None):
+    return {'user_variants': [pergunta], 'ai_responses': [resposta], 'selected': 0}
+
+
+def escrever_json_antigo(tmp_path):
+    caminho = tmp_path / 'chats_data.json'
+    caminho.write_text(json.dumps({
+        'c1': {'name': 'Primeiro', 'conversation_blocks': [bloco('olá', 'olá!')]},
+        'c2': {'name': 'Segundo', 'conversation_blocks': [bloco('um', '1'), bloco('dois', '2')]},
+    }), encoding='utf-8')
+    return str(caminho)
+
+
+def correr_e_morrer(tmp_path, codigo):
+    # Corre `codigo` noutro processo (com `store` = ChatStore de chats.db) e termina-o com os._exit,
+    # sem fechar ligações nem fazer checkpoint do WAL, como um processo morto a meio
+    script = (f"import os, sys; sys.path.insert(0, {RAIZ!r}); import app\n"
+              f"store = app.ChatStore({str(tmp_path / 'chats.db')!r})\n"
+              f"{codigo}\n"
+              "os._exit(0)\n")
+    env = dict(os.environ, MEMORY_EMBEDDINGS='hash')
+    subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), env=env, check=True, timeout=120)
+
+
+def test_migracao_interrompida_fica_vazia_e_repete(tmp_path, caminho_db):
+    ficheiro = escrever_json_antigo(tmp_path)
+    store = app.ChatStore(caminho_db)
+    # Falha a meio da migração: o primeiro chat já foi inserido quando o segundo falha. O trigger é
+    # temporário (só desta ligação); numa só thread o pool devolve sempre a mesma ligação
+    with store._ligacao() as con:
+        con.execute("CREATE TEMP TRIGGER falhar BEFORE INSERT ON blocks WHEN new.chat_id = 'c2' "
+                    "BEGIN SELECT RAISE(ABORT, 'falha simulada'); END")
+    store.migrar_json(ficheiro)
+    assert store.carregar_metadados() == {}
+    assert os.path.exists(ficheiro)
+    assert not os.path.exists(ficheiro + '.migrado')
+
+    with store._ligacao() as con:
+        con.execute("DROP TRIGGER falhar")
+    app.ChatStore(caminho_db).migrar_json(ficheiro)
+    meta = app.ChatStore(caminho_db).carregar_metadados()
+    assert list(meta) == ['c1', 'c2']
+    assert meta['c2']['n_blocos'] == 2
+    assert not os.path.exists(ficheiro)
+    assert os.path.exists(ficheiro + '.migrado')
+
+
+def test_migracao_nao_repete_com_chats_na_base(tmp_path, store):
+    ficheiro = escrever_json_antigo(tmp_path)
+    store.guardar_chat('existente', {'name': 'Já cá estava', 'versao': 0})
+    store.migrar_json(ficheiro)
+    assert list(store.carregar_metadados()) == ['existente']
+    assert os.path.exists(ficheiro)
+
+
+def test_escrita_de_bloco_antiga_e_ignorada(store):
+    store.guardar_chat('c', {'name': 'Chat', 'versao': 0})
+    store.guardar_bloco('c', 0, bloco('pergunta', 'resposta nova'), 3)
+    store.guardar_bloco('c', 0, bloco('pergunta', None), 2)
+    data = store.carregar_chat('c')
+    assert data['conversation_blocks'][0]['ai_responses'] == ['resposta nova']
+    assert data['versao'] == 3
+
+
+def test_escrita_do_chat_antiga_e_ignorada(store):
+    store.guardar_chat('c', {'name': 'Novo nome', 'versao': 5})
+    store.guardar_chat('c', {'name': 'Nome antigo', 'versao': 4})
+    assert store.carregar_chat('c')['name'] == 'Novo nome'
+
+
+def test_renomear_depois_de_bloco_mais_recente(store):
+    # A renomeação (versão 2) chega ao SQLite depois da resposta (versão 3): não pode ser descartada
+    store.guardar_chat('c', {'name': 'Novo Chat', 'versao': 0})
+    store.guardar_bloco('c', 0, bloco('olá'), 1)
+    store.guardar_bloco('c', 0, bloco('olá', 'resposta'), 3)
+    store.guardar_chat('c', {'name': 'Titulo gerado', 'versao': 2})
+    data = store.carregar_chat('c')
+    assert data['name'] == 'Titulo gerado'
+    assert data['versao'] == 3
+    assert data['conversation_blocks'][0]['ai_responses'] == ['resposta']
+
+
+def test_renomear_em_corrida_com_resposta(caminho_db, store, gestor):
+    # Como na primeira mensagem: o nome gerado em segundo plano e a resposta são gravados ao mesmo
+    # tempo, e a gravação do nome só chega ao SQLite depois da do bloco
+    gestor['c'] = app.Chat('c', app.new_chat_obj())
+    block_idx, _ = gestor.adicionar_bloco('c', 'olá')
+    bloco_gravado = threading.Event()
+    guardar_chat, guardar_bloco = store.guardar_chat, store.guardar_bloco
+
+    def guardar_chat_atrasado(cid, data):
+        assert bloco_gravado.wait(10)
+        guardar_chat(cid, data)
+
+    def guardar_bloco_e_avisar(*args):
+        guardar_bloco(*args)
+        bloco_gravado.set()
+
+    store.guardar_chat, store.guardar_bloco = guardar_chat_atrasado, guardar_bloco_e_avisar
+    renomear = threading.Thread(target=gestor.renomear, args=('c', 'Titulo gerado'), kwargs={'apenas_se_nome': 'Novo Chat'})
+    renomear.start()
+    # A renomeação já incrementou a versão em memória antes da resposta
+    while gestor.versao('c') < 2:
+        time.sleep(0.001)
+    gestor.definir_resposta('c', block_idx, 'resposta')
+    renomear.join(10)
+
+    data = app.ChatStore(caminho_db).carregar_chat('c')
+    assert data['name'] == 'Titulo gerado'
+    assert data['conversation_blocks'][0]['ai_responses'] == ['resposta']
+
+
+def test_reabrir_depois_de_o_processo_morrer(tmp_path, caminho_db):
+    correr_e_morrer(tmp_path, (
+        "store.guardar_chat('c', {'name': 'Sobrevive', 'versao': 0})\n"
+        "for i in range(3):\n"
+        "    store.guardar_bloco('c', i, {'user_variants': [str(i)], 'ai_responses': ['ok'], 'selected': 0}, i + 1)"))
+    # As escritas ficaram só no WAL
+    assert os.path.getsize(caminho_db + '-wal') > 0
+    data = app.ChatStore(caminho_db).carregar_chat('c')
+    assert data['name'] == 'Sobrevive'
+    assert [b['user_variants'] for b in data['conversation_blocks']] == [['0'], ['1'], ['2']]
+    assert app.ChatStore(caminho_db).carregar_metadados()['c']['n_blocos'] == 3
+
+
+def test_transacao_a_meio_e_descartada(tmp_path, caminho_db):
+    correr_e_morrer(tmp_path, (
+        "store.guardar_chat('c', {'name': 'Chat', 'versao': 0})\n"
+        "with store._ligacao() as con:\n"
+        "    con.execute('BEGIN IMMEDIATE')\n"
+        "    con.execute(\"INSERT INTO blocks (chat_id, idx, versao, data) VALUES ('c', 0, 1, '{}')\")\n"
+        "    os._exit(0)"))
+    store = app.ChatStore(caminho_db)
+    assert store.carregar_chat('c')['conversation_blocks'] == []
+    # A base de dados continua a aceitar escritas (o lock da transação morta foi libertado)
+    store.guardar_bloco('c', 0, bloco('depois'), 1)
+    assert store.carregar_chat('c')['conversation_blocks'] == [bloco('depois')]
+
+
+def test_base_antiga_recebe_versao_meta(caminho_db):
+    con = sqlite3.connect(caminho_db)
+    con.executescript("""
+        CREATE TABLE chats (id TEXT PRIMARY KEY, name TEXT NOT NULL, ordem INTEGER NOT NULL,
+                            versao INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL,
+                            extra TEXT NOT NULL DEFAULT '{}');
+        CREATE TABLE blocks (chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE, idx INTEGER NOT NULL,
+                             versao INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (chat_id, idx)) WITHOUT ROWID;
+        INSERT INTO chats VALUES ('c', 'Antigo', 1, 7, 0, '{}');
+        INSERT INTO blocks VALUES ('c', 0, 7, '{"user_variants": ["x"], "ai_responses": ["y"], "selected": 0}');
+    """)
+    con.close()
+    store = app.ChatStore(caminho_db)
+    assert store.carregar_metadados()['c']['n_blocos'] == 1
+    store.guardar_chat('c', {'name': 'Renomeado', 'versao': 8})
+    assert store.carregar_chat('c')['name'] == 'Renomeado'
+
+
+def test_dois_workers_acrescentam_ao_mesmo_chat(caminho_db):
+    # Dois workers (cada um com a sua cache) sobre a mesma base de dados: o segundo ainda não viu o
+    # bloco do primeiro quando acrescenta o seu, e nenhum dos dois pode ser substituído
+    a = app.ChatManager(app.ChatStore(caminho_db), app.LocalState())
+    a['c'] = app.Chat('c', app.new_chat_obj())
+    b = app.ChatManager(app.ChatStore(caminho_db), app.LocalState())
+    assert b.copia_blocos('c') == []
+
+    assert a.adicionar_bloco('c', 'de a') == (0, [])
+    idx, anteriores = b.adicionar_bloco('c', 'de b')
+    assert idx == 1
+    assert [x['user_variants'] for x in anteriores] == [['de a']]
+    assert [x['user_variants'] for x in b.copia_blocos('c')] == [['de a'], ['de b']]
+    b.definir_resposta('c', idx, 'resposta a b')
+
+    data = app.ChatStore(caminho_db).carregar_chat('c')
+    assert [x['user_variants'] for x in data['conversation_blocks']] == [['de a'], ['de b']]
+    assert data['conversation_blocks'][1]['ai_responses'] == ['resposta a b']
+
+
+def test_workers_em_paralelo_nunca_partilham_um_indice(caminho_db):
+    app.ChatManager(app.ChatStore(caminho_db), app.LocalState())['c'] = app.Chat('c', app.new_chat_obj())
+    gestores = [app.ChatManager(app.ChatStore(caminho_db), app.LocalState()) for _ in range(2)]
+    for g in gestores:
+        g.copia_blocos('c')  # ambos com o chat em cache
+    indices = []
+
+    def acrescentar(g, nome):
+        for i in range(10):
+            idx, _ = g.adicionar_bloco('c', f'{nome}-{i}')
+            indices.append(idx)
+
+    threads = [threading.Thread(target=acrescentar, args=(g, f'{n}{t}'))
+               for n, g in enumerate(gestores) for t in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    assert sorted(indices) == list(range(40))
+    blocos = app.ChatStore(caminho_db).carregar_chat('c')['conversation_blocks']
+    assert len({x['user_variants'][0] for x in blocos}) == 40
+
+
+def test_pool_reutiliza_as_ligacoes_entre_threads(caminho_db):
+    # Uma thread por pedido (como no servidor de desenvolvimento) não abre uma ligação nova de cada vez
+    store = app.ChatStore(caminho_db)
+    store.guardar_chat('c', {'name': 'Chat', 'versao': 0})
+    barreira = threading.Barrier(4, timeout=10)
+
+    def pedido():
+        with store._ligacao():
+            barreira.wait()  # quatro ligações em uso ao mesmo tempo
+        store.carregar_chat('c')
+
+    for _ in range(10):
+        threads = [threading.Thread(target=pedido) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+    assert store.pool.metrics()['abertas'] == 4
+
+
+def test_pool_cheio_espera_por_uma_ligacao_livre(caminho_db):
+    pool = armazenamento.PoolSQLite(caminho_db, tamanho=1)
+    obtida = threading.Event()
+
+    def outra():
+        with pool.ligacao():
+            obtida.set()
+
+    with pool.ligacao() as con:
+        con.execute('BEGIN IMMEDIATE')  # deixada a meio: o pool desfaz a transação ao devolver
+        t = threading.Thread(target=outra)
+        t.start()
+        assert not obtida.wait(0.2)
+    assert obtida.wait(10)
+    t.join(10)
+    with pool.ligacao() as con:
+        assert not con.in_transaction
+    assert pool.metrics() == {'abertas': 1, 'livres': 1, 'max': 1}
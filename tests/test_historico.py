@@ -0,0 +1,64 @@
+# Histórico enviado ao modelo: turnos recentes literais e o resto através do resumo, sem repetir blocos.
+import re
+import uuid
+
+import pytest
+
+import app
+
+
+def criar_chat_com_blocos(n):
+    cid = uuid.uuid4().hex
+    app.chats[cid] = app.Chat(cid, app.new_chat_obj())
+    for i in range(n):
+        idx, _ = app.chats.adicionar_bloco(cid, f'pergunta B{i:02d}')
+        app.chats.definir_resposta(cid, idx, f'resposta {i}')
+    return cid
+
+
+def blocos_citados(mensagens):
+    # Contagem de cada marcador de bloco (Bnn, só nas perguntas e no resumo) nas mensagens montadas
+    contagem = {}
+    for m in mensagens:
+        for marcador in set(re.findall(r'B\d\d', m['content'])):
+            contagem[marcador] = contagem.get(marcador, 0) + 1
+    return contagem
+
+
+@pytest.fixture
+def submetidas(monkeypatch):
+    # Regista as tarefas em vez de as correr (o resumo chamaria o modelo)
+    registo = []
+    monkeypatch.setattr(app.tarefas, 'submit', lambda key, fn, *args: registo.append((key, args)))
+    return registo
+
+
+@pytest.mark.parametrize('orcamento', [10 ** 6, 60, 25])
+def test_cada_bloco_aparece_uma_so_vez(submetidas, orcamento):
+    cid = criar_chat_com_blocos(10)
+    # O resumo cobre os blocos 0..5 (um lote à frente da janela literal)
+    resumo = ' '.join(f'B{i:02d}' for i in range(6))
+    assert app.chats.guardar_resumo(cid, f'resumo de {resumo}', 6)
+    mensagens = app.construir_historico(cid, app.chats.copia_blocos(cid), orcamento)
+    contagem = blocos_citados(mensagens)
+    assert all(n == 1 for n in contagem.values()), contagem
+    assert {f'B{i:02d}' for i in range(6)} <= set(contagem)
+
+
+def test_blocos_cobertos_pelo_resumo_nao_entram_literalmente(submetidas):
+    cid = criar_chat_com_blocos(8)
+    assert app.chats.guardar_resumo(cid, 'resumo de B00 B01 B02', 3)
+    mensagens = app.construir_historico(cid, app.chats.copia_blocos(cid), 10 ** 6)
+    literais = [m['content'] for m in mensagens if m['role'] == 'user']
+    assert literais == [f'pergunta B{i:02d}' for i in range(3, 8)]
+    assert not submetidas
+
+
+def test_janela_curta_atualiza_o_resumo(submetidas):
+    cid = criar_chat_com_blocos(8)
+    mensagens = app.construir_historico(cid, app.chats.copia_blocos(cid), 25)
+    primeiro_literal = int(re.search(r'B(\d\d)', mensagens[0]['content']).group(1))
+    assert primeiro_literal > 0
+    (chave, args), = submetidas
+    assert chave == ('resumo', cid)
+    assert args[1] == min(8, primeiro_literal + app.SUMMARY_BATCH)